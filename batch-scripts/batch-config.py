@@ -1,8 +1,13 @@
 import boto3
 import logging, os
 import argparse
+import threading, time
+import random
 
 from botocore.config import Config
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as EndpointError
+from concurrent.futures import ThreadPoolExecutor
 from jproperties import Properties
 
 '''
@@ -50,6 +55,180 @@ def deploy_configuration(props: Properties, nmspce: str):
         raise e
 
 
+'''
+Token bucket shared by the sync writers.  Throttled calls halve the
+rate and recover it gradually after successful calls.
+'''
+class RateLimiter(object):
+
+    def __init__(self, tps: float):
+        self.max_tps = tps
+        self.tps = tps
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    '''
+    block until the caller may make a request
+    '''
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + 1.0 / self.tps
+
+        time.sleep(max(0.0, slot - now))
+
+    def throttled(self):
+        with self.lock:
+            self.tps = max(0.5, self.tps / 2)
+            logger.warning(f'Throttled, reducing rate to {self.tps:0.2f} TPS')
+
+    def succeeded(self):
+        with self.lock:
+            self.tps = min(self.max_tps, self.tps + 0.1)
+
+
+'''
+errors retried by call_with_limiter, the set botocore's retries cover
+for deploy_configuration.  throttles reduce the rate, transient errors
+back off with jitter
+'''
+THROTTLE_CODES = ('ThrottlingException', 'Throttling', 'TooManyUpdates', 'RequestLimitExceeded')
+TRANSIENT_CODES = ('InternalServerError', 'InternalFailure', 'ServiceUnavailable', 'RequestTimeout',
+    'RequestTimeoutException')
+
+
+'''
+call an SSM operation under the rate limiter, retrying throttled
+requests with a reduced rate and transient failures after a backoff
+'''
+def call_with_limiter(limiter: RateLimiter, operation, max_attempts: int = 8, **kwargs):
+    for attempt in range(1, max_attempts + 1):
+        limiter.acquire()
+        try:
+            response = operation(**kwargs)
+            limiter.succeeded()
+            return response
+
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+            if attempt == max_attempts:
+                raise e
+
+            if code in THROTTLE_CODES:
+                limiter.throttled()
+            elif code in TRANSIENT_CODES or status >= 500:
+                backoff(attempt)
+            else:
+                raise e
+
+        except (EndpointError, HTTPClientError) as e:
+            if attempt == max_attempts:
+                raise e
+            backoff(attempt)
+
+
+'''
+sleep a random part of an exponentially growing, capped delay
+'''
+def backoff(attempt: int, base: float = 0.5, cap: float = 20.0):
+    time.sleep(random.uniform(0, min(cap, base * 2 ** (attempt - 1))))
+
+
+'''
+read the parameters of the namespace in one paginated pass.  properties
+are written flat, so nested namespaces are not read
+'''
+def get_existing_parameters(ssm, nmspce: str, limiter: RateLimiter):
+    existing = {}
+    request = { 'Path': nmspce, 'Recursive': False, 'WithDecryption': False, 'MaxResults': 10 }
+
+    while True:
+        response = call_with_limiter(limiter, ssm.get_parameters_by_path, **request)
+        for p in response['Parameters']:
+            existing[p['Name']] = p['Value']
+
+        if not response.get('NextToken'):
+            return existing
+        request['NextToken'] = response['NextToken']
+
+
+'''
+compare the properties to the deployed namespace.  returns the
+parameters to put (added or changed) and the stale names
+'''
+def diff_configuration(props: Properties, nmspce: str, existing: dict):
+    desired = { f'{nmspce}/{k}': props[k].data for k in props.keys() }
+
+    added = { k: v for k, v in desired.items() if k not in existing }
+    changed = { k: v for k, v in desired.items() if k in existing and existing[k] != v }
+    # written by the lambda and batch-init, never treat them as stale
+    managed = lambda name: name in ('event-resource', 'shard-plan') or name.startswith('batch-init-start')
+    stale = [k for k in existing if k not in desired and not managed(k[len(nmspce) + 1:])
+        and not '/' in k[len(nmspce) + 1:]]
+    return added, changed, stale
+
+
+'''
+Sync configuration.  Only added and changed properties are written,
+concurrently and under an SSM rate limit.  Stale parameters are
+deleted if requested.  A dry run reports the diff without writing.
+'''
+def sync_configuration(props: Properties, nmspce: str, delete_stale: bool = False,
+        dry_run: bool = False, workers: int = 4, tps: float = 3.0):
+    # add prefix slash if necessary
+    nmspce = nmspce if nmspce[0] == '/' else '/' + nmspce
+    nmspce = nmspce.rstrip('/')
+
+    # retries happen in call_with_limiter, so throttles reach the limiter
+    ssm = boto3.client('ssm', config = Config(
+        retries = { 'max_attempts': 1 },
+        max_pool_connections = workers
+    ))
+
+    limiter = RateLimiter(tps)
+    existing = get_existing_parameters(ssm, nmspce, limiter)
+    added, changed, stale = diff_configuration(props, nmspce, existing)
+
+    # existing parameters neither in the file nor stale are managed
+    unchanged = len(props.keys()) - len(added) - len(changed)
+    managed = len(existing) - unchanged - len(changed) - len(stale)
+    logger.info(f'Sync {nmspce}: {len(added)} added, {len(changed)} changed, '
+        + f'{len(stale)} stale, {unchanged} unchanged, {managed} managed')
+    for k in sorted(added):
+        logger.info(f'+ {k} = {added[k]}')
+    for k in sorted(changed):
+        logger.info(f'~ {k} = {existing[k]} -> {changed[k]}')
+    for k in sorted(stale):
+        logger.info(f'- {k}' + ('' if delete_stale else ' (kept)'))
+
+    if dry_run:
+        logger.info('Dry run, no parameters were written.')
+        return
+
+    def put(item):
+        param_path, value = item
+        response = call_with_limiter(limiter, ssm.put_parameter,
+            Name = param_path,
+            Value = value,
+            Type = 'String',
+            Overwrite = True
+        )
+
+        version = response['Version']
+        logger.debug(f'Parameter {param_path} version {version} upload complete')
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        list(executor.map(put, list(added.items()) + list(changed.items())))
+
+    if delete_stale:
+        # delete_parameters accepts 10 names per call
+        for i in range(0, len(stale), 10):
+            call_with_limiter(limiter, ssm.delete_parameters, Names = stale[i:i + 10])
+            logger.debug(f'Deleted stale parameters {stale[i:i + 10]}')
+
+
 '''
 load arguments required by application
 '''
@@ -57,6 +236,11 @@ def init_arguments():
     parser = argparse.ArgumentParser(description = 'Migrate Configuration')
     parser.add_argument('filepath', help = 'Properties file to upload.')
     parser.add_argument('namespace', help = 'Namespace path used in property deployment {namepsace/{prop_name}={prop_value}')
+    parser.add_argument('--sync', action = 'store_true', help = 'Only write added or changed properties.')
+    parser.add_argument('--delete-stale', action = 'store_true', help = 'With --sync, delete parameters missing from the file.')
+    parser.add_argument('--dry-run', action = 'store_true', help = 'With --sync, report the diff without writing.')
+    parser.add_argument('--workers', type = int, default = 4, help = 'With --sync, concurrent writers.')
+    parser.add_argument('--tps', type = float, default = 3.0, help = 'With --sync, maximum PutParameter calls per second.')
     return parser.parse_args()
 
 '''
@@ -92,7 +276,11 @@ if __name__ == '__main__':
         nmspce = args.namespace
 
         properties = load_properties(args)
-        deploy_configuration(properties, nmspce)
+        if args.sync:
+            sync_configuration(properties, nmspce, args.delete_stale,
+                args.dry_run, args.workers, args.tps)
+        else:
+            deploy_configuration(properties, nmspce)
 
         logger.info('Deployment completed successfully.')
 
@@ -1,11 +1,15 @@
-import logging, os, datetime
-import argparse
+import logging, os, sys, datetime
+import argparse, json, threading, shlex
 import boto3, uuid
-import subprocess
+import subprocess, queue
+import zlib, bz2
+import hashlib, shutil
 import requests
 import time
 
+from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import quote_plus
 
 '''
@@ -23,33 +27,340 @@ logger = initialize_logger()
 clients = {}
 
 
+THROTTLE_CODES = ['Throttling', 'ThrottlingException', 'ThrottledException', 'TooManyRequestsException',
+    'RequestLimitExceeded', 'RequestThrottled', 'SlowDown', 'ProvisionedThroughputExceededException']
+
+# latency histogram upper bounds in milliseconds, the last bucket is unbounded
+LATENCY_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+# embedded metric format accepts at most 100 values per metric
+MAX_LATENCY_VALUES = 100
+
+
+'''
+Per service and operation AWS API metrics collected from botocore's
+event system.  before-call/after-call time each API call (retries
+included), needs-retry sees every attempt so throttles absorbed by the
+retry config are counted too.  A copy of lambda/src/metrics.py, since
+batch-init is deployed as a single file.
+'''
+class ApiMetrics(object):
+
+    def __init__(self, namespace: str = 'CfnEc2Processing', enabled: bool = True):
+        self.namespace = namespace
+        self.enabled = enabled
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    '''
+    register the handlers on a client, returns the client
+    '''
+    def instrument(self, client):
+        events = client.meta.events
+        service = client.meta.service_model.service_name
+        events.register_first(f'before-call.{service}.*', self.__before_call)
+        events.register(f'after-call.{service}.*', self.__after_call)
+        events.register(f'after-call-error.{service}.*', self.__after_call_error)
+        events.register_first(f'needs-retry.{service}.*', self.__needs_retry)
+        return client
+
+    def __operation(self, service: str, operation: str):
+        key = (service, operation)
+        if not key in self.operations:
+            self.operations[key] = {
+                'calls': 0, 'errors': 0, 'retries': 0, 'throttles': 0,
+                'latency': [], 'histogram': [0] * (len(LATENCY_BUCKETS) + 1)
+            }
+
+        return self.operations[key]
+
+    def __before_call(self, context, **kwargs):
+        context['metrics_start'] = time.perf_counter()
+
+    def __after_call(self, model, parsed, context, **kwargs):
+        self.__record(model, context, parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+            'Error' in parsed)
+
+    def __after_call_error(self, model, context, **kwargs):
+        self.__record(model, context, 0, True)
+
+    def __record(self, model, context, retries: int, error: bool):
+        elapsed = (time.perf_counter() - context.get('metrics_start', time.perf_counter())) * 1000
+        bucket = len([b for b in LATENCY_BUCKETS if elapsed > b])
+
+        with self.lock:
+            op = self.__operation(model.service_model.service_name, model.name)
+            op['calls'] += 1
+            op['retries'] += retries
+            op['errors'] += 1 if error else 0
+            op['histogram'][bucket] += 1
+            if len(op['latency']) < MAX_LATENCY_VALUES:
+                op['latency'].append(round(elapsed, 3))
+
+    def __needs_retry(self, response, operation, **kwargs):
+        if not response:
+            return
+
+        code = response[1].get('Error', {}).get('Code')
+        if code in THROTTLE_CODES:
+            with self.lock:
+                self.__operation(operation.service_model.service_name, operation.name)['throttles'] += 1
+
+    '''
+    embedded metric format documents, one per service and operation
+    '''
+    def to_emf(self, dimensions: dict = None):
+        dimensions = dimensions or {}
+        timestamp = int(time.time() * 1000)
+        documents = []
+
+        with self.lock:
+            for (service, operation), op in sorted(self.operations.items()):
+                document = {
+                    '_aws': {
+                        'Timestamp': timestamp,
+                        'CloudWatchMetrics': [{
+                            'Namespace': self.namespace,
+                            'Dimensions': [list(dimensions.keys()) + ['Service', 'Operation']],
+                            'Metrics': [
+                                { 'Name': 'Calls', 'Unit': 'Count' },
+                                { 'Name': 'Errors', 'Unit': 'Count' },
+                                { 'Name': 'Retries', 'Unit': 'Count' },
+                                { 'Name': 'Throttles', 'Unit': 'Count' },
+                                { 'Name': 'Latency', 'Unit': 'Milliseconds' }
+                            ]
+                        }]
+                    },
+                    'Service': service,
+                    'Operation': operation,
+                    'Calls': op['calls'],
+                    'Errors': op['errors'],
+                    'Retries': op['retries'],
+                    'Throttles': op['throttles'],
+                    'Latency': op['latency'],
+                    'LatencyHistogram': dict(zip([f'le_{b}ms' for b in LATENCY_BUCKETS] + ['gt_5000ms'], op['histogram']))
+                }
+                document.update(dimensions)
+                documents.append(document)
+
+        return documents
+
+    '''
+    write the metric lines and start a new collection period
+    '''
+    def flush(self, out = None, dimensions: dict = None):
+        if self.enabled:
+            out = out or sys.stdout
+            for document in self.to_emf(dimensions):
+                out.write(json.dumps(document) + '\n')
+            out.flush()
+
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+
+api_metrics = ApiMetrics(os.getenv('METRICS_NAMESPACE', 'CfnEc2Processing'),
+    os.getenv('API_METRICS', 'on') != 'off')
+
+
+'''
+write the api metrics collected during a phase as embedded metric
+lines to batch-init-metrics.log
+'''
+def flush_api_metrics(phase: str):
+    try:
+        with open('batch-init-metrics.log', 'a') as out:
+            api_metrics.flush(out, { 'Function': 'batch-init', 'Phase': phase })
+
+    except Exception as e:
+        logger.warning(f'Unable to write api metrics: {e}')
+
+
 '''
-create a boto client instance.
+create a boto client instance.  every client reports its calls
+to api_metrics
 '''
 def get_client(name: str, region: str = 'us-east-1'):
     if not name in clients:
-        clients[name] = boto3.client(name, config = Config(
+        clients[name] = api_metrics.instrument(boto3.client(name, config = Config(
             region_name = region,
-            retries = { 'max_attempts': 5 }
-        ))
+            retries = { 'max_attempts': 5 },
+            max_pool_connections = 50
+        )))
 
     return clients[name]
 
 
 '''
-get parameters from namespace uses the get_parameters_by_path api
-to request all parameters at once.
+Load every parameter in a namespace.  Follows all pages of
+get_parameters_by_path and keeps a versioned snapshot on disk.  When a
+snapshot exists, only parameter metadata is listed and values are
+fetched (in batches of GetParameters) for names whose version changed.
+'''
+class NamespaceLoader(object):
+
+    SNAPSHOT_FORMAT = 1
+    PAGE_SIZE = 10           # get_parameters_by_path and get_parameters maximum
+    METADATA_PAGE_SIZE = 50  # describe_parameters maximum
+
+    def __init__(self, ssm, namespace: str, snapshot_path: str = 'parameters-snapshot.json'):
+        self.ssm = ssm
+        self.namespace = namespace
+        self.snapshot_path = snapshot_path
+        self.calls = 0
+        self.elapsed = 0.0
+
+    '''
+    return {name: {'Value', 'Version'}} for the namespace, reusing
+    the snapshot where versions have not changed
+    '''
+    def load(self):
+        start = time.perf_counter()
+        snapshot = self.__read_snapshot()
+
+        if snapshot is None:
+            params = self.__get_all_parameters()
+        else:
+            params = self.__refresh_snapshot(snapshot)
+
+        self.__write_snapshot(params)
+        self.elapsed = time.perf_counter() - start
+
+        logger.info(f'Loaded {len(params)} params from {self.namespace} '
+            + f'in {self.calls} calls ({self.elapsed:0.4f} seconds)')
+        return params
+
+    '''
+    page through every parameter value in the namespace
+    '''
+    def __get_all_parameters(self):
+        params = {}
+        request = {
+            'Path': self.namespace,
+            'Recursive': True,
+            'WithDecryption': False,
+            'MaxResults': self.PAGE_SIZE
+        }
+
+        while True:
+            self.calls += 1
+            response = self.ssm.get_parameters_by_path(**request)
+            for p in response['Parameters']:
+                params[p['Name']] = { 'Value': p['Value'], 'Version': p['Version'] }
+
+            if not response.get('NextToken'):
+                return params
+            request['NextToken'] = response['NextToken']
+
+    '''
+    list current versions and fetch values only for new or changed names
+    '''
+    def __refresh_snapshot(self, snapshot: dict):
+        versions = self.__get_parameter_versions()
+        params = {}
+        stale = []
+
+        for name, version in versions.items():
+            cached = snapshot.get(name)
+            if cached and cached['Version'] == version:
+                params[name] = cached
+            else:
+                stale.append(name)
+
+        logger.info(f'Snapshot reused for {len(params)} params, {len(stale)} changed')
+        params.update(self.__get_parameters(stale))
+        return params
+
+    '''
+    page through parameter metadata to get the version of each name
+    '''
+    def __get_parameter_versions(self):
+        versions = {}
+        request = {
+            'ParameterFilters': [{ 'Key': 'Path', 'Option': 'Recursive', 'Values': [self.namespace] }],
+            'MaxResults': self.METADATA_PAGE_SIZE
+        }
+
+        while True:
+            self.calls += 1
+            response = self.ssm.describe_parameters(**request)
+            for p in response['Parameters']:
+                versions[p['Name']] = p['Version']
+
+            if not response.get('NextToken'):
+                return versions
+            request['NextToken'] = response['NextToken']
+
+    '''
+    fetch known names with batched GetParameters calls
+    '''
+    def __get_parameters(self, names: list):
+        params = {}
+        for i in range(0, len(names), self.PAGE_SIZE):
+            self.calls += 1
+            response = self.ssm.get_parameters(
+                Names = names[i:i + self.PAGE_SIZE],
+                WithDecryption = False
+            )
+
+            for p in response['Parameters']:
+                params[p['Name']] = { 'Value': p['Value'], 'Version': p['Version'] }
+
+            if response.get('InvalidParameters'):
+                logger.warning(f'Parameters removed while loading: {response["InvalidParameters"]}')
+
+        return params
+
+    '''
+    read a snapshot written for this namespace, None if unusable
+    '''
+    def __read_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'r') as snapshot_file:
+                snapshot = json.load(snapshot_file)
+
+            if snapshot.get('format') != self.SNAPSHOT_FORMAT or snapshot.get('namespace') != self.namespace:
+                logger.info('Ignoring snapshot written for a different namespace or format')
+                return None
+
+            return snapshot['parameters']
+
+        except FileNotFoundError:
+            return None
+
+        except Exception as e:
+            logger.warning(f'Unable to read parameter snapshot {self.snapshot_path}: {e}')
+            return None
+
+    '''
+    persist the loaded parameters with their versions
+    '''
+    def __write_snapshot(self, params: dict):
+        try:
+            with open(self.snapshot_path, 'w') as snapshot_file:
+                json.dump({
+                    'format': self.SNAPSHOT_FORMAT,
+                    'namespace': self.namespace,
+                    'parameters': params
+                }, snapshot_file)
+
+        except Exception as e:
+            logger.warning(f'Unable to write parameter snapshot {self.snapshot_path}: {e}')
+
+
+'''
+get parameters from namespace.  all pages are requested and a local
+snapshot is reused when parameter versions have not changed.
 '''
 def get_parameters_from_namespace(ssm, namespace: str):
 
     try:
         # get parameters from /some/namespace/path
         logger.info(f'Querying parameters in {namespace} namespace...')
-        response = ssm.get_parameters_by_path(
-            Path = namespace,
-            Recursive = True,
-            WithDecryption = False
-        )
+        loaded = NamespaceLoader(ssm, namespace).load()
 
     except Exception as e:
         logger.error(f'An error occurred querying parameters in the namespace {namespace}: {e}')
@@ -59,9 +370,9 @@ def get_parameters_from_namespace(ssm, namespace: str):
     nmspce_to_remove = namespace if namespace[-1:] == '/' else namespace + '/'
 
     params = {}
-    for p in response['Parameters']:
+    for name, p in loaded.items():
         # remove the namespace that was added
-        name_only = p['Name'].replace(nmspce_to_remove, '')
+        name_only = name.replace(nmspce_to_remove, '')
         logger.debug('Retrieved {} parameter'.format(name_only))
         params[name_only] = p['Value']
 
@@ -70,7 +381,7 @@ def get_parameters_from_namespace(ssm, namespace: str):
     if not 'event-data' in params.keys():
         raise Exception(f'event-data parameter is missing in namespace {namespace}')
 
-    logger.info('Get_parameters_by_path returned {} params'.format(len(params)))
+    logger.info('Namespace query returned {} params'.format(len(params)))
     return params
 
 
@@ -91,50 +402,434 @@ def create_properties_file(params: dict):
 
 
 '''
-get objects from S3
+transfer settings for each object download.  large objects are
+fetched in ranged parts by several threads
 '''
-def download_s3_resources(s3, params: dict):
-    for k,v in params.items():
-        if v.startswith('s3://'):
+def get_transfer_config():
+    mb = 1024 * 1024
+    return TransferConfig(
+        multipart_threshold = int(os.getenv('S3_CHUNK_SIZE_MB', 8)) * mb,
+        multipart_chunksize = int(os.getenv('S3_CHUNK_SIZE_MB', 8)) * mb,
+        max_concurrency = int(os.getenv('S3_OBJECT_CONCURRENCY', 10))
+    )
+
+
+'''
+a local copy is current when its size matches and the etag recorded
+next to it at download time matches the object.  a decompressed copy
+has no size to compare, pass None
+'''
+def is_local_copy_current(filename: str, size: int, etag: str):
+    try:
+        if size is not None and os.path.getsize(filename) != size:
+            return False
+
+        with open(f'{filename}.etag', 'r') as etag_file:
+            return etag_file.read().strip() == etag
+
+    except OSError:
+        return False
+
+
+'''
+event-data compression, from the content-encoding param or the
+file extension.  the decompressed file drops the extension
+'''
+COMPRESSED_EXTENSIONS = { '.gz': 'gzip', '.bz2': 'bzip2', '.zst': 'zstd' }
+
+
+def get_compression(params: dict):
+    encoding = params.get('content-encoding')
+    if encoding:
+        return None if encoding in ('none', 'identity') else encoding
+
+    extension = os.path.splitext(params.get('event-data', ''))[1]
+    return COMPRESSED_EXTENSIONS.get(extension)
+
+
+def get_local_filename(resource: str, encoding: str = None):
+    filename = get_download_attributes(resource)[2]
+    root, extension = os.path.splitext(filename)
+    return root if encoding and COMPRESSED_EXTENSIONS.get(extension) == encoding else filename
+
+
+'''
+Incremental decompression of gzip, bzip2 or zstd chunks.  Output is
+produced in pieces of at most MAX_OUTPUT bytes so memory stays bounded
+whatever the ratio, and concatenated streams (multi-member gzip,
+pbzip2, multi-frame zstd) are followed to the end.  zstd needs the
+zstandard package.
+'''
+class Decompressor(object):
+
+    MAX_OUTPUT = 4 * 1024 * 1024
+
+    def __init__(self, encoding: str):
+        if not encoding in ('gzip', 'bzip2', 'zstd'):
+            raise Exception(f'Unsupported content-encoding {encoding}.')
+
+        self.encoding = encoding
+
+    '''
+    yield the decompressed pieces of an iterable of compressed chunks.
+    fails on truncated gzip or bzip2 input
+    '''
+    def stream(self, chunks):
+        if self.encoding == 'zstd':
+            return self.__stream_zstd(chunks)
+        return self.__stream_incremental(chunks)
+
+    def __new_stream(self):
+        if self.encoding == 'gzip':
+            return zlib.decompressobj(zlib.MAX_WBITS | 16)
+        return bz2.BZ2Decompressor()
+
+    def __stream_incremental(self, chunks):
+        stream, ended = None, False
+        for data in chunks:
+            while data:
+                if stream is None:
+                    stream, ended = self.__new_stream(), False
+
+                yield stream.decompress(data, self.MAX_OUTPUT)
+                data = stream.unconsumed_tail if self.encoding == 'gzip' else b''
+
+                # output held back by the limit is drained before more
+                # input is read or the stream is judged truncated
+                if not data:
+                    yield from self.__drain(stream)
+
+                # the stream ended, anything left starts the next one
+                if stream.eof:
+                    data = stream.unused_data + data
+                    stream, ended = None, True
+
+        if stream is not None and not ended:
+            raise Exception(f'Truncated {self.encoding} event-data.')
+
+    def __drain(self, stream):
+        while not stream.eof:
+            piece = stream.decompress(b'', self.MAX_OUTPUT)
+            if not piece:
+                return
+            yield piece
+
+    # the zstd decompressobj has no output limit, its stream_reader pulls
+    # input as needed and reads at most MAX_OUTPUT at a time
+    def __stream_zstd(self, chunks):
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('zstd event-data needs the zstandard package on the instance.')
+
+        reader = zstandard.ZstdDecompressor().stream_reader(ChunkReader(chunks), read_across_frames = True)
+        with reader:
+            while True:
+                piece = reader.read(self.MAX_OUTPUT)
+                if not piece:
+                    return
+                yield piece
+
+
+'''
+a read()-able view of an iterable of byte chunks
+'''
+class ChunkReader(object):
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = b''
+
+    def read(self, size: int = -1):
+        while not self.pending:
+            self.pending = next(self.chunks, None)
+            if self.pending is None:
+                self.pending = b''
+                return b''
+
+        if size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+'''
+write a compressed object to local_path decompressed, chunk by chunk.
+returns the compressed and raw byte counts
+'''
+def download_decompressed(s3, bucket: str, key: str, local_path: str, encoding: str):
+    decompressor = Decompressor(encoding)
+    compressed, raw = 0, 0
+
+    def count(chunks):
+        nonlocal compressed
+        for chunk in chunks:
+            compressed += len(chunk)
+            yield chunk
+
+    # written aside and renamed, local_path may be linked to a cache entry
+    body = s3.get_object(Bucket = bucket, Key = key)['Body']
+    with open(f'{local_path}.part', 'wb') as out:
+        for piece in decompressor.stream(count(body.iter_chunks(1024 * 1024))):
+            out.write(piece)
+            raw += len(piece)
+
+    os.replace(f'{local_path}.part', local_path)
+    return compressed, raw
 
-            try:
-                logger.info(f'Collecting S3 resource {v} from {k} param')
-                
-                # get s3 attributes from resource path
-                bucket, key, filename = get_download_attributes(v)
 
-                # download the current directory of execution
-                logger.debug(f'Downloading S3 object: {bucket}, {key}, {filename}')
-                s3.download_file(bucket, key, f'./{filename}')
+'''
+log compressed and raw throughput of a decompressing transfer
+'''
+def log_decompressed_throughput(action: str, resource: str, compressed: int, raw: int, elapsed: float):
+    mb = lambda count: count / (1024 * 1024) / elapsed if elapsed > 0 else 0
+    ratio = raw / compressed if compressed else 0
+    logger.info(f'{action} {resource}: {compressed} compressed, {raw} raw bytes in {elapsed:0.4f} seconds '
+        + f'({mb(compressed):0.2f} MB/s compressed, {mb(raw):0.2f} MB/s raw, ratio {ratio:0.1f})')
+
+
+'''
+Content-addressed cache of downloaded objects shared by every job on
+the instance.  An entry is named by the object ETag and size (and the
+decompression applied), so the same content under any key is stored
+once.  Hits are hard-linked into the working directory; entries are
+touched on use and the least recently used are evicted above max_bytes.
+The processor must not modify its inputs in place.
+'''
+class ArtifactCache(object):
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok = True)
+
+    def entry_path(self, etag: str, size: int, encoding: str = None):
+        name = hashlib.sha256(f'{etag.strip(chr(34))}:{size}:{encoding or ""}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name)
+
+    '''
+    link a cached copy to local_path.  False on a miss
+    '''
+    def fetch(self, etag: str, size: int, encoding: str, local_path: str):
+        entry = self.entry_path(etag, size, encoding)
+        with self.lock:
+            if not os.path.exists(entry):
+                return False
+
+            os.utime(entry)
+            link_or_copy(entry, local_path)
+            return True
+
+    '''
+    add a downloaded file and evict down to the size cap
+    '''
+    def store(self, etag: str, size: int, encoding: str, local_path: str):
+        entry = self.entry_path(etag, size, encoding)
+        with self.lock:
+            if not os.path.exists(entry):
+                link_or_copy(local_path, f'{entry}.tmp')
+                os.replace(f'{entry}.tmp', entry)
+            self.__evict(keep = entry)
+
+    def __evict(self, keep: str):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+
+            os.remove(path)
+            total -= size
+            logger.info(f'Evicted {path} from the artifact cache ({size} bytes)')
+
+
+'''
+hard link source to target, replacing target.  copies when the two
+are on different filesystems
+'''
+def link_or_copy(source: str, target: str):
+    if os.path.exists(target):
+        os.remove(target)
+
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+artifact_cache = None
+artifact_cache_lock = threading.Lock()
+
+
+'''
+the instance artifact cache, None when ARTIFACT_CACHE is off.  the
+cache lives in ARTIFACT_CACHE (default ./artifact-cache), capped at
+ARTIFACT_CACHE_MB (default 2048)
+'''
+def get_artifact_cache():
+    global artifact_cache
+
+    directory = os.getenv('ARTIFACT_CACHE', 'artifact-cache')
+    if directory == 'off':
+        return None
+
+    with artifact_cache_lock:
+        if artifact_cache is None:
+            artifact_cache = ArtifactCache(directory, int(os.getenv('ARTIFACT_CACHE_MB', 2048)) * 1024 * 1024)
+
+    return artifact_cache
+
+
+'''
+record the ETag of a downloaded local copy next to it
+'''
+def write_etag(local_path: str, etag: str):
+    with open(f'{local_path}.etag', 'w') as etag_file:
+        etag_file.write(etag)
+
+
+'''
+download a single S3 resource, skipping it if already present.
+returns the number of bytes transferred
+'''
+def download_s3_resource(s3, resource: str, transfer_config: TransferConfig, encoding: str = None):
+    # get s3 attributes from resource path
+    bucket, key, filename = get_download_attributes(resource)
+    local_path = f'./{get_local_filename(resource, encoding)}'
+
+    head = s3.head_object(Bucket = bucket, Key = key)
+    size, etag = head['ContentLength'], head['ETag']
+    if is_local_copy_current(local_path, None if encoding else size, etag):
+        logger.info(f'Skipping {resource}, local copy is current ({etag})')
+        return 0
+
+    # the same content may have been fetched by an earlier job
+    cache = get_artifact_cache()
+    if cache and cache.fetch(etag, size, encoding, local_path):
+        write_etag(local_path, etag)
+        logger.info(f'Linked {resource} from the artifact cache ({etag})')
+        return 0
+
+    # a compressed object is decompressed as it arrives
+    if encoding:
+        start = time.perf_counter()
+        compressed, raw = download_decompressed(s3, bucket, key, local_path, encoding)
+        log_decompressed_throughput('Downloaded', resource, compressed, raw, time.perf_counter() - start)
+
+        write_etag(local_path, etag)
+        if cache:
+            cache.store(etag, size, encoding, local_path)
+        return compressed
+
+    # download the current directory of execution
+    logger.debug(f'Downloading S3 object: {bucket}, {key}, {filename}')
+    start = time.perf_counter()
+    s3.download_file(bucket, key, local_path, Config = transfer_config)
+    elapsed = time.perf_counter() - start
+
+    write_etag(local_path, etag)
+    if cache:
+        cache.store(etag, size, encoding, local_path)
+
+    throughput = size / (1024 * 1024) / elapsed if elapsed > 0 else 0
+    logger.info(f'Downloaded {resource}: {size} bytes in {elapsed:0.4f} seconds ({throughput:0.2f} MB/s)')
+    return size
+
+
+'''
+get objects from S3.  every s3:// parameter is downloaded concurrently,
+except the params named in skip.  encodings names the params to
+decompress while downloading.  every resource is required, any failed
+download raises once the others have finished
+'''
+def download_s3_resources(s3, params: dict, skip: list = None, encodings: dict = None):
+    skip, encodings = skip or [], encodings or {}
+    resources = { k: v for k, v in params.items() if v.startswith('s3://') and not k in skip }
+    if not resources:
+        return
+
+    transfer_config = get_transfer_config()
+    max_workers = int(os.getenv('S3_DOWNLOAD_WORKERS', 4))
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        futures = {}
+        for k, v in resources.items():
+            logger.info(f'Collecting S3 resource {v} from {k} param')
+            futures[executor.submit(download_s3_resource, s3, v, transfer_config, encodings.get(k))] = v
+
+        failed = []
+        for future in as_completed(futures):
+            try:
+                future.result()
 
             except Exception as e:
-                logger.error('An error occurred downloading {}: {}'.format(v, str(e)))
+                logger.error('An error occurred downloading {}: {}'.format(futures[future], str(e)))
+                failed.append(futures[future])
+
+    if failed:
+        raise Exception(f"{len(failed)} of {len(resources)} S3 resources failed to download: {', '.join(sorted(failed))}")
+
+
+'''
+namespace parameters consumed by batch-init and never passed
+to the batch-processor
+'''
+BATCH_INIT_PARAMS = [
+    'event-resource',
+    'datafile-path',
+    'email',
+    'batch-init-start',
+    'stream-input',
+    'shards',
+    'shard-plan',
+    'instance-type',
+    'notify-topic',
+    'content-encoding',
+    'launcher',
+    'jvm-options'
+]
+
+
+'''
+a command or argument list as one shell-quoted string, for logs
+and notifications
+'''
+def quote_command(args: list):
+    return ' '.join(shlex.quote(a) for a in args)
 
 
 '''
 get commandline options for launching the application
-from this script
+from this script, one list item per argument.  datafile_path
+replaces the downloaded event-data
 '''
-def get_commandline_args(params: dict):
+def get_commandline_args(params: dict, datafile_path: str = None):
     cmdline_args = []
     
     # exclude event-resource and change event-data
     for k,v in params.items():
 
         # ignore the jar and the input param to replace
-        if k in ['event-resource', 'datafile-path', 'email']:
+        if k in BATCH_INIT_PARAMS or k.startswith('batch-init-start-shard'):
             continue
 
         # change the event-data to what the batch-processor
-        # would require as an input file
+        # would require as an input file, or the stream to read
         if k == 'event-data':
-            attrs = get_download_attributes(v)
-            cmdline_args.append('--datafile-path=./{}'.format(attrs[2]))
+            filename = get_local_filename(v, get_compression(params))
+            cmdline_args.append('--datafile-path={}'.format(datafile_path or f'./{filename}'))
         else:
             cmdline_args.append(f'--{k}={v}')
 
-    cmdline_args = ' '.join(cmdline_args)
-    logger.info(f'Generated commandline arguments to append: {cmdline_args}')
+    logger.info(f'Generated commandline arguments to append: {quote_command(cmdline_args)}')
     return cmdline_args
 
 
@@ -164,6 +859,42 @@ def get_instance_namespace():
     except Exception as e:
         logger.error(f'An error occurred reading the namespace file: {e}')
 
+'''
+get the shard-plan index given to a fan-out instance at launch, None
+when the instance processes the whole event-data
+'''
+def get_instance_shard(shard_path: str = 'shard'):
+    if not os.path.exists(shard_path):
+        return None
+
+    with open(shard_path, 'r') as shardfile:
+        return int(shardfile.readline().rstrip('\n').split('=')[1])
+
+'''
+log the userdata boot timeline written at launch.  each line is
+"<epoch> <uptime> <phase>" after the first "profile=" line
+'''
+def log_boot_timeline(timeline_path: str = 'boot-timeline'):
+    try:
+        with open(timeline_path, 'r') as timeline:
+            lines = timeline.read().splitlines()
+
+        profile = lines[0].split('=')[1]
+        previous = None
+        for line in lines[1:]:
+            epoch, uptime, phase = line.split(' ', 2)
+            delta = 0.0 if previous is None else float(epoch) - previous
+            previous = float(epoch)
+            logger.info(f'Boot phase {phase} ({profile}): uptime {float(uptime):0.2f}s, took {delta:0.2f}s')
+
+        with open('/proc/uptime', 'r') as proc_uptime:
+            uptime_now = float(proc_uptime.read().split()[0])
+        logger.info(f'Boot to batch-init ({profile}): {uptime_now:0.2f} seconds')
+
+    except Exception as e:
+        logger.warning(f'Unable to read boot timeline: {e}')
+
+
 '''
 get the region the instance is deployed in.  used
 in configuring the boto3 client(s)
@@ -179,203 +910,1346 @@ def get_instance_region():
 
 
 '''
-launch the java application to process data
-'''
-def launch_process(app_name: str, cmdline_args: str):
-    # execute the process and ensure a zero return code
-    subprocess_exc = ['java', '-jar', app_name, cmdline_args]
-
-    logger.info(f'** Launching {app_name}...')
-    logger.info('** Executing {}'.format(' '.join(subprocess_exc)))
-    process = subprocess.run(subprocess_exc)
-    process.check_returncode()
-
-
-'''
-get the application name from the event-resource.  it is created
-when the lambda function is triggered.
+Stream an S3 object into the batch-processor instead of downloading it
+first.  The GetObject body is written to a named pipe (fifo) the
+processor opens as its datafile, or to the processor's stdin, so
+processing overlaps the transfer and nothing is stored on disk.
 '''
-def name_from_event_resource(params: dict):
-    if not 'event-resource' in params.keys():
-        raise Exception('The event-resource key is required for processing.')
-
-    last_delim = params['event-resource'].rfind('/')
-    return params['event-resource'][last_delim + 1:]
-
+class S3InputStream(object):
 
-'''
-Orchestrate mailing through this class
-'''
-class BatchInitMailer(object):
+    CHUNK_SIZE = 1024 * 1024
 
-    def __init__(self, namespace: str):
-        logger.info('Initializing Mailer')
-        self.namespace = namespace
+    def __init__(self, s3, resource: str, mode: str = 'fifo', encoding: str = None):
+        if not mode in ('fifo', 'stdin'):
+            raise Exception(f'Unsupported stream-input mode {mode}.')
 
-        # get the default no-reply email; dest can be a list
-        self.src_email = self.__get_param_value('no-reply-email')
-        dest_email = self.__get_param_value(f'{namespace}/email')
-        
-        # enable mailing if both parameters were populated
-        self.mail_enabled = self.src_email and dest_email
-        if not self.mail_enabled:
-            logger.info('Mailing disabled.  Both src and destination '
-                + 'email parameters must be configured''')
-        else: # split if enabled, destination can be a list
-            self.dest_email = dest_email.split(',')
-
-    '''
-    Assemble an HTML body with a link to the SSM parameters that
-    produced the commandline arguments
-    '''
-    def __get_html_body(self, curr_time: str, namespace: str, app_name: str, cmdline_args: str):
-        # assemble a link to the parameter store entries
-        region = 'us-east-1'
-        ssm_link_url = ''.join([
-            f'https://console.aws.amazon.com/systems-manager/parameters/?region={region}',
-            '&tab=Table#list_parameter_filters=Path:Recursive:{}'.format(quote_plus(namespace))
-        ])
+        self.s3 = s3
+        self.resource = resource
+        self.mode = mode
+        self.encoding = encoding
+        self.bytes = 0
+        self.raw_bytes = 0
+        self.error = None
+        self.thread = None
 
-        return ''.join([
-            f'<h3>Batch Processing Started <small>{curr_time}</small></h3>',
-            '<ul>',
-                f"<li>Namespace: <a href='{ssm_link_url}'>{namespace}</a></li>",
-                f'<li>Application: {app_name}</li>',
-                f'<li>Commandline Args: {cmdline_args}</li>'
-            '</ul>'
-        ])
+        bucket, key, filename = get_download_attributes(resource)
+        self.bucket, self.key = bucket, key
+        self.fifo_path = f'./{filename}.fifo'
 
     '''
-    Assemble the Text body
+    the path passed to the processor as --datafile-path
     '''
-    def __get_text_body(self, curr_time: str, namespace: str, app_name: str, cmdline_args: str):
-        return '\n'.join([
-            f'Batch Processing Started: {curr_time}',
-                f'\t- Namespace: {namespace}',
-                f'\t- Application: {app_name}',
-                f'\t- Commandline Args: {cmdline_args}'
-        ])
+    @property
+    def datafile_path(self):
+        return self.fifo_path if self.mode == 'fifo' else '/dev/stdin'
 
     '''
-    Get a parameter value or return None
+    create the fifo before the process is launched, so it exists when
+    the processor opens --datafile-path
     '''
-    def __get_param_value(self, param_name: str):
-        try:
-            logger.info(f'Querying SSM parameter {param_name}')
-
-            ssm = get_client('ssm')
-            response = ssm.get_parameter(
-                Name = param_name,
-                WithDecryption = False
-            )
-
-            logger.debug(f'Query response: {response}')
-            return response['Parameter']['Value']
-        
-        except Exception as e:
-            logger.error(f'An error occurred querying parameter store: {e}')
-            return None
+    def prepare(self):
+        if self.mode == 'fifo':
+            if os.path.exists(self.fifo_path):
+                os.remove(self.fifo_path)
+            os.mkfifo(self.fifo_path)
 
     '''
-    Send an email to signal the start of processing
+    start the writer for a launched process
     '''
-    def send_start(self, app_name: str, cmdline_args: str):
-        if not self.mail_enabled:
-            return
+    def start(self, process):
+        if self.mode == 'fifo':
+            opener = lambda: open(self.fifo_path, 'wb')
+        else:
+            opener = lambda: process.stdin
 
-        # get the current time and setup link
-        curr_time = datetime.datetime.utcnow().isoformat()
+        self.thread = threading.Thread(target = self.__write, args = (opener,), daemon = True)
+        self.thread.start()
 
+    def __write(self, opener):
+        start = time.perf_counter()
         try:
-            ses = get_client('ses', region)
-            response = ses.send_email(
-                Source = self.src_email,
-                Destination = { 'ToAddresses': self.dest_email },
-                Message = {
-                    'Subject': { 'Data': f'Batch Processing {app_name}' },
-                    'Body': {
-                        'Text': { 'Data': self.__get_text_body(curr_time, self.namespace, app_name, cmdline_args), },
-                        'Html': { 'Data': self.__get_html_body(curr_time, self.namespace, app_name, cmdline_args) }
-                    }
-                }
-            )
+            logger.info(f'Streaming {self.resource} to {self.datafile_path}')
+
+            # opening a fifo blocks until the processor opens it to read.
+            # open first so a failed request can never leave it waiting
+            decompressor = Decompressor(self.encoding) if self.encoding else None
+            with opener() as out:
+                body = self.s3.get_object(Bucket = self.bucket, Key = self.key)['Body']
+                chunks = self.__count(body.iter_chunks(self.CHUNK_SIZE))
+                for piece in (decompressor.stream(chunks) if decompressor else chunks):
+                    out.write(piece)
+                    self.raw_bytes += len(piece)
+
+            elapsed = time.perf_counter() - start
+            if decompressor:
+                log_decompressed_throughput('Streamed', self.resource, self.bytes, self.raw_bytes, elapsed)
+            else:
+                throughput = self.bytes / (1024 * 1024) / elapsed if elapsed > 0 else 0
+                logger.info(f'Streamed {self.bytes} bytes in {elapsed:0.4f} seconds ({throughput:0.2f} MB/s)')
 
-            logger.info(f'SendMail response {response}')
-        
         except Exception as e:
-            logger.error(f'An error occurred sending start email: {e}')
+            self.error = e
+
+    def __count(self, chunks):
+        for chunk in chunks:
+            self.bytes += len(chunk)
+            yield chunk
 
     '''
-    Send an email to signal the end of processing
+    wait for the writer after the process exited.  a writer still
+    waiting for the fifo to be opened is released.  fails if the stream
+    was incomplete so truncated input never passes as a success
     '''
-    def send_complete(self, app_name: str, duration: float):
-        if not self.mail_enabled:
-            return
-        
-        try:
-            ses = get_client('ses', region)
-            response = ses.send_email(
-                Source = self.src_email,
-                Destination = { 'ToAddresses': self.dest_email },
-                Message = {
-                    'Subject': { 'Data': f'Batch Processing {app_name}' },
-                    'Body': {
-                        'Text': { 'Data': f'Batch Processing Completed in {duration:0.4f} seconds' },
-                        'Html': { 'Data': f'<h3>Batch Processing Completed <small>in {duration:0.4f} seconds</small></h3>' }
-                    }
-                }
-            )
+    def finish(self, timeout: float = 30.0):
+        if self.mode == 'fifo' and self.thread and self.thread.is_alive():
+            try:
+                os.close(os.open(self.fifo_path, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
 
-            logger.info(f'SendMail response {response}')
+        if self.thread:
+            self.thread.join(timeout)
+        if self.mode == 'fifo' and os.path.exists(self.fifo_path):
+            os.remove(self.fifo_path)
 
-        except Exception as e:
-            logger.error(f'An error occurred sending completion email: {e}')
+        if self.error:
+            raise Exception(f'Streaming {self.resource} failed after {self.bytes} bytes: {self.error}')
 
 
 '''
-1. pull ssm parameter
-2. pull s3 object resources
-3. create commandline argument string
-4. create configuration file
-5. start the batch-processor
+Line-aligned byte range shards of a headerless CSV object in S3.  An
+offset is aligned by moving it just past the first newline at or after
+offset - 1, found with small ranged GETs, so a line always belongs to
+the shard its first byte falls in.  Workers given the same raw offsets
+align them to the same boundaries.
 '''
-if __name__ == '__main__':
+class S3Shards(object):
+
+    PROBE_SIZE = 64 * 1024
+
+    def __init__(self, s3, resource: str):
+        self.s3 = s3
+        self.resource = resource
+        self.bucket, self.key, self.filename = get_download_attributes(resource)
+        self.size = s3.head_object(Bucket = self.bucket, Key = self.key)['ContentLength']
+
+    '''
+    the first line boundary at or after offset
+    '''
+    def align(self, offset: int):
+        if offset <= 0 or offset >= self.size:
+            return min(max(offset, 0), self.size)
+
+        position = offset - 1
+        probe_size = self.PROBE_SIZE
+        while position < self.size:
+            end = min(position + probe_size, self.size) - 1
+            data = self.s3.get_object(Bucket = self.bucket, Key = self.key,
+                Range = f'bytes={position}-{end}')['Body'].read()
+
+            newline = data.find(b'\n')
+            if newline >= 0:
+                return position + newline + 1
+
+            position = end + 1
+            probe_size *= 2
+
+        return self.size
+
+    '''
+    split the object, or the byte range start to end, into count aligned
+    (start, end) ranges, end exclusive.  shards that align to nothing
+    are dropped
+    '''
+    def plan(self, count: int, start: int = 0, end: int = None):
+        end = self.size if end is None else end
+        raw = [start + (end - start) * i // count for i in range(count + 1)]
+        bounds = [self.align(offset) for offset in raw]
+        return [(bounds[i], bounds[i + 1]) for i in range(count) if bounds[i] < bounds[i + 1]]
+
+    '''
+    download one shard with a ranged GET, returns the local path
+    '''
+    def download(self, index: int, start: int, end: int):
+        path = f'./{self.filename}.shard{index}'
+        began = time.perf_counter()
+        body = self.s3.get_object(Bucket = self.bucket, Key = self.key,
+            Range = f'bytes={start}-{end - 1}')['Body']
+
+        with open(path, 'wb') as out:
+            for chunk in body.iter_chunks(1024 * 1024):
+                out.write(chunk)
+
+        elapsed = time.perf_counter() - began
+        logger.info(f'Downloaded shard {index} ({end - start} bytes) in {elapsed:0.4f} seconds')
+        return path
+
+    '''
+    download every shard concurrently, returns the paths in shard order
+    '''
+    def download_all(self, shards: list):
+        with ThreadPoolExecutor(max_workers = int(os.getenv('S3_DOWNLOAD_WORKERS', 4))) as executor:
+            futures = [executor.submit(self.download, i, start, end) for i, (start, end) in enumerate(shards)]
+            return [future.result() for future in futures]
+
+
+'''
+the shards and their aligned ranges for this job, None when sharding
+is off.  the shards param (or SHARDS) is a count or "auto" for the core
+count, the default; shards smaller than SHARD_MIN_MB are not worth a JVM.  a fan-out
+instance only shards its own range of the shard-plan written by the
+lambda, and always takes the sharded path
+'''
+def get_shards(s3, params: dict, shard_index: int = None):
+    # one shard per core by default, a streamed event-data is not split
+    # unless shards is set
+    streamed = params.get('stream-input', os.getenv('STREAM_INPUT', '')) not in ('', 'off')
+    setting = params.get('shards', os.getenv('SHARDS', '1' if streamed else 'auto'))
+    count = (os.cpu_count() or 1) if setting == 'auto' else int(setting)
+    fan_out = shard_index is not None and 'shard-plan' in params
+    if count <= 1 and not fan_out:
+        return None
+
+    # compressed data has no line boundaries to seek to.  it is processed
+    # whole, by the first fan-out instance only
+    if get_compression(params):
+        if fan_out and shard_index > 0:
+            logger.warning(f'Compressed event-data is not split, shard {shard_index} has nothing to process')
+            return None, []
+
+        logger.info('Compressed event-data is processed whole')
+        return None
+
+    shards = S3Shards(s3, params['event-data'])
+    start, end = 0, shards.size
+    if fan_out:
+        start, end = json.loads(params['shard-plan'])['ranges'][shard_index]
+
+    min_bytes = int(os.getenv('SHARD_MIN_MB', 16)) * 1024 * 1024
+    count = max(1, min(count, (end - start) // min_bytes + 1))
+    if count <= 1 and not fan_out:
+        return None
+
+    logger.info(f'Processing {shards.resource} bytes {start}-{end} of {shards.size} in {count} shard(s)')
+    return shards, shards.plan(count, start, end)
+
+
+'''
+run one processor per shard and wait for all of them.  exit codes and
+timings are logged per shard; any failure fails the job with every
+exit code
+'''
+def launch_sharded_processes(app_name: str, params: dict, shard_paths: list, profile = None, jvm = None):
+    processes = []
+    for i, path in enumerate(shard_paths):
+        # the shards share the instance, only the first one builds the class archive
+        args = get_commandline_args(params, path)
+        subprocess_exc = jvm.command(app_name, args, len(shard_paths), i == 0) if jvm else ['java', '-jar', app_name] + args
+        logger.info(f'** Launching shard {i}: {quote_command(subprocess_exc)}')
+        process = subprocess.Popen(subprocess_exc, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        readers = stream_output(process, f'shard{i}')
+        finish = profile.track_process(f'shard{i}', process) if profile else None
+        processes.append((process, time.perf_counter(), finish, readers))
+
+    results = []
+    for i, (process, began, finish, readers) in enumerate(processes):
+        returncode = process.wait()
+        for reader in readers:
+            reader.join()
+        if finish:
+            finish()
+        if jvm and i == 0:
+            jvm.finish(app_name, returncode)
+        elapsed = time.perf_counter() - began
+        logger.info(f'Shard {i} exited {returncode} after {elapsed:0.4f} seconds')
+        results.append({ 'shard': i, 'returncode': returncode, 'seconds': elapsed })
+
+    failed = [r for r in results if r['returncode'] != 0]
+    if failed:
+        codes = ', '.join(f"shard {r['shard']}={r['returncode']}" for r in failed)
+        raise Exception(f'{len(failed)} of {len(results)} shards failed: {codes}')
+
+    return results
+
+
+'''
+the input stream for the event-data, None to download it first.
+enabled per namespace with the stream-input param (fifo or stdin)
+or the STREAM_INPUT environment variable
+'''
+def get_input_stream(s3, params: dict):
+    mode = params.get('stream-input', os.getenv('STREAM_INPUT', ''))
+    if not mode or mode == 'off':
+        return None
+
+    return S3InputStream(s3, params['event-data'], mode, get_compression(params))
+
+
+'''
+Sample a running process from /proc every interval seconds: cpu time
+and utilization, resident memory and bytes read and written.  Stops
+when the process exits or stop() is called.
+'''
+class ProcessSampler(object):
+
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+    def __init__(self, pid: int, interval: float = 5.0):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self.__run, name = f'sampler-{pid}', daemon = True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __run(self):
+        began = time.perf_counter()
+        previous = None
+        while True:
+            try:
+                sample = self.__read()
+            except (OSError, ValueError, IndexError):
+                return
+
+            sample['t'] = round(time.perf_counter() - began, 3)
+            if previous and sample['t'] > previous['t']:
+                cpu = sample['cpu_seconds'] - previous['cpu_seconds']
+                sample['cpu_pct'] = round(cpu / (sample['t'] - previous['t']) * 100, 1)
+            self.samples.append(sample)
+            previous = sample
+
+            if self.stopped.wait(self.interval):
+                return
+
+    def __read(self):
+        with open(f'/proc/{self.pid}/stat', 'r') as stat:
+            fields = stat.read().rpartition(')')[2].split()
+        sample = { 'cpu_seconds': (int(fields[11]) + int(fields[12])) / self.CLOCK_TICKS, 'cpu_pct': 0.0 }
+
+        with open(f'/proc/{self.pid}/status', 'r') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    sample['rss_kb'] = int(line.split()[1])
+                elif line.startswith('VmHWM:'):
+                    sample['rss_peak_kb'] = int(line.split()[1])
+
+        try:
+            with open(f'/proc/{self.pid}/io', 'r') as io_counters:
+                counters = dict(line.split(': ') for line in io_counters.read().splitlines())
+            sample['read_bytes'] = int(counters['read_bytes'])
+            sample['write_bytes'] = int(counters['write_bytes'])
+        except (OSError, KeyError):
+            pass
+
+        return sample
+
+    '''
+    peak and average resource use over the samples
+    '''
+    def summary(self):
+        if not self.samples:
+            return {}
+
+        last = self.samples[-1]
+        cpu = [s['cpu_pct'] for s in self.samples[1:]]
+        return {
+            'samples': len(self.samples),
+            'cpu_seconds': last['cpu_seconds'],
+            'cpu_pct_avg': round(sum(cpu) / len(cpu), 1) if cpu else 0.0,
+            'cpu_pct_max': max(cpu) if cpu else 0.0,
+            'rss_kb_max': max(max(s.get('rss_kb', 0), s.get('rss_peak_kb', 0)) for s in self.samples),
+            'read_bytes': last.get('read_bytes', 0),
+            'write_bytes': last.get('write_bytes', 0)
+        }
+
+
+'''
+Timeline of a job: every bootstrap step and processor run as a phase
+measured from the job start, plus the /proc samples of each processor.
+Written as json lines next to batch-init.log.  PROFILE_INTERVAL sets
+the sample interval in seconds, 0 turns sampling off.
+'''
+class JobProfile(object):
+
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self.started = time.time()
+        self.origin = time.perf_counter()
+        self.interval = float(os.getenv('PROFILE_INTERVAL', 5))
+        self.phases = []
+        self.samplers = {}
+        self.written = False
+
+    '''
+    add a timed phase.  process marks a processor run, every other
+    phase is part of the bootstrap
+    '''
+    def add_phase(self, name: str, start: float, end: float, process: bool = False):
+        self.phases.append({ 'name': name, 'start': round(start, 4), 'end': round(end, 4),
+            'seconds': round(end - start, 4), 'process': process })
+
+    '''
+    add the finished steps of a bootstrap graph as phases, steps
+    already added are skipped
+    '''
+    def add_steps(self, graph):
+        offset = graph.origin - self.origin
+        added = [p['name'] for p in self.phases]
+        for name, step in graph.steps.items():
+            if step['end'] is not None and not name in added:
+                self.add_phase(name, step['start'] + offset, step['end'] + offset)
+
+    '''
+    time a processor run as phase name and sample it while it runs.
+    returns a callable that ends the phase
+    '''
+    def track_process(self, name: str, process):
+        start = time.perf_counter() - self.origin
+        sampler = ProcessSampler(process.pid, self.interval).start() if self.interval > 0 else None
+        self.samplers[name] = sampler
+
+        def finish():
+            if sampler:
+                sampler.stop()
+            self.add_phase(name, start, time.perf_counter() - self.origin, process = True)
+
+        return finish
+
+    def summary(self):
+        phases = sorted(self.phases, key = lambda p: p['start'])
+        processes = { name: sampler.summary() for name, sampler in self.samplers.items() if sampler }
+        return {
+            'namespace': self.namespace,
+            'started': self.started,
+            'seconds': round(time.perf_counter() - self.origin, 4),
+            'phases': phases,
+            'processes': processes
+        }
+
+    '''
+    append the timeline and the samples to their files, returns the
+    summary
+    '''
+    def write(self, timeline_path: str = 'batch-init-timeline.json', samples_path: str = 'batch-init-samples.json'):
+        summary = self.summary()
+        self.written = True
+        try:
+            with open(timeline_path, 'a') as out:
+                out.write(json.dumps(summary) + '\n')
+
+            with open(samples_path, 'a') as out:
+                for name, sampler in self.samplers.items():
+                    for sample in (sampler.samples if sampler else []):
+                        out.write(json.dumps(dict(sample, process = name, started = self.started)) + '\n')
+
+        except Exception as e:
+            logger.warning(f'Unable to write the job profile: {e}')
+
+        return summary
+
+
+'''
+one line per processor for the completion notification
+'''
+def format_profile(summary: dict):
+    lines = []
+    # the first processor run starts when the bootstrap is done
+    bootstrap = [p for p in summary['phases'] if not p.get('process')]
+    runs = [p for p in summary['phases'] if p.get('process')]
+    if runs:
+        lines.append(f"Bootstrap: {min(p['start'] for p in runs):0.2f} seconds to processor start")
+    elif bootstrap:
+        lines.append(f"Bootstrap: {max(p['end'] for p in bootstrap):0.2f} seconds, no processor started")
+
+    for name, usage in summary['processes'].items():
+        if not usage:
+            continue
+        lines.append(f"{name}: peak RSS {usage['rss_kb_max'] / 1024:0.1f} MB, "
+            + f"CPU {usage['cpu_pct_avg']:0.0f}% average {usage['cpu_pct_max']:0.0f}% peak of {os.cpu_count()} core(s), "
+            + f"read {usage['read_bytes'] / (1024 * 1024):0.1f} MB, written {usage['write_bytes'] / (1024 * 1024):0.1f} MB")
+
+    return lines
+
+
+'''
+log every line the process writes to stdout and stderr as it is
+written.  returns the reader threads, joined once the process exits
+'''
+def stream_output(process, name: str):
+    def pump(pipe, level):
+        with pipe:
+            for line in iter(pipe.readline, b''):
+                logger.log(level, f'[{name}] {line.decode("utf-8", "replace").rstrip()}')
+
+    readers = [threading.Thread(target = pump, args = (process.stdout, logging.INFO), daemon = True),
+        threading.Thread(target = pump, args = (process.stderr, logging.WARNING), daemon = True)]
+    for reader in readers:
+        reader.start()
+
+    return readers
+
+
+'''
+total instance memory in MB from /proc/meminfo
+'''
+def get_memory_mb(meminfo_path: str = '/proc/meminfo'):
+    with open(meminfo_path, 'r') as meminfo:
+        for line in meminfo:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) // 1024
+
+    raise Exception(f'MemTotal not found in {meminfo_path}.')
+
+
+'''
+the java version string and feature release, 8 for 1.8.0_292 and 17
+for 17.0.2.  None when java -version can not be read
+'''
+def get_java_version():
     try:
-        start = time.perf_counter()
-        logger.info('Gathering configuration...')
+        out = subprocess.run(['java', '-version'], capture_output = True, text = True, timeout = 30)
+        version = out.stderr.split('"')[1]
 
-        # namespace should be added via EC2 userdata
-        namespace = get_instance_namespace()
-        logger.info(f'Namespace: {namespace}')
+    except Exception as e:
+        logger.warning(f'Unable to read the java version: {e}')
+        return None, None
 
-        # initialize the client for requests
-        region = get_instance_region()
-        ssm = get_client('ssm', region)
-        s3 = get_client('s3', region)
+    parts = version.split('.')
+    feature = parts[1] if parts[0] == '1' else parts[0]
+    return version, int(''.join(c for c in feature.split('-')[0] if c.isdigit()) or 0)
 
-        # get parameters and application name
-        params = get_parameters_from_namespace(ssm, namespace)
-        app_name = name_from_event_resource(params)
 
-        # save s3 objects to the current directory
-        download_s3_resources(s3, params)
+'''
+sha256 of a file, read in chunks
+'''
+def hash_file(path: str):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as data:
+        for chunk in iter(lambda: data.read(1024 * 1024), b''):
+            digest.update(chunk)
 
-        # create a properties file and cmd args from params
-        create_properties_file(params)
-        cmdline_args = get_commandline_args(params)
+    return digest.hexdigest()
+
+
+'''
+JVM options for the batch-processor.  The heap is a share of the
+instance memory split between the processes that run at once.  GC is
+chosen for short batch runs: serial on a single core or a small heap,
+parallel with one thread per core otherwise.  With java 13 or later
+the first run of a jar writes a dynamic AppCDS archive at exit, later
+runs of the same jar and java version map it instead of loading and
+verifying the classes again.  jvm-options are appended last so they
+override any of these.
+'''
+class JvmProfile(object):
+
+    # below this heap, or with one core, parallel collection does not pay off
+    PARALLEL_GC_MIN_HEAP_MB = 1792
+
+    def __init__(self, memory_mb: int, cores: int, heap_pct: float = 70.0, cds_dir: str = None,
+            java_version: tuple = (None, None), options: list = None):
+        self.memory_mb = memory_mb
+        self.cores = cores
+        self.heap_pct = heap_pct
+        self.cds_dir = cds_dir
+        self.java_version, self.java_feature = java_version
+        self.options = options or []
+        self.archives = {}
+
+    def heap_options(self, processes: int = 1):
+        heap_mb = max(64, int(self.memory_mb * self.heap_pct / 100 / processes))
+        cores = max(1, self.cores // processes)
+
+        if cores < 2 or heap_mb < self.PARALLEL_GC_MIN_HEAP_MB:
+            gc = ['-XX:+UseSerialGC']
+        else:
+            gc = ['-XX:+UseParallelGC', f'-XX:ParallelGCThreads={cores}']
+
+        return [f'-Xms{heap_mb}m', f'-Xmx{heap_mb}m'] + gc + ['-XX:+ExitOnOutOfMemoryError']
+
+    '''
+    the archive path of a jar, None when AppCDS is off or unsupported
+    '''
+    def get_archive(self, app_name: str):
+        if not self.cds_dir or not self.java_feature or self.java_feature < 13:
+            return None
+
+        if not app_name in self.archives:
+            key = hashlib.sha256(f'{hash_file(app_name)}:{self.java_version}'.encode('utf-8')).hexdigest()
+            self.archives[app_name] = os.path.join(self.cds_dir, f'{key}.jsa')
+
+        return self.archives[app_name]
+
+    def cds_options(self, app_name: str, dump: bool = True):
+        archive = self.get_archive(app_name)
+        if not archive:
+            return []
+
+        if os.path.exists(archive):
+            logger.info(f'Using class data sharing archive {archive}')
+            return [f'-XX:SharedArchiveFile={archive}']
+
+        if not dump:
+            return []
+
+        # written at exit, kept only if the run succeeds
+        os.makedirs(self.cds_dir, exist_ok = True)
+        logger.info(f'Creating class data sharing archive {archive}')
+        return [f'-XX:ArchiveClassesAtExit={archive}.part']
+
+    '''
+    the java command for a jar and its arguments.  processes is the
+    number of JVMs that share the instance, dump allows this one to
+    create the class archive
+    '''
+    def command(self, app_name: str, args: list, processes: int = 1, dump: bool = True):
+        options = self.heap_options(processes) + self.cds_options(app_name, dump) + self.options
+        logger.info(f'JVM options for {processes} process(es) on {self.memory_mb} MB, '
+            + f'{self.cores} core(s), java {self.java_version}: {quote_command(options)}')
+        return ['java'] + options + ['-jar', app_name] + args
+
+    '''
+    keep the archive written by a successful run, drop a partial one
+    '''
+    def finish(self, app_name: str, returncode: int):
+        archive = self.archives.get(app_name)
+        if not archive or not os.path.exists(f'{archive}.part'):
+            return
+
+        if returncode == 0:
+            os.replace(f'{archive}.part', archive)
+            logger.info(f'Saved class data sharing archive {archive}')
+        else:
+            os.remove(f'{archive}.part')
+
+
+'''
+the JVM profile for the instance, None to run java with its defaults.
+JVM_PROFILE=off turns it off, JVM_HEAP_PCT is the share of memory
+for heaps (default 70) and JVM_CDS the archive directory (default
+cds, off to disable).  the namespace jvm-options param adds options
+'''
+def get_jvm_profile(params: dict):
+    if os.getenv('JVM_PROFILE', 'on') == 'off':
+        return None
+
+    cds_dir = os.getenv('JVM_CDS', 'cds')
+    try:
+        return JvmProfile(get_memory_mb(), os.cpu_count() or 1, float(os.getenv('JVM_HEAP_PCT', 70)),
+            None if cds_dir == 'off' else cds_dir, get_java_version(), shlex.split(params.get('jvm-options', '')))
+
+    except Exception as e:
+        logger.warning(f'Unable to build the JVM profile, running java with its defaults: {e}')
+        return None
+
+
+'''
+launch the java application to process data.  an input stream
+writes the event-data to the process while it runs
+'''
+def launch_process(app_name: str, cmdline_args: list, input_stream = None, profile = None, jvm = None):
+    # execute the process and ensure a zero return code
+    subprocess_exc = jvm.command(app_name, cmdline_args) if jvm else ['java', '-jar', app_name] + cmdline_args
+    stdin = subprocess.PIPE if input_stream and input_stream.mode == 'stdin' else None
+
+    # the fifo must exist before the processor can open it
+    if input_stream:
+        input_stream.prepare()
+
+    logger.info(f'** Launching {app_name}...')
+    logger.info(f'** Executing {quote_command(subprocess_exc)}')
+    process = subprocess.Popen(subprocess_exc, stdin = stdin, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+    readers = stream_output(process, 'process')
+    finish = profile.track_process('process', process) if profile else None
+
+    # feed the event-data while the process runs
+    if input_stream:
+        input_stream.start(process)
+
+    returncode = process.wait()
+    for reader in readers:
+        reader.join()
+    if finish:
+        finish()
+    if jvm:
+        jvm.finish(app_name, returncode)
+
+    # a stream broken by the processor exiting must not hide its exit
+    # code, the stream error becomes the cause
+    stream_error = None
+    if input_stream:
+        try:
+            input_stream.finish()
+        except Exception as e:
+            stream_error = e
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, subprocess_exc) from stream_error
+    if stream_error:
+        raise stream_error
+
+
+'''
+get the application name from the event-resource.  it is created
+when the lambda function is triggered.
+'''
+def name_from_event_resource(params: dict):
+    if not 'event-resource' in params.keys():
+        raise Exception('The event-resource key is required for processing.')
+
+    last_delim = params['event-resource'].rfind('/')
+    return params['event-resource'][last_delim + 1:]
+
+
+'''
+notification settings from one batched parameter fetch: the sender
+(no-reply-email), the recipients ({namespace}/email, comma separated)
+and an optional SNS topic ({namespace}/notify-topic)
+'''
+def get_notification_settings(ssm, namespace: str):
+    sep = '/' if not namespace[-1:] == '/' else ''
+    names = { 'no-reply-email': 'sender', f'{namespace}{sep}email': 'recipients',
+        f'{namespace}{sep}notify-topic': 'topic' }
+
+    settings = { 'sender': None, 'recipients': None, 'topic': None }
+    try:
+        response = ssm.get_parameters(Names = list(names.keys()), WithDecryption = False)
+        for param in response['Parameters']:
+            settings[names[param['Name']]] = param['Value']
+
+    except Exception as e:
+        logger.error(f'An error occurred querying notification parameters: {e}')
+
+    return settings
+
+
+'''
+send notifications as SES email
+'''
+class SesSink(object):
+
+    def __init__(self, region: str, sender: str, recipients: list):
+        self.region = region
+        self.sender = sender
+        self.recipients = recipients
+
+    def send(self, message: dict):
+        response = get_client('ses', self.region).send_email(
+            Source = self.sender,
+            Destination = { 'ToAddresses': self.recipients },
+            Message = {
+                'Subject': { 'Data': message['subject'] },
+                'Body': {
+                    'Text': { 'Data': message['text'] },
+                    'Html': { 'Data': message['html'] }
+                }
+            }
+        )
+        logger.info(f'SendMail response {response}')
+
+
+'''
+publish notifications to an SNS topic
+'''
+class SnsSink(object):
+
+    def __init__(self, region: str, topic_arn: str):
+        self.region = region
+        self.topic_arn = topic_arn
+
+    def send(self, message: dict):
+        response = get_client('sns', self.region).publish(
+            TopicArn = self.topic_arn,
+            Subject = message['subject'][:100],
+            Message = message['text']
+        )
+        logger.info(f'Publish response {response}')
+
+
+'''
+append notifications to a local file as json lines, for tests
+'''
+class FileSink(object):
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def send(self, message: dict):
+        with open(self.path, 'a') as out:
+            out.write(json.dumps(message) + '\n')
 
-        # initialize mailer for start and stop notifications
-        mailer = BatchInitMailer(namespace)
-        mailer.send_start(app_name, cmdline_args)
 
-        # execute the java process
-        launch_process(app_name, cmdline_args)
+'''
+the sinks for the settings.  SES needs a sender and recipients, SNS a
+topic and NOTIFY_FILE adds the file sink
+'''
+def get_notification_sinks(settings: dict, region: str):
+    sinks = []
+    if settings['sender'] and settings['recipients']:
+        sinks.append(SesSink(region, settings['sender'], settings['recipients'].split(',')))
+    if settings['topic']:
+        sinks.append(SnsSink(region, settings['topic']))
+    if os.getenv('NOTIFY_FILE'):
+        sinks.append(FileSink(os.getenv('NOTIFY_FILE')))
+
+    if not sinks:
+        logger.info('Notifications disabled.  Configure the src and destination '
+            + 'email parameters, a notify-topic or NOTIFY_FILE')
+    return sinks
+
+
+'''
+Deliver notifications from a background queue so a slow SES or SNS
+never holds up processing.  Every sink gets max_attempts tries with
+doubling backoff; flush waits at most timeout for the queue to drain
+and drops what is left.
+'''
+class NotificationDispatcher(object):
+
+    def __init__(self, sinks: list, max_attempts: int = 3, backoff: float = 1.0):
+        self.sinks = sinks
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.queue = queue.Queue()
+        self.sent = 0
+        self.failed = 0
+
+        self.worker = threading.Thread(target = self.__run, name = 'notifications', daemon = True)
+        self.worker.start()
+
+    '''
+    queue a message for every sink, never blocks
+    '''
+    def notify(self, message: dict):
+        if self.sinks:
+            self.queue.put(message)
+
+    '''
+    stop accepting messages and wait up to timeout for delivery.
+    returns True when everything queued was attempted
+    '''
+    def flush(self, timeout: float = 10.0):
+        self.queue.put(None)
+        self.worker.join(timeout)
+
+        drained = not self.worker.is_alive()
+        if not drained:
+            logger.warning(f'Notification flush timed out after {timeout}s, {max(0, self.queue.qsize() - 1)} queued message(s) dropped')
+
+        logger.info(f'Notifications sent: {self.sent}, failed: {self.failed}')
+        return drained
+
+    def __run(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                return
+
+            for sink in self.sinks:
+                self.__send(sink, message)
+
+    def __send(self, sink, message: dict):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                sink.send(message)
+                self.sent += 1
+                return
+
+            except Exception as e:
+                logger.error(f'{type(sink).__name__} attempt {attempt} of {self.max_attempts} failed: {e}')
+                if attempt < self.max_attempts:
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+
+        self.failed += 1
+
+
+'''
+the dispatcher for a job, its sinks built from one batched fetch of
+the notification settings
+'''
+def get_notification_dispatcher(ssm, namespace: str, region: str):
+    sinks = get_notification_sinks(get_notification_settings(ssm, namespace), region)
+    return NotificationDispatcher(sinks, int(os.getenv('NOTIFY_ATTEMPTS', 3)))
+
+
+'''
+the start notification, with a link to the SSM parameters that
+produced the commandline arguments
+'''
+def get_start_message(namespace: str, region: str, app_name: str, cmdline_args: list):
+    cmdline_args = quote_command(cmdline_args)
+    curr_time = datetime.datetime.utcnow().isoformat()
+
+    # assemble a link to the parameter store entries
+    ssm_link_url = ''.join([
+        f'https://console.aws.amazon.com/systems-manager/parameters/?region={region}',
+        '&tab=Table#list_parameter_filters=Path:Recursive:{}'.format(quote_plus(namespace))
+    ])
+
+    return {
+        'subject': f'Batch Processing {app_name}',
+        'text': '\n'.join([
+            f'Batch Processing Started: {curr_time}',
+                f'\t- Namespace: {namespace}',
+                f'\t- Application: {app_name}',
+                f'\t- Commandline Args: {cmdline_args}'
+        ]),
+        'html': ''.join([
+            f'<h3>Batch Processing Started <small>{curr_time}</small></h3>',
+            '<ul>',
+                f"<li>Namespace: <a href='{ssm_link_url}'>{namespace}</a></li>",
+                f'<li>Application: {app_name}</li>',
+                f'<li>Commandline Args: {cmdline_args}</li>'
+            '</ul>'
+        ])
+    }
+
+
+'''
+the completion notification, with the profile summary lines
+'''
+def get_complete_message(app_name: str, duration: float, profile_lines: list = None):
+    profile_lines = profile_lines or []
+    return {
+        'subject': f'Batch Processing {app_name}',
+        'text': '\n'.join([f'Batch Processing Completed in {duration:0.4f} seconds']
+            + [f'\t- {line}' for line in profile_lines]),
+        'html': ''.join([f'<h3>Batch Processing Completed <small>in {duration:0.4f} seconds</small></h3>']
+            + (['<ul>'] + [f'<li>{line}</li>' for line in profile_lines] + ['</ul>'] if profile_lines else []))
+    }
 
-        # take the duration and send completion email
+
+'''
+Worker pool board backed by SSM parameter store.  Layout is shared
+with the lambda (lambda/src/pool.py):
+
+    {pool}/{worker_id}/state       "idle <epoch>", "busy <epoch>" or "leaving <epoch>"
+    {pool}/{worker_id}/assignment  the namespace to process
+'''
+class SsmPoolBoard(object):
+
+    def __init__(self, ssm, pool_path: str):
+        self.ssm = ssm
+        self.pool_path = pool_path.rstrip('/')
+
+    def set_state(self, worker_id: str, state: str):
+        self.ssm.put_parameter(
+            Name = f'{self.pool_path}/{worker_id}/state',
+            Value = f'{state} {time.time()}',
+            Type = 'String',
+            Overwrite = True
+        )
+
+    def get_assignment(self, worker_id: str):
+        try:
+            response = self.ssm.get_parameter(Name = f'{self.pool_path}/{worker_id}/assignment')
+            return response['Parameter']['Value']
+
+        except self.ssm.exceptions.ParameterNotFound:
+            return None
+
+    def release(self, worker_id: str):
+        self.__delete(f'{self.pool_path}/{worker_id}/assignment')
+
+    def deregister(self, worker_id: str):
+        self.__delete(f'{self.pool_path}/{worker_id}/state')
+
+    def __delete(self, name: str):
+        try:
+            self.ssm.delete_parameter(Name = name)
+        except self.ssm.exceptions.ParameterNotFound:
+            pass
+
+
+'''
+local directory stand-in for the pool board, one file per parameter
+'''
+class LocalPoolBoard(object):
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def set_state(self, worker_id: str, state: str):
+        os.makedirs(os.path.join(self.directory, worker_id), exist_ok = True)
+        with open(os.path.join(self.directory, worker_id, 'state'), 'w') as state_file:
+            state_file.write(f'{state} {time.time()}')
+
+    def get_assignment(self, worker_id: str):
+        try:
+            with open(os.path.join(self.directory, worker_id, 'assignment'), 'r') as assignment:
+                return assignment.read()
+        except FileNotFoundError:
+            return None
+
+    def release(self, worker_id: str):
+        self.__delete(os.path.join(self.directory, worker_id, 'assignment'))
+
+    def deregister(self, worker_id: str):
+        self.__delete(os.path.join(self.directory, worker_id, 'state'))
+
+    def __delete(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+'''
+get the pool board for a pool path.  file://{dir} selects the local board
+'''
+def get_pool_board(pool_path: str, region: str):
+    if pool_path.startswith('file://'):
+        return LocalPoolBoard(pool_path[len('file://'):])
+
+    return SsmPoolBoard(get_client('ssm', region), pool_path)
+
+
+'''
+Long-lived pool agent.  Reports idle with a heartbeat, polls for an
+assignment and runs it.  The state stays busy until the assignment is
+released so the lambda never dispatches to a worker mid-job.  After
+idle_timeout seconds without work the agent leaves the pool: it
+reports leaving, which the lambda never dispatches to, and waits
+leave_grace seconds so a dispatch that read the idle state earlier can
+finish its claim before the final assignment check.
+'''
+class PoolAgent(object):
+
+    def __init__(self, board, worker_id: str, poll_interval: float = 5.0,
+            heartbeat_interval: float = 30.0, idle_timeout: float = 900.0, leave_grace: float = 30.0):
+        self.board = board
+        self.worker_id = worker_id
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.leave_grace = leave_grace
+
+    def run(self, run_job):
+        logger.info(f'Joining worker pool as {self.worker_id}')
+        self.board.set_state(self.worker_id, 'idle')
+        idle_since = last_heartbeat = time.monotonic()
+
+        while True:
+            namespace = self.board.get_assignment(self.worker_id)
+            if namespace:
+                self.__run_assignment(run_job, namespace)
+                self.board.set_state(self.worker_id, 'idle')
+                idle_since = last_heartbeat = time.monotonic()
+                continue
+
+            now = time.monotonic()
+            if now - idle_since >= self.idle_timeout:
+                break
+
+            if now - last_heartbeat >= self.heartbeat_interval:
+                self.board.set_state(self.worker_id, 'idle')
+                last_heartbeat = now
+
+            time.sleep(self.poll_interval)
+
+        # stop new dispatches, then pick up an assignment that raced the exit
+        logger.info(f'Idle for {self.idle_timeout} seconds, leaving worker pool')
+        self.board.set_state(self.worker_id, 'leaving')
+        time.sleep(self.leave_grace)
+
+        namespace = self.board.get_assignment(self.worker_id)
+        if namespace:
+            self.__run_assignment(run_job, namespace)
+        self.board.deregister(self.worker_id)
+
+    def __run_assignment(self, run_job, namespace: str):
+        logger.info(f'Received pool assignment {namespace}')
+        self.board.set_state(self.worker_id, 'busy')
+        flush_api_metrics('pool')
+
+        try:
+            run_job(namespace)
+        except Exception as e:
+            logger.error(f'Pool assignment {namespace} encountered an error: {e}')
+        finally:
+            self.board.release(self.worker_id)
+            flush_api_metrics('job')
+
+
+'''
+record when batch-init started processing a namespace.  read by the
+stack tracker (lambda/src/tracker.py), failure only loses the metric.
+every fan-out shard records its own start
+'''
+def get_batch_init_start_name(shard_index: int = None):
+    return 'batch-init-start' if shard_index is None else f'batch-init-start-shard{shard_index}'
+
+
+def put_batch_init_start(ssm, namespace: str, shard_index: int = None):
+    try:
+        sep = '/' if not namespace[-1:] == '/' else ''
+        ssm.put_parameter(
+            Name = f'{namespace}{sep}{get_batch_init_start_name(shard_index)}',
+            Value = str(time.time()),
+            Type = 'String',
+            Overwrite = True
+        )
+
+    except Exception as e:
+        logger.warning(f'Unable to record batch-init start: {e}')
+
+
+'''
+get the instance id used as the pool worker id
+'''
+def get_instance_id():
+    try:
+        resp = requests.get('http://169.254.169.254/latest/meta-data/instance-id', timeout = 2)
+        if resp.status_code == 200:
+            return resp.text
+    except Exception:
+        logger.error('Unable to query instance metadata for instance-id.  Using hostname')
+
+    return os.uname().nodename
+
+
+'''
+Bootstrap steps run as a dependency graph on a thread pool.  A step
+starts once the steps it depends on have finished and receives their
+results as arguments, so independent steps (parameter fetch,
+notification settings, downloads) overlap.  Steps are added in dependency order and
+the pool queue is FIFO, so a step waiting on its dependencies never
+holds back one of them.
+'''
+class BootstrapGraph(object):
+
+    def __init__(self, max_workers: int = 8):
+        self.executor = ThreadPoolExecutor(max_workers = max_workers)
+        self.origin = time.perf_counter()
+        self.steps = {}
+
+    def add(self, name: str, fn, deps: list = None):
+        deps = deps or []
+        dep_futures = [self.steps[dep]['future'] for dep in deps]
+        step = { 'deps': list(deps), 'start': None, 'end': None }
+
+        def run():
+            results = [future.result() for future in dep_futures]
+            step['start'] = time.perf_counter() - self.origin
+            try:
+                return fn(*results)
+            finally:
+                step['end'] = time.perf_counter() - self.origin
+
+        step['future'] = self.executor.submit(run)
+        self.steps[name] = step
+        return self
+
+    '''
+    wait for the steps and return their results in order.  the first
+    failed step raises
+    '''
+    def wait(self, names: list):
+        return [self.steps[name]['future'].result() for name in names]
+
+    '''
+    the chain of steps that decided when name finished, following the
+    dependency that finished last
+    '''
+    def critical_path(self, name: str):
+        path = [name]
+        while self.steps[path[-1]]['deps']:
+            path.append(max(self.steps[path[-1]]['deps'], key = lambda dep: self.steps[dep]['end'] or 0))
+
+        return list(reversed(path))
+
+    '''
+    log the start, duration and wait of every finished step and the
+    critical path to name.  wait is the time a ready step was queued
+    '''
+    def report(self, name: str):
+        for step_name, step in sorted(self.steps.items(), key = lambda item: item[1]['start'] or 0):
+            if step['end'] is None:
+                continue
+
+            ready = max([self.steps[dep]['end'] for dep in step['deps']] or [0.0])
+            logger.info(f"Bootstrap step {step_name}: started {step['start']:0.4f}s, "
+                + f"took {step['end'] - step['start']:0.4f}s, waited {step['start'] - ready:0.4f}s")
+
+        path = self.critical_path(name)
+        breakdown = ', '.join(f"{p} {self.steps[p]['end'] - self.steps[p]['start']:0.4f}s" for p in path)
+        logger.info(f"Critical path to {name} ({self.steps[name]['end']:0.4f}s): {breakdown}")
+        return path
+
+    def shutdown(self):
+        self.executor.shutdown(wait = True)
+
+
+'''
+deliver the queued notifications of a job, waiting at most
+NOTIFY_FLUSH_TIMEOUT seconds
+'''
+def flush_notifications(graph: BootstrapGraph):
+    try:
+        notifier, = graph.wait(['notifier'])
+        notifier.flush(float(os.getenv('NOTIFY_FLUSH_TIMEOUT', 10)))
+
+    except Exception as e:
+        logger.error(f'Unable to flush notifications: {e}')
+
+
+'''
+decide how the event-data reaches the processor: (sharding, None)
+when split into shards, (None, input_stream) when streamed, or
+(None, None) when downloaded whole
+'''
+def plan_input(s3, params: dict, shard_index: int = None):
+    sharding = get_shards(s3, params, shard_index)
+    input_stream = get_input_stream(s3, params) if not sharding else None
+    return sharding, input_stream
+
+
+'''
+fetch the event-data as planned.  returns the shard paths when
+sharding, a streamed event-data is fetched by the stream itself
+'''
+def fetch_event_data(s3, params: dict, plan: tuple):
+    sharding, input_stream = plan
+    if sharding:
+        shards, shard_ranges = sharding
+        return shards.download_all(shard_ranges) if shard_ranges else []
+
+    if not input_stream:
+        download_s3_resources(s3, { 'event-data': params['event-data'] },
+            encodings = { 'event-data': get_compression(params) })
+
+    return None
+
+
+'''
+1. pull ssm parameter
+2. pull s3 object resources
+3. create commandline argument string
+4. create configuration file
+5. start the batch-processor
+
+steps 1 to 4 and the start notification run as a BootstrapGraph;
+the processor starts as soon as its inputs are ready.  notifications
+are delivered in the background and flushed when the job ends
+'''
+def run_job(namespace: str, region: str, shard_index: int = None):
+    start = time.perf_counter()
+    logger.info(f'Namespace: {namespace}')
+
+    # initialize the client for requests
+    ssm = get_client('ssm', region)
+    s3 = get_client('s3', region)
+
+    profile = JobProfile(namespace)
+    graph = BootstrapGraph()
+    try:
+        # the launch tracker measures request to start with this
+        graph.add('batch_init_start', lambda: put_batch_init_start(ssm, namespace, shard_index))
+
+        # parameters and the notification settings are independent
+        graph.add('params', lambda: get_parameters_from_namespace(ssm, namespace))
+        graph.add('notifier', lambda: get_notification_dispatcher(ssm, namespace, region))
+
+        # save s3 objects to the current directory while the event-data
+        # is planned.  a large event-data is split into line-aligned
+        # shards, each downloaded with a ranged GET and run by its own
+        # process; a streamed event-data is fetched by the processor
+        graph.add('resources', lambda params: download_s3_resources(s3, params, ['event-data']), ['params'])
+        graph.add('input_plan', lambda params: plan_input(s3, params, shard_index), ['params'])
+        graph.add('event_data', lambda params, plan: fetch_event_data(s3, params, plan), ['params', 'input_plan'])
+
+        # create a properties file and cmd args from params
+        graph.add('properties', create_properties_file, ['params'])
+        graph.add('cmdline_args', lambda params, plan: get_commandline_args(params,
+            plan[1].datafile_path if plan[1] else None), ['params', 'input_plan'])
+        graph.add('jvm', get_jvm_profile, ['params'])
+
+        # notifications are queued, they never hold up the processor
+        graph.add('send_start', lambda notifier, params, cmdline_args: notifier.notify(get_start_message(
+            namespace, region, name_from_event_resource(params), cmdline_args)), ['notifier', 'params', 'cmdline_args'])
+        graph.add('ready', lambda *inputs: None, ['resources', 'event_data', 'properties', 'cmdline_args', 'jvm'])
+
+        params, (sharding, input_stream), shard_paths, cmdline_args, jvm, _ = graph.wait(
+            ['params', 'input_plan', 'event_data', 'cmdline_args', 'jvm', 'ready'])
+        graph.report('ready')
+        profile.add_steps(graph)
+        app_name = name_from_event_resource(params)
+
+        # execute the java process, or one per shard
+        if sharding:
+            launch_sharded_processes(app_name, params, shard_paths, profile, jvm)
+        else:
+            launch_process(app_name, cmdline_args, input_stream, profile, jvm)
+
+        # take the duration and send completion notification
+        notifier, _ = graph.wait(['notifier', 'send_start'])
         duration = time.perf_counter() - start
-        mailer.send_complete(app_name, duration)
+        summary = profile.write()
+        notifier.notify(get_complete_message(app_name, duration, format_profile(summary)))
+
+    finally:
+        graph.shutdown()
+
+        # a failed job keeps its timeline too
+        if not profile.written:
+            profile.add_steps(graph)
+            profile.write()
+
+        flush_notifications(graph)
+
+    logger.info('Process completed successfully.')
+
+
+'''
+load arguments.  --pool keeps the instance running as a pool
+worker after the namespace from userdata has been processed
+'''
+def init_arguments():
+    parser = argparse.ArgumentParser(description = 'Batch Init')
+    parser.add_argument('--pool', help = 'Worker pool path to join after the first job.')
+    parser.add_argument('--pool-poll-interval', type = float, default = 5.0, help = 'Seconds between assignment polls.')
+    parser.add_argument('--pool-idle-timeout', type = float, default = 900.0, help = 'Seconds idle before leaving the pool.')
+    parser.add_argument('--pool-leave-grace', type = float, default = 30.0, help = 'Seconds between leaving and the last assignment check.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = init_arguments()
+    region = get_instance_region()
+
+    try:
+        logger.info('Gathering configuration...')
+
+        # timings for the userdata phases that preceded this script
+        log_boot_timeline()
+
+        # namespace, and the shard for a fan-out instance, should
+        # be added via EC2 userdata
+        namespace = get_instance_namespace()
+        run_job(namespace, region, get_instance_shard())
 
-        logger.info('Process completed successfully.')
-    
     except Exception as e:
         logger.error(f'Processing encountered an error: {e}')
+
+    finally:
+        flush_api_metrics('job')
+
+    if args.pool:
+        try:
+            board = get_pool_board(args.pool, region)
+            agent = PoolAgent(board, get_instance_id(), args.pool_poll_interval,
+                idle_timeout = args.pool_idle_timeout, leave_grace = args.pool_leave_grace)
+            agent.run(lambda assigned: run_job(assigned, region))
+
+        except Exception as e:
+            logger.error(f'Worker pool agent encountered an error: {e}')
+
+        finally:
+            flush_api_metrics('pool')
@@ -0,0 +1,147 @@
+import unittest
+from unittest import mock
+import importlib.util
+
+import boto3
+from botocore.stub import Stubber
+from jproperties import Properties
+
+
+'''
+batch-config.py is a script, load it by path
+'''
+def load_script(name: str, path: str):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+batch_config = load_script('batch_config', './batch-scripts/batch-config.py')
+
+
+class TestBatchConfig(unittest.TestCase):
+
+    '''
+    nested namespaces and managed parameters are never stale
+    '''
+    def test_diff_configuration(self):
+        props = Properties()
+        props['name'] = 'new'
+        props['added'] = 'value'
+
+        existing = {
+            '/bucket/name': 'old',
+            '/bucket/removed': 'value',
+            '/bucket/event-resource': 's3://bucket/job.jar',
+            '/bucket/shard-plan': '{}',
+            '/bucket/batch-init-start-shard1': '1600000000.0',
+            '/bucket/jobs/nightly/event-data': 's3://bucket/data.csv'
+        }
+        added, changed, stale = batch_config.diff_configuration(props, '/bucket', existing)
+
+        self.assertEqual({ '/bucket/added': 'value' }, added)
+        self.assertEqual({ '/bucket/name': 'new' }, changed)
+        self.assertEqual(['/bucket/removed'], stale)
+
+    '''
+    the namespace is read flat, a throttled page is retried under the
+    limiter
+    '''
+    def test_get_existing_parameters(self):
+        ssm = boto3.client('ssm', region_name = 'us-east-1',
+            aws_access_key_id = 'test', aws_secret_access_key = 'test')
+        request = { 'Path': '/bucket', 'Recursive': False, 'WithDecryption': False, 'MaxResults': 10 }
+
+        with Stubber(ssm) as stubber:
+            stubber.add_client_error('get_parameters_by_path', service_error_code = 'ThrottlingException',
+                expected_params = request)
+            stubber.add_response('get_parameters_by_path', { 'Parameters': [
+                { 'Name': '/bucket/name', 'Value': 'value' }], 'NextToken': 'next' }, request)
+            stubber.add_response('get_parameters_by_path', { 'Parameters': [
+                { 'Name': '/bucket/other', 'Value': 'value' }] }, dict(request, NextToken = 'next'))
+
+            existing = batch_config.get_existing_parameters(ssm, '/bucket', batch_config.RateLimiter(1000.0))
+
+        self.assertEqual({ '/bucket/name': 'value', '/bucket/other': 'value' }, existing)
+
+
+class TestSyncConfiguration(unittest.TestCase):
+
+    def setUp(self):
+        self.ssm = boto3.client('ssm', region_name = 'us-east-1',
+            aws_access_key_id = 'test', aws_secret_access_key = 'test')
+        self.stubber = Stubber(self.ssm)
+        self.stubber.activate()
+
+        self.props = Properties()
+        self.props['name'] = 'new'
+        self.props['same'] = 'value'
+        self.props['added'] = 'value'
+
+        self.stubber.add_response('get_parameters_by_path', { 'Parameters': [
+            { 'Name': '/bucket/name', 'Value': 'old' },
+            { 'Name': '/bucket/same', 'Value': 'value' },
+            { 'Name': '/bucket/removed', 'Value': 'value' },
+            { 'Name': '/bucket/event-resource', 'Value': 's3://bucket/job.jar' }] },
+            { 'Path': '/bucket', 'Recursive': False, 'WithDecryption': False, 'MaxResults': 10 })
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+    def sync(self, **kwargs):
+        with mock.patch.object(batch_config.boto3, 'client', return_value = self.ssm), \
+                mock.patch.object(batch_config.time, 'sleep'):
+            with self.assertLogs(batch_config.logger, 'INFO') as logs:
+                batch_config.sync_configuration(self.props, 'bucket', workers = 1, tps = 1000.0, **kwargs)
+        self.stubber.assert_no_pending_responses()
+        return logs.output
+
+    def put(self, name: str, value: str):
+        return { 'Name': name, 'Value': value, 'Type': 'String', 'Overwrite': True }
+
+    '''
+    added and changed properties are put, stale ones deleted, and
+    managed parameters are counted apart from unchanged ones
+    '''
+    def test_sync(self):
+        self.stubber.add_response('put_parameter', { 'Version': 1 }, self.put('/bucket/added', 'value'))
+        self.stubber.add_response('put_parameter', { 'Version': 2 }, self.put('/bucket/name', 'new'))
+        self.stubber.add_response('delete_parameters', { 'DeletedParameters': ['/bucket/removed'] },
+            { 'Names': ['/bucket/removed'] })
+
+        output = self.sync(delete_stale = True)
+        self.assertIn('Sync /bucket: 1 added, 1 changed, 1 stale, 1 unchanged, 1 managed', output[0])
+
+    '''
+    a dry run reads the namespace and writes nothing
+    '''
+    def test_dry_run(self):
+        output = self.sync(delete_stale = True, dry_run = True)
+        self.assertIn('Dry run, no parameters were written.', output[-1])
+
+    '''
+    throttles and transient errors are retried, stale parameters are
+    kept unless deletion is requested
+    '''
+    def test_retries(self):
+        self.stubber.add_client_error('put_parameter', service_error_code = 'ThrottlingException',
+            expected_params = self.put('/bucket/added', 'value'))
+        self.stubber.add_client_error('put_parameter', service_error_code = 'InternalServerError',
+            http_status_code = 500, expected_params = self.put('/bucket/added', 'value'))
+        self.stubber.add_response('put_parameter', { 'Version': 1 }, self.put('/bucket/added', 'value'))
+        self.stubber.add_client_error('put_parameter', service_error_code = 'ServiceUnavailable',
+            http_status_code = 503, expected_params = self.put('/bucket/name', 'new'))
+        self.stubber.add_response('put_parameter', { 'Version': 2 }, self.put('/bucket/name', 'new'))
+
+        output = self.sync()
+        self.assertIn('- /bucket/removed (kept)', '\n'.join(output))
+
+    '''
+    other client errors are not retried
+    '''
+    def test_not_retried(self):
+        self.stubber.add_client_error('put_parameter', service_error_code = 'ValidationException',
+            expected_params = self.put('/bucket/added', 'value'))
+
+        with self.assertRaises(batch_config.ClientError):
+            self.sync()
@@ -0,0 +1,780 @@
+import unittest
+from unittest import mock
+import os, io, json, time
+import gzip, bz2
+import threading, subprocess
+import random
+import tempfile
+import importlib.util
+
+import boto3
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+
+'''
+batch-init.py is deployed as a single script, load it by path.  it
+logs to batch-init.log in the working directory, so load it from a
+temporary one
+'''
+def load_batch_init():
+    path = os.path.abspath('./batch-scripts/batch-init.py')
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            spec = importlib.util.spec_from_file_location('batch_init', path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        finally:
+            os.chdir(cwd)
+
+    return module
+
+batch_init = load_batch_init()
+
+
+'''
+run every test in its own working directory, batch-init writes its
+logs and caches next to itself
+'''
+class WorkingDirectoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.TemporaryDirectory()
+        os.chdir(self.workdir.name)
+
+        self.path = os.environ['PATH']
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        os.chdir(self.cwd)
+        self.workdir.cleanup()
+
+    '''
+    put a shell script named java first on the PATH
+    '''
+    def install_java(self, script: str):
+        os.makedirs('bin', exist_ok = True)
+        with open('bin/java', 'w') as java:
+            java.write('#!/bin/sh\n' + script)
+        os.chmod('bin/java', 0o755)
+        os.environ['PATH'] = os.path.abspath('bin') + os.pathsep + self.path
+
+
+'''
+in-memory S3 for ranged reads and downloads of one object, served
+under any key but those in missing
+'''
+class FakeS3(object):
+
+    def __init__(self, data: bytes, etag: str = '"etag"', missing: tuple = ()):
+        self.data = data
+        self.etag = etag
+        self.missing = missing
+        self.ranges = []
+        self.downloads = []
+
+    def head_object(self, Bucket: str, Key: str):
+        return { 'ContentLength': len(self.data), 'ETag': self.etag }
+
+    def download_file(self, Bucket: str, Key: str, Filename: str, Config = None):
+        self.downloads.append(Key)
+        if Key in self.missing:
+            raise Exception(f'NoSuchKey {Key}')
+
+        with open(Filename, 'wb') as out:
+            out.write(self.data)
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None):
+        data = self.data
+        if Range:
+            start, end = [int(b) for b in Range[len('bytes='):].split('-')]
+            self.ranges.append((start, end))
+            data = data[start:end + 1]
+
+        return { 'Body': StreamingBody(io.BytesIO(data), len(data)) }
+
+
+def stub_s3():
+    return boto3.client('s3', region_name = 'us-east-1',
+        aws_access_key_id = 'test', aws_secret_access_key = 'test')
+
+
+class TestPoolAgent(WorkingDirectoryTestCase):
+
+    '''
+    an assignment claimed after the agent started leaving is still run
+    before the worker deregisters
+    '''
+    def test_leaving_runs_late_assignment(self):
+        with tempfile.TemporaryDirectory() as tmp:
+
+            class LateClaimBoard(batch_init.LocalPoolBoard):
+                def set_state(self, worker_id: str, state: str):
+                    super().set_state(worker_id, state)
+                    # a dispatcher that read the idle state claims now
+                    if state == 'leaving':
+                        with open(os.path.join(self.directory, worker_id, 'assignment'), 'w') as assignment:
+                            assignment.write('/bucket/late/')
+
+            jobs = []
+            agent = batch_init.PoolAgent(LateClaimBoard(tmp), 'i-0123', poll_interval = 0.01,
+                idle_timeout = 0.0, leave_grace = 0.01)
+            agent.run(jobs.append)
+
+            self.assertEqual(['/bucket/late/'], jobs)
+            self.assertEqual([], os.listdir(os.path.join(tmp, 'i-0123')))
+
+
+class TestInputStream(WorkingDirectoryTestCase):
+
+    '''
+    the fifo exists when the processor starts and carries the object
+    '''
+    def test_fifo_exists_at_launch(self):
+        self.install_java('path="${3#--datafile-path=}"\n'
+            + '[ -p "$path" ] || exit 3\n'
+            + 'cat "$path" > received\n')
+
+        s3 = stub_s3()
+        with Stubber(s3) as stubber:
+            stubber.add_response('get_object', { 'Body': StreamingBody(io.BytesIO(b'a,1\nb,2\n'), 8) },
+                { 'Bucket': 'bucket', 'Key': 'data.csv' })
+
+            stream = batch_init.S3InputStream(s3, 's3://bucket/data.csv', 'fifo')
+            batch_init.launch_process('job.jar', [f'--datafile-path={stream.datafile_path}'], stream)
+
+        with open('received', 'rb') as received:
+            self.assertEqual(b'a,1\nb,2\n', received.read())
+        self.assertFalse(os.path.exists(stream.fifo_path))
+
+    '''
+    the processor's exit code is raised with the stream error as its
+    cause, a stream error alone still fails
+    '''
+    def test_exit_code_before_stream_error(self):
+        class BrokenStream(object):
+            mode = 'fifo'
+            def prepare(self):
+                pass
+            def start(self, process):
+                pass
+            def finish(self):
+                raise Exception('Streaming s3://bucket/data.csv failed after 0 bytes: Broken pipe')
+
+        self.install_java('exit 3\n')
+        with self.assertRaises(subprocess.CalledProcessError) as failed:
+            batch_init.launch_process('job.jar', [], BrokenStream())
+        self.assertEqual(3, failed.exception.returncode)
+        self.assertIn('Broken pipe', str(failed.exception.__cause__))
+
+        self.install_java('exit 0\n')
+        with self.assertRaisesRegex(Exception, 'Broken pipe'):
+            batch_init.launch_process('job.jar', [], BrokenStream())
+
+
+class TestShards(WorkingDirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        generator = random.Random(13)
+        self.data = b''.join(f'{i},{"x" * generator.randint(0, 40)}\n'.encode('utf-8') for i in range(500))
+
+    '''
+    shards of every fan-out range meet at line boundaries and together
+    hold every line exactly once, with probes smaller than a line
+    '''
+    def test_fan_out_ranges_align_to_lines(self):
+        s3 = FakeS3(self.data)
+        size = len(self.data)
+        ranges = [[size * i // 3, size * (i + 1) // 3] for i in range(3)]
+        params = { 'event-data': 's3://bucket/data.csv', 'shards': '4', 'shard-plan': json.dumps({ 'ranges': ranges }) }
+
+        probe_size = batch_init.S3Shards.PROBE_SIZE
+        batch_init.S3Shards.PROBE_SIZE = 3
+        os.environ['SHARD_MIN_MB'] = '1'
+        try:
+            planned = [batch_init.get_shards(s3, params, i)[1] for i in range(3)]
+        finally:
+            batch_init.S3Shards.PROBE_SIZE = probe_size
+            del os.environ['SHARD_MIN_MB']
+
+        shards = [shard for plan in planned for shard in plan]
+        pieces = [self.data[start:end] for start, end in shards]
+        self.assertEqual(self.data, b''.join(pieces))
+        self.assertTrue(all(piece.endswith(b'\n') for piece in pieces))
+        self.assertEqual([end for _, end in shards[:-1]], [start for start, _ in shards[1:]])
+
+    '''
+    a whole object splits into the requested count of aligned shards,
+    which download to files holding their lines
+    '''
+    def test_plan_and_download(self):
+        shards = batch_init.S3Shards(FakeS3(self.data), 's3://bucket/data.csv')
+        plan = shards.plan(4)
+        paths = shards.download_all(plan)
+
+        self.assertEqual(4, len(plan))
+        contents = []
+        for path in paths:
+            with open(path, 'rb') as shard:
+                contents.append(shard.read())
+        self.assertEqual(self.data, b''.join(contents))
+
+    '''
+    without a shards setting the input splits per core, unless it is
+    streamed or too small
+    '''
+    def test_default_shards(self):
+        s3 = FakeS3(self.data * 200)
+        params = { 'event-data': 's3://bucket/data.csv' }
+
+        os.environ['SHARD_MIN_MB'] = '1'
+        try:
+            with mock.patch.object(batch_init.os, 'cpu_count', return_value = 2):
+                shards, plan = batch_init.get_shards(s3, params)
+                self.assertEqual(2, len(plan))
+
+                self.assertIsNone(batch_init.get_shards(s3, dict(params, shards = '1')))
+                self.assertIsNone(batch_init.get_shards(s3, dict(params, **{ 'stream-input': 'fifo' })))
+                self.assertIsNone(batch_init.get_shards(FakeS3(self.data), params))
+        finally:
+            del os.environ['SHARD_MIN_MB']
+
+    '''
+    every shard runs to completion and a failure reports every exit code
+    '''
+    def test_sharded_exit_codes(self):
+        self.install_java('case "$3" in *shard1) exit 2;; *shard2) exit 5;; esac\n')
+        params = { 'event-data': 's3://bucket/data.csv' }
+
+        results = batch_init.launch_sharded_processes('job.jar', params, ['./data.csv.shard0'])
+        self.assertEqual([0], [r['returncode'] for r in results])
+
+        with self.assertRaises(Exception) as raised:
+            batch_init.launch_sharded_processes('job.jar', params,
+                ['./data.csv.shard0', './data.csv.shard1', './data.csv.shard2'])
+        self.assertEqual('2 of 3 shards failed: shard 1=2, shard 2=5', str(raised.exception))
+
+
+class TestNamespaceLoader(WorkingDirectoryTestCase):
+
+    '''
+    the first load pages through every value; the next one lists
+    versions and only fetches new or changed parameters
+    '''
+    def test_snapshot_reuse(self):
+        ssm = boto3.client('ssm', region_name = 'us-east-1',
+            aws_access_key_id = 'test', aws_secret_access_key = 'test')
+        path = { 'Path': '/bucket/', 'Recursive': True, 'WithDecryption': False, 'MaxResults': 10 }
+        described = { 'ParameterFilters': [{ 'Key': 'Path', 'Option': 'Recursive', 'Values': ['/bucket/'] }],
+            'MaxResults': 50 }
+
+        with Stubber(ssm) as stubber:
+            stubber.add_response('get_parameters_by_path', { 'NextToken': 'next', 'Parameters': [
+                { 'Name': '/bucket/event-data', 'Value': 's3://bucket/data.csv', 'Version': 1 }] }, path)
+            stubber.add_response('get_parameters_by_path', { 'Parameters': [
+                { 'Name': '/bucket/name', 'Value': 'old', 'Version': 1 }] }, dict(path, NextToken = 'next'))
+
+            first = batch_init.NamespaceLoader(ssm, '/bucket/')
+            self.assertEqual('old', first.load()['/bucket/name']['Value'])
+            self.assertEqual(2, first.calls)
+
+            stubber.add_response('describe_parameters', { 'Parameters': [
+                { 'Name': '/bucket/event-data', 'Version': 1 },
+                { 'Name': '/bucket/name', 'Version': 2 },
+                { 'Name': '/bucket/added', 'Version': 1 }] }, described)
+            stubber.add_response('get_parameters', { 'Parameters': [
+                { 'Name': '/bucket/name', 'Value': 'new', 'Version': 2 },
+                { 'Name': '/bucket/added', 'Value': 'value', 'Version': 1 }] },
+                { 'Names': ['/bucket/name', '/bucket/added'], 'WithDecryption': False })
+
+            second = batch_init.NamespaceLoader(ssm, '/bucket/')
+            params = second.load()
+            stubber.assert_no_pending_responses()
+
+        self.assertEqual({ '/bucket/event-data': 's3://bucket/data.csv', '/bucket/name': 'new', '/bucket/added': 'value' },
+            { name: p['Value'] for name, p in params.items() })
+        self.assertEqual(2, second.calls)
+
+    '''
+    a snapshot written for another namespace is not reused
+    '''
+    def test_snapshot_other_namespace(self):
+        with open('parameters-snapshot.json', 'w') as snapshot:
+            json.dump({ 'format': 1, 'namespace': '/other/', 'parameters': {} }, snapshot)
+
+        ssm = boto3.client('ssm', region_name = 'us-east-1',
+            aws_access_key_id = 'test', aws_secret_access_key = 'test')
+        with Stubber(ssm) as stubber:
+            stubber.add_response('get_parameters_by_path', { 'Parameters': [
+                { 'Name': '/bucket/event-data', 'Value': 's3://bucket/data.csv', 'Version': 1 }] })
+
+            params = batch_init.NamespaceLoader(ssm, '/bucket/').load()
+
+        self.assertEqual(['/bucket/event-data'], list(params.keys()))
+
+
+class TestBootstrapGraph(unittest.TestCase):
+
+    '''
+    the critical path follows whichever dependency finished last
+    '''
+    def test_critical_path(self):
+        graph = batch_init.BootstrapGraph(max_workers = 4)
+        try:
+            graph.add('config', lambda: 'config')
+            graph.add('client', lambda: time.sleep(0.2) or 'client')
+            graph.add('params', lambda config: time.sleep(0.01) or 'params', ['config'])
+            graph.add('download', lambda client, params: client + params, ['client', 'params'])
+
+            self.assertEqual(['clientparams'], graph.wait(['download']))
+            self.assertEqual(['client', 'download'], graph.critical_path('download'))
+            self.assertEqual(['config', 'params'], graph.critical_path('params'))
+            self.assertEqual(['client', 'download'], graph.report('download'))
+        finally:
+            graph.shutdown()
+
+    '''
+    a failed dependency fails the steps that wait on it
+    '''
+    def test_failed_step(self):
+        graph = batch_init.BootstrapGraph()
+        try:
+            graph.add('config', lambda: 1 / 0)
+            graph.add('params', lambda config: config, ['config'])
+
+            with self.assertRaises(ZeroDivisionError):
+                graph.wait(['params'])
+        finally:
+            graph.shutdown()
+
+
+class TestNotificationDispatcher(WorkingDirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.notify_file = os.environ.get('NOTIFY_FILE')
+        os.environ['NOTIFY_FILE'] = 'notifications.jsonl'
+
+    def tearDown(self):
+        if self.notify_file is None:
+            os.environ.pop('NOTIFY_FILE')
+        else:
+            os.environ['NOTIFY_FILE'] = self.notify_file
+        super().tearDown()
+
+    def read_notifications(self):
+        if not os.path.exists('notifications.jsonl'):
+            return []
+        with open('notifications.jsonl') as notifications:
+            return [json.loads(line) for line in notifications]
+
+    '''
+    a failing sink is retried up to max_attempts, then counted as failed
+    '''
+    def test_retry(self):
+        class FlakyFileSink(batch_init.FileSink):
+            def __init__(self, path: str, failures: dict):
+                super().__init__(path)
+                self.failures = failures
+
+            def send(self, message: dict):
+                if self.failures[message['subject']]:
+                    self.failures[message['subject']] -= 1
+                    raise Exception('throttled')
+                super().send(message)
+
+        sink, = batch_init.get_notification_sinks({ 'sender': None, 'recipients': None, 'topic': None }, 'us-east-1')
+        dispatcher = batch_init.NotificationDispatcher([FlakyFileSink(sink.path, { 'started': 2, 'completed': 3 })],
+            max_attempts = 3, backoff = 0.01)
+        dispatcher.notify({ 'subject': 'started' })
+        dispatcher.notify({ 'subject': 'completed' })
+
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual([{ 'subject': 'started' }], self.read_notifications())
+        self.assertEqual((1, 1), (dispatcher.sent, dispatcher.failed))
+
+    '''
+    flush gives up on a stuck sink after the timeout and drops the rest
+    '''
+    def test_flush_timeout(self):
+        release = threading.Event()
+
+        class StuckFileSink(batch_init.FileSink):
+            def send(self, message: dict):
+                release.wait(5)
+                super().send(message)
+
+        dispatcher = batch_init.NotificationDispatcher([StuckFileSink('notifications.jsonl')], backoff = 0.01)
+        dispatcher.notify({ 'subject': 'started' })
+        dispatcher.notify({ 'subject': 'completed' })
+
+        started = time.perf_counter()
+        self.assertFalse(dispatcher.flush(0.2))
+        self.assertLess(time.perf_counter() - started, 2)
+        self.assertEqual([], self.read_notifications())
+
+        release.set()
+        dispatcher.worker.join(5)
+        self.assertEqual(2, dispatcher.sent)
+
+
+class TestDecompressor(unittest.TestCase):
+
+    def setUp(self):
+        self.max_output = batch_init.Decompressor.MAX_OUTPUT
+        batch_init.Decompressor.MAX_OUTPUT = 64 * 1024
+
+    def tearDown(self):
+        batch_init.Decompressor.MAX_OUTPUT = self.max_output
+
+    def chunked(self, data: bytes, size: int = 1000):
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    '''
+    concatenated streams decompress in pieces of at most MAX_OUTPUT
+    '''
+    def check_bounded(self, encoding: str, compress):
+        first, second = b'a' * 1000000, b'event,data\n' * 100
+        pieces = list(batch_init.Decompressor(encoding).stream(self.chunked(compress(first) + compress(second))))
+
+        self.assertEqual(first + second, b''.join(pieces))
+        self.assertLessEqual(max(len(piece) for piece in pieces), batch_init.Decompressor.MAX_OUTPUT)
+
+    def test_gzip(self):
+        self.check_bounded('gzip', gzip.compress)
+
+    def test_bzip2(self):
+        self.check_bounded('bzip2', bz2.compress)
+
+    def test_zstd(self):
+        try:
+            import zstandard
+        except ImportError:
+            self.skipTest('zstandard is not installed')
+        self.check_bounded('zstd', zstandard.ZstdCompressor().compress)
+
+    def test_truncated(self):
+        with self.assertRaisesRegex(Exception, 'Truncated gzip'):
+            list(batch_init.Decompressor('gzip').stream(self.chunked(gzip.compress(b'a' * 100000)[:-10])))
+        with self.assertRaisesRegex(Exception, 'Truncated bzip2'):
+            list(batch_init.Decompressor('bzip2').stream(self.chunked(bz2.compress(b'a' * 100000)[:-10])))
+
+    '''
+    a final chunk holding many MAX_OUTPUT pieces is drained in full
+    and not mistaken for truncated input
+    '''
+    def test_compressible_final_chunk(self):
+        head, tail = b'event,data\n' * 100, b'a' * 5000000
+        for encoding, compress in (('gzip', gzip.compress), ('bzip2', bz2.compress)):
+            pieces = list(batch_init.Decompressor(encoding).stream(self.chunked(compress(head)) + [compress(tail)]))
+
+            self.assertEqual(head + tail, b''.join(pieces))
+            self.assertLessEqual(max(len(piece) for piece in pieces), batch_init.Decompressor.MAX_OUTPUT)
+
+
+class TestArtifactCache(WorkingDirectoryTestCase):
+
+    def write(self, path: str, data: bytes):
+        with open(path, 'wb') as out:
+            out.write(data)
+
+    def read(self, path: str):
+        with open(path, 'rb') as source:
+            return source.read()
+
+    '''
+    a stored file is fetched by ETag, size and encoding from any key
+    '''
+    def test_fetch_store(self):
+        cache = batch_init.ArtifactCache('cache', 1024)
+        self.assertFalse(cache.fetch('"etag"', 5, None, 'data.csv'))
+
+        self.write('data.csv', b'a,b\n1')
+        cache.store('"etag"', 5, None, 'data.csv')
+
+        self.assertTrue(cache.fetch('etag', 5, None, 'copy.csv'))
+        self.assertEqual(b'a,b\n1', self.read('copy.csv'))
+        self.assertFalse(cache.fetch('etag', 5, 'gzip', 'other.csv'))
+        self.assertFalse(cache.fetch('etag', 6, None, 'other.csv'))
+        self.assertFalse(os.path.exists('other.csv'))
+
+    '''
+    the least recently used entries go first, never the one just stored
+    '''
+    def test_evict(self):
+        cache = batch_init.ArtifactCache('cache', 250)
+        for i, etag in enumerate(['first', 'second']):
+            self.write(f'{etag}.csv', bytes(100))
+            cache.store(etag, 100, None, f'{etag}.csv')
+            os.utime(cache.entry_path(etag, 100), (1000 + i, 1000 + i))
+
+        # using the first makes the second the oldest
+        self.assertTrue(cache.fetch('first', 100, None, 'first.csv'))
+
+        self.write('third.csv', bytes(100))
+        cache.store('third', 100, None, 'third.csv')
+
+        self.assertEqual([True, False, True], [os.path.exists(cache.entry_path(etag, 100)) for etag in ['first', 'second', 'third']])
+
+        self.write('large.csv', bytes(500))
+        cache.store('large', 500, None, 'large.csv')
+        self.assertEqual([cache.entry_path('large', 500)], [os.path.join('cache', name) for name in os.listdir('cache')])
+
+
+class TestDownloads(WorkingDirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.environ = mock.patch.dict(os.environ, { 'ARTIFACT_CACHE': 'off' })
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        super().tearDown()
+
+    def write(self, path: str, data: str):
+        with open(path, 'w') as out:
+            out.write(data)
+
+    '''
+    part size and threads per object come from the environment
+    '''
+    def test_transfer_config(self):
+        config = batch_init.get_transfer_config()
+        self.assertEqual((8 * 1024 * 1024, 8 * 1024 * 1024, 10),
+            (config.multipart_threshold, config.multipart_chunksize, config.max_concurrency))
+
+        with mock.patch.dict(os.environ, { 'S3_CHUNK_SIZE_MB': '4', 'S3_OBJECT_CONCURRENCY': '3' }):
+            config = batch_init.get_transfer_config()
+        self.assertEqual((4 * 1024 * 1024, 4 * 1024 * 1024, 3),
+            (config.multipart_threshold, config.multipart_chunksize, config.max_concurrency))
+
+    '''
+    a local copy is current only with the same size and the ETag
+    recorded next to it
+    '''
+    def test_local_copy_current(self):
+        self.assertFalse(batch_init.is_local_copy_current('data.csv', 5, '"etag"'))
+
+        self.write('data.csv', 'a,b\n1')
+        self.assertFalse(batch_init.is_local_copy_current('data.csv', 5, '"etag"'))
+
+        self.write('data.csv.etag', '"etag"')
+        self.assertTrue(batch_init.is_local_copy_current('data.csv', 5, '"etag"'))
+        self.assertTrue(batch_init.is_local_copy_current('data.csv', None, '"etag"'))
+        self.assertFalse(batch_init.is_local_copy_current('data.csv', 6, '"etag"'))
+        self.assertFalse(batch_init.is_local_copy_current('data.csv', 5, '"other"'))
+
+    '''
+    a download records its ETag, is skipped while the object is
+    unchanged and repeated when the ETag changes
+    '''
+    def test_download_resource(self):
+        s3 = FakeS3(b'a,b\n1')
+        config = batch_init.get_transfer_config()
+
+        self.assertEqual(5, batch_init.download_s3_resource(s3, 's3://bucket/path/data.csv', config))
+        with open('data.csv.etag') as etag:
+            self.assertEqual('"etag"', etag.read())
+
+        self.assertEqual(0, batch_init.download_s3_resource(s3, 's3://bucket/path/data.csv', config))
+        self.assertEqual(['path/data.csv'], s3.downloads)
+
+        s3.etag = '"changed"'
+        self.assertEqual(5, batch_init.download_s3_resource(s3, 's3://bucket/path/data.csv', config))
+        self.assertEqual(2, len(s3.downloads))
+
+    '''
+    s3:// params are downloaded at once, skipped params and other
+    values are not
+    '''
+    def test_download_resources(self):
+        barrier = threading.Barrier(2, timeout = 5)
+
+        class ConcurrentS3(FakeS3):
+            def download_file(self, *args, **kwargs):
+                # only passes with both downloads in flight
+                barrier.wait()
+                super().download_file(*args, **kwargs)
+
+        s3 = ConcurrentS3(b'a,b\n1')
+        batch_init.download_s3_resources(s3, { 'jar': 's3://bucket/app.jar', 'config': 's3://bucket/app.yml',
+            'event-data': 's3://bucket/data.csv', 'email': 'user@example.com' }, ['event-data'])
+
+        self.assertEqual(['app.jar', 'app.yml'], sorted(s3.downloads))
+        self.assertTrue(os.path.exists('app.jar') and os.path.exists('app.yml'))
+        self.assertFalse(os.path.exists('data.csv'))
+
+    '''
+    a failed download fails the job once the others have finished
+    '''
+    def test_download_failure(self):
+        s3 = FakeS3(b'a,b\n1', missing = ('app.yml',))
+        with self.assertRaisesRegex(Exception, '1 of 2 S3 resources failed to download: s3://bucket/app.yml'):
+            batch_init.download_s3_resources(s3, { 'jar': 's3://bucket/app.jar', 'config': 's3://bucket/app.yml' })
+
+        self.assertTrue(os.path.exists('app.jar.etag'))
+
+
+class TestJvmProfile(WorkingDirectoryTestCase):
+
+    '''
+    the heap is a share of memory per process, GC follows cores and heap
+    '''
+    def test_heap_options(self):
+        self.assertEqual(['-Xms716m', '-Xmx716m', '-XX:+UseSerialGC', '-XX:+ExitOnOutOfMemoryError'],
+            batch_init.JvmProfile(1024, 1).heap_options())
+        self.assertEqual(['-Xms1433m', '-Xmx1433m', '-XX:+UseSerialGC', '-XX:+ExitOnOutOfMemoryError'],
+            batch_init.JvmProfile(2048, 4).heap_options())
+        self.assertEqual(['-Xms5734m', '-Xmx5734m', '-XX:+UseParallelGC', '-XX:ParallelGCThreads=4', '-XX:+ExitOnOutOfMemoryError'],
+            batch_init.JvmProfile(16384, 8).heap_options(2))
+        self.assertEqual(['-Xms64m', '-Xmx64m'], batch_init.JvmProfile(128, 1, heap_pct = 10).heap_options(4)[:2])
+
+    '''
+    the first successful run dumps an archive that later runs map, a
+    failed run leaves none.  older javas get no CDS options
+    '''
+    def test_cds_options(self):
+        with open('app.jar', 'wb') as jar:
+            jar.write(b'jar')
+
+        self.assertEqual([], batch_init.JvmProfile(1024, 1, cds_dir = 'cds', java_version = ('11.0.2', 11)).cds_options('app.jar'))
+        self.assertEqual([], batch_init.JvmProfile(1024, 1, java_version = ('17.0.1', 17)).cds_options('app.jar'))
+
+        jvm = batch_init.JvmProfile(1024, 1, cds_dir = 'cds', java_version = ('17.0.1', 17), options = ['-Xss1m'])
+        archive = jvm.get_archive('app.jar')
+        self.assertEqual([], jvm.cds_options('app.jar', dump = False))
+
+        command = jvm.command('app.jar', ['--datafile-path=data.csv'])
+        self.assertEqual(['java', '-Xms716m'], command[:2])
+        self.assertEqual([f'-XX:ArchiveClassesAtExit={archive}.part', '-Xss1m', '-jar', 'app.jar', '--datafile-path=data.csv'], command[-5:])
+
+        # a failed run drops its partial archive
+        open(f'{archive}.part', 'w').close()
+        jvm.finish('app.jar', 1)
+        self.assertEqual([], os.listdir('cds'))
+
+        open(f'{archive}.part', 'w').close()
+        jvm.finish('app.jar', 0)
+        self.assertEqual([f'-XX:SharedArchiveFile={archive}'], jvm.cds_options('app.jar'))
+
+        # another java version keeps its own archive
+        other = batch_init.JvmProfile(1024, 1, cds_dir = 'cds', java_version = ('21.0.1', 21))
+        self.assertNotEqual(archive, other.get_archive('app.jar'))
+
+
+class TestJobProfile(WorkingDirectoryTestCase):
+
+    def tearDown(self):
+        os.environ.pop('PROFILE_INTERVAL', None)
+        super().tearDown()
+
+    def run_profiled(self, interval: str):
+        os.environ['PROFILE_INTERVAL'] = interval
+        profile = batch_init.JobProfile('/bucket/')
+
+        graph = batch_init.BootstrapGraph()
+        graph.add('params', lambda: time.sleep(0.05))
+        graph.wait(['params'])
+        graph.shutdown()
+        profile.add_steps(graph)
+
+        process = subprocess.Popen(['sleep', '0.3'])
+        finish = profile.track_process('process', process)
+        process.wait()
+        finish()
+
+        return profile, profile.write()
+
+    '''
+    a sampled run reports its usage, the bootstrap ends when it starts
+    '''
+    def test_sampled(self):
+        profile, summary = self.run_profiled('0.05')
+
+        self.assertEqual(['params', 'process'], [p['name'] for p in summary['phases']])
+        self.assertGreater(summary['phases'][1]['seconds'], 0.25)
+
+        usage = summary['processes']['process']
+        self.assertGreater(usage['samples'], 1)
+        self.assertGreater(usage['rss_kb_max'], 0)
+
+        lines = batch_init.format_profile(summary)
+        self.assertEqual(f"Bootstrap: {summary['phases'][1]['start']:0.2f} seconds to processor start", lines[0])
+        self.assertTrue(lines[1].startswith('process: peak RSS'))
+
+        with open('batch-init-timeline.json') as timeline:
+            self.assertEqual(summary, json.loads(timeline.read()))
+        with open('batch-init-samples.json') as samples:
+            self.assertEqual(usage['samples'], len([json.loads(line) for line in samples]))
+
+    '''
+    without sampling the run is still a process phase, never bootstrap
+    '''
+    def test_unsampled(self):
+        profile, summary = self.run_profiled('0')
+
+        self.assertEqual({}, summary['processes'])
+        self.assertEqual([False, True], [p['process'] for p in summary['phases']])
+        self.assertEqual([f"Bootstrap: {summary['phases'][1]['start']:0.2f} seconds to processor start"],
+            batch_init.format_profile(summary))
+        self.assertLess(summary['phases'][1]['start'], 0.25)
+
+        with open('batch-init-samples.json') as samples:
+            self.assertEqual('', samples.read())
+
+
+class TestBatchInitStart(unittest.TestCase):
+
+    '''
+    every fan-out shard records its own start, none reach the processor
+    '''
+    def test_shard_start(self):
+        ssm = boto3.client('ssm', region_name = 'us-east-1',
+            aws_access_key_id = 'test', aws_secret_access_key = 'test')
+        with Stubber(ssm) as stubber:
+            stubber.add_response('put_parameter', { 'Version': 1 }, { 'Name': '/bucket/batch-init-start-shard2',
+                'Value': mock.ANY, 'Type': 'String', 'Overwrite': True })
+            batch_init.put_batch_init_start(ssm, '/bucket/', 2)
+            stubber.assert_no_pending_responses()
+
+        params = { 'batch-init-start': '1', 'batch-init-start-shard2': '1', 'name': 'value' }
+        self.assertEqual(['--name=value'], batch_init.get_commandline_args(params))
+
+
+class TestApiMetrics(WorkingDirectoryTestCase):
+
+    '''
+    the batch-init copy of the collector counts calls and errors per
+    operation and flushes them per phase to batch-init-metrics.log
+    '''
+    def test_flush_phase(self):
+        metrics = batch_init.ApiMetrics('Test')
+        ssm = metrics.instrument(boto3.client('ssm', region_name = 'us-east-1',
+            aws_access_key_id = 'test', aws_secret_access_key = 'test'))
+
+        with Stubber(ssm) as stubber:
+            stubber.add_response('get_parameter', { 'Parameter': { 'Name': 'name', 'Value': 'value' } })
+            stubber.add_client_error('get_parameter', service_error_code = 'ParameterNotFound')
+            ssm.get_parameter(Name = 'name')
+            with self.assertRaises(Exception):
+                ssm.get_parameter(Name = 'missing')
+
+        with mock.patch.object(batch_init, 'api_metrics', metrics):
+            batch_init.flush_api_metrics('params')
+            batch_init.flush_api_metrics('download')
+
+        with open('batch-init-metrics.log') as log:
+            lines = [json.loads(line) for line in log]
+
+        self.assertEqual(1, len(lines))
+        metric = lines[0]
+        self.assertEqual(('ssm', 'GetParameter', 'batch-init', 'params'),
+            (metric['Service'], metric['Operation'], metric['Function'], metric['Phase']))
+        self.assertEqual((2, 1), (metric['Calls'], metric['Errors']))
+        self.assertEqual(2, sum(metric['LatencyHistogram'].values()))
+        self.assertEqual('Test', metric['_aws']['CloudWatchMetrics'][0]['Namespace'])
@@ -0,0 +1,297 @@
+import sys, os
+import json, time, datetime
+import statistics, subprocess
+import argparse, tracemalloc
+
+sys.path.insert(0, './lambda/src')
+sys.path.insert(0, './lambda/benchmarks')
+
+# never reach real AWS from a benchmark
+for name, value in [('AWS_ACCESS_KEY_ID', 'bench'), ('AWS_SECRET_ACCESS_KEY', 'bench'),
+        ('AWS_DEFAULT_REGION', 'us-east-1'), ('CLOUDFORM_BUCKET', 'bench-cfn-bucket'),
+        ('CLOUDFORM_KEY', 'template.yml'), ('LOGGING_LEVEL', 'ERROR'), ('API_METRICS', 'off')]:
+    os.environ.setdefault(name, value)
+
+from fake_aws import FakeAws, launch_responses
+
+RESULTS_DIR = './lambda/benchmarks/results'
+PARAMS_YML = b'''
+- ParameterKey: InstanceKeyPair
+  ParameterValue: bench-key
+- ParameterKey: InstanceSubnetId
+  ParameterValue: subnet-00000000
+- ParameterKey: InstanceProfile
+  ParameterValue: bench-profile
+- ParameterKey: VPC
+  ParameterValue: vpc-00000000
+'''
+
+
+'''
+attach the fake to every client the launch path uses
+'''
+def install_fakes(latency_ms: float):
+    import cfn
+
+    with open('./cloudformation/template.yml', 'rb') as template:
+        fake = launch_responses(FakeAws(latency_ms), template.read(), PARAMS_YML)
+
+    fake.attach(cfn.get_client('s3'))
+    fake.attach(cfn.get_client('ssm'))
+    fake.attach(cfn.get_client('cloudformation'))
+    fake.attach(cfn.get_client('ec2'))
+    return fake
+
+
+def load_event(event_file: str):
+    with open(f'./lambda/tests/resources/{event_file}', 'r') as data:
+        return json.load(data)
+
+
+'''
+time a call and count the AWS calls it made
+'''
+def timed(fake: FakeAws, fn, *args):
+    fake.reset_calls()
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = (time.perf_counter() - start) * 1000
+    return elapsed, dict(fake.calls)
+
+
+def summarize_ms(samples: list):
+    return {
+        'median_ms': statistics.median(samples),
+        'p90_ms': sorted(samples)[max(0, int(len(samples) * 0.9) - 1)],
+        'min_ms': min(samples),
+        'max_ms': max(samples)
+    }
+
+
+'''
+warm lambda_handler invocations: wall time and AWS calls per invocation
+'''
+def bench_handler(fake: FakeAws, event: dict, iterations: int):
+    from cfn_launch import lambda_handler
+
+    samples, calls = [], None
+    for _ in range(iterations):
+        elapsed, calls = timed(fake, lambda_handler, event, None)
+        samples.append(elapsed)
+
+    result = summarize_ms(samples)
+    result['calls_per_invocation'] = sum(calls.values())
+    result['calls'] = calls
+    return result
+
+
+'''
+each CFN method on its own.  the first call sees a cold object cache
+'''
+def bench_methods(fake: FakeAws, iterations: int):
+    from cfn import CFN, object_cache
+    from registry import TemplateRegistry
+
+    cfn = CFN(os.environ['CLOUDFORM_BUCKET'], os.environ['CLOUDFORM_KEY'])
+    registered = CFN(os.environ['CLOUDFORM_BUCKET'], os.environ['CLOUDFORM_KEY'],
+        TemplateRegistry(os.environ['CLOUDFORM_BUCKET']))
+    namespace = '/bench-bucket/'
+    methods = {
+        'verify_namespace': lambda: cfn.verify_namespace(namespace),
+        'put_event_resource_param': lambda: cfn.put_event_resource_param(namespace, 'bench-bucket', 'job.jar'),
+        'get_template_body_as_string': cfn.get_template_body_as_string,
+        'get_template_params_as_yaml': cfn.get_template_params_as_yaml,
+        'get_user_data': lambda: cfn.get_user_data(namespace),
+        'create_stack': lambda: cfn.create_stack('bench-job', 'template', []).stack_status,
+        'create_stack_registered': lambda: registered.create_stack('bench-job', 'template', []).stack_status
+    }
+
+    object_cache.clear()
+    results = {}
+    for name, method in methods.items():
+        first_ms, first_calls = timed(fake, method)
+        samples = [timed(fake, method)[0] for _ in range(iterations)]
+
+        results[name] = summarize_ms(samples)
+        results[name].update({ 'first_ms': first_ms, 'first_calls': sum(first_calls.values()) })
+
+    return results
+
+
+'''
+warm invocations through each launcher.  the lambda side of the launch
+only; request-to-running latency is in the tracker timelines
+'''
+def bench_launchers(fake: FakeAws, event: dict, iterations: int):
+    launcher = os.environ.get('LAUNCHER')
+    results = {}
+    try:
+        for name in ['cloudformation', 'ec2']:
+            os.environ['LAUNCHER'] = name
+            results[name] = bench_handler(fake, event, iterations)
+    finally:
+        if launcher is None:
+            os.environ.pop('LAUNCHER', None)
+        else:
+            os.environ['LAUNCHER'] = launcher
+
+    return results
+
+
+'''
+request-to-running and request-to-batch-init percentiles of each
+launcher from stored tracker timelines
+'''
+def launch_timelines(store: str):
+    from tracker import get_timeline_store, summarize_by_launcher
+    return summarize_by_launcher(get_timeline_store(store).all())
+
+
+'''
+allocations made by warm invocations, with the top allocation sites
+'''
+def bench_allocations(fake: FakeAws, event: dict, iterations: int):
+    from cfn_launch import lambda_handler
+
+    tracemalloc.start(10)
+    before = tracemalloc.take_snapshot()
+    for _ in range(iterations):
+        lambda_handler(event, None)
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, 'lineno')
+    return {
+        'peak_kb': peak / 1024,
+        'net_kb_per_invocation': sum(s.size_diff for s in stats) / 1024 / iterations,
+        'top_sites': [{ 'site': str(s.traceback[0]), 'kb': s.size_diff / 1024 } for s in stats[:5]]
+    }
+
+
+'''
+import and a single invocation in a fresh interpreter
+'''
+def cold_invocation(latency_ms: float, event_file: str):
+    start = time.perf_counter()
+    import cfn_launch
+    imported = time.perf_counter()
+
+    fake = install_fakes(latency_ms)
+    elapsed, calls = timed(fake, cfn_launch.lambda_handler, load_event(event_file), None)
+    return {
+        'import_ms': (imported - start) * 1000,
+        'first_invoke_ms': elapsed,
+        'calls_per_invocation': sum(calls.values())
+    }
+
+
+def bench_cold(latency_ms: float, event_file: str, runs: int):
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, __file__, '--cold',
+            '--latency-ms', str(latency_ms), '--event', event_file],
+            capture_output = True, check = True, text = True)
+        samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    return {
+        'import_ms': statistics.median(s['import_ms'] for s in samples),
+        'first_invoke_ms': statistics.median(s['first_invoke_ms'] for s in samples),
+        'calls_per_invocation': samples[-1]['calls_per_invocation']
+    }
+
+
+def git_revision():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True)
+        return out.stdout.strip() or 'unknown'
+    except Exception:
+        return 'unknown'
+
+
+'''
+save the results and return the previous run for comparison
+'''
+def store_results(results: dict):
+    os.makedirs(RESULTS_DIR, exist_ok = True)
+    previous = sorted(f for f in os.listdir(RESULTS_DIR) if f.endswith('.json'))
+
+    stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+    path = os.path.join(RESULTS_DIR, f"{stamp}-{results['revision']}.json")
+    with open(path, 'w') as out:
+        json.dump(results, out, indent = 2)
+
+    if not previous:
+        return path, None
+
+    with open(os.path.join(RESULTS_DIR, previous[-1]), 'r') as prev:
+        return path, json.load(prev)
+
+
+'''
+percent change of the headline metrics against the previous run
+'''
+def compare(current: dict, previous: dict):
+    metrics = [
+        ('handler.median_ms', lambda r: r['handler']['median_ms']),
+        ('handler.calls_per_invocation', lambda r: r['handler']['calls_per_invocation']),
+        ('cold.import_ms', lambda r: r['cold']['import_ms']),
+        ('cold.first_invoke_ms', lambda r: r['cold']['first_invoke_ms']),
+        ('allocations.peak_kb', lambda r: r['allocations']['peak_kb'])
+    ] + [(f'launchers.{l}.median_ms', lambda r, l = l: r['launchers'][l]['median_ms']) for l in current.get('launchers', {})] \
+      + [(f'timelines.{l}.instance_running.p50', lambda r, l = l: r['timelines'][l]['instance_running']['p50'])
+        for l in current.get('timelines', {})] + [(f'methods.{m}.median_ms', lambda r, m = m: r['methods'][m]['median_ms']) for m in current['methods']]
+
+    lines = [f"Compared to {previous['revision']} ({previous['timestamp']})"]
+    for name, get in metrics:
+        try:
+            before, after = get(previous), get(current)
+        except KeyError:
+            continue
+
+        change = (after - before) / before * 100 if before else 0.0
+        lines.append(f'  {name:<45} {before:>10.2f} -> {after:>10.2f} ({change:+.1f}%)')
+
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark lambda_handler and the CFN helpers')
+    parser.add_argument('--iterations', type = int, default = 50)
+    parser.add_argument('--cold-runs', type = int, default = 5)
+    parser.add_argument('--latency-ms', type = float, default = 0.0, help = 'Latency injected into every AWS call.')
+    parser.add_argument('--event', default = 's3-object-created.json', help = 'Event file in lambda/tests/resources.')
+    parser.add_argument('--no-store', action = 'store_true', help = 'Do not save or compare results.')
+    parser.add_argument('--timelines', help = 'Tracker timeline store to compare launcher latency from.')
+    parser.add_argument('--cold', action = 'store_true', help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cold:
+        print(json.dumps(cold_invocation(args.latency_ms, args.event)))
+        sys.exit(0)
+
+    results = {
+        'revision': git_revision(),
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'latency_ms': args.latency_ms,
+        'iterations': args.iterations,
+        'event': args.event,
+        'cold': bench_cold(args.latency_ms, args.event, args.cold_runs)
+    }
+
+    fake = install_fakes(args.latency_ms)
+    event = load_event(args.event)
+    results['handler'] = bench_handler(fake, event, args.iterations)
+    results['methods'] = bench_methods(fake, args.iterations)
+    results['allocations'] = bench_allocations(fake, event, args.iterations)
+    results['launchers'] = bench_launchers(fake, event, args.iterations)
+    if args.timelines:
+        results['timelines'] = launch_timelines(args.timelines)
+
+    print(json.dumps(results, indent = 2))
+
+    if not args.no_store:
+        path, previous = store_results(results)
+        print(f'Results saved to {path}')
+        if previous:
+            print(compare(results, previous))
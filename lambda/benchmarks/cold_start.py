@@ -0,0 +1,62 @@
+import sys, os
+import json, statistics
+import subprocess
+import argparse
+
+'''
+measure a lambda cold start in a fresh interpreter: importing the
+handler module, then the client construction that either happens in
+the init phase (AWS_LAMBDA_FUNCTION_NAME set) or on the first invocation
+'''
+PROBE = '''
+import sys, time, json
+sys.path.insert(0, './lambda/src')
+
+start = time.perf_counter()
+import cfn_launch
+imported = time.perf_counter()
+
+import cfn
+cfn.initialize_clients()
+initialized = time.perf_counter()
+
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'first_invoke_clients_ms': (initialized - imported) * 1000,
+    'yaml_imported': 'yaml' in sys.modules
+}))
+'''
+
+
+def run_probe(lambda_init: bool):
+    env = dict(os.environ, AWS_DEFAULT_REGION = 'us-east-1', LOGGING_LEVEL = 'ERROR')
+    env.pop('AWS_LAMBDA_FUNCTION_NAME', None)
+    if lambda_init:
+        env['AWS_LAMBDA_FUNCTION_NAME'] = 'cold-start-probe'
+
+    out = subprocess.run([sys.executable, '-c', PROBE], env = env,
+        capture_output = True, check = True, text = True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+'''
+median of each measurement over several fresh interpreters
+'''
+def measure(lambda_init: bool, runs: int):
+    samples = [run_probe(lambda_init) for _ in range(runs)]
+    return {
+        'import_ms': statistics.median(s['import_ms'] for s in samples),
+        'first_invoke_clients_ms': statistics.median(s['first_invoke_clients_ms'] for s in samples),
+        'yaml_imported': any(s['yaml_imported'] for s in samples)
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Lambda import and cold start timing')
+    parser.add_argument('--runs', type = int, default = 7)
+    args = parser.parse_args()
+
+    print(json.dumps({
+        'local': measure(False, args.runs),
+        'lambda_init': measure(True, args.runs)
+    }, indent = 2))
@@ -0,0 +1,119 @@
+import io, time
+import datetime, threading
+
+from botocore.awsrequest import AWSResponse
+from botocore.response import StreamingBody
+from botocore.exceptions import ClientError
+
+'''
+In-process AWS fake for benchmarks.  Hooks before-call on botocore
+clients, the same extension point Stubber uses, but answers by
+operation name so the call sequence may vary between invocations
+(cache hits, retries).  Every call sleeps the injected latency and is
+counted per service and operation.
+'''
+class FakeAws(object):
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency = latency_ms / 1000.0
+        self.responses = {}
+        self.calls = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    '''
+    answer service.operation with response, or a callable returning it
+    '''
+    def respond(self, service: str, operation: str, response):
+        self.responses[f'{service}.{operation}'] = response
+        return self
+
+    '''
+    intercept every call made by the client
+    '''
+    def attach(self, client):
+        service = client.meta.service_model.service_name
+        client.meta.events.register_first(f'before-parameter-build.{service}.*', self.__capture)
+        client.meta.events.register(f'before-call.{service}.*', self.__handle)
+        return client
+
+    def reset_calls(self):
+        self.calls = {}
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    '''
+    before-call only sees the serialized request, keep the api parameters
+    '''
+    def __capture(self, params, **kwargs):
+        self.local.params = dict(params)
+
+    def __handle(self, model, **kwargs):
+        params = self.local.params
+        name = f'{model.service_model.service_name}.{model.name}'
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if not name in self.responses:
+            raise Exception(f'No fake response for {name}')
+
+        response = self.responses[name]
+        parsed = response(params) if callable(response) else response
+        return AWSResponse(None, 200, {}, None), parsed
+
+
+'''
+GetObject response with a fresh streaming body
+'''
+def object_response(body: bytes, etag: str = '"0"'):
+    return lambda params: {
+        'Body': StreamingBody(io.BytesIO(body), len(body)),
+        'ETag': etag,
+        'ContentLength': len(body)
+    }
+
+
+'''
+GetParameter response, only event-data exists in the namespace
+'''
+def get_parameter_response(params):
+    if not params['Name'].endswith('event-data'):
+        raise ClientError({ 'Error': { 'Code': 'ParameterNotFound' } }, 'GetParameter')
+
+    return { 'Parameter': { 'Name': params['Name'], 'Value': 's3://bucket/data.csv', 'Version': 1 } }
+
+
+'''
+canned responses for every call the launch path makes
+'''
+def launch_responses(fake: FakeAws, template: bytes, params_yml: bytes):
+    created = datetime.datetime(2020, 1, 1, tzinfo = datetime.timezone.utc)
+
+    fake.respond('s3', 'GetObject', lambda params: object_response(
+        template if params['Key'] != 'params.yml' else params_yml)(params))
+    fake.respond('ssm', 'GetParametersByPath', lambda params: { 'Parameters': [
+        { 'Name': f"{params['Path']}event-data", 'Value': 's3://bucket/data.csv', 'Version': 1 }] })
+    fake.respond('ssm', 'PutParameter', { 'Version': 1 })
+    fake.respond('ssm', 'GetParameter', get_parameter_response)
+    fake.respond('s3', 'HeadObject', { 'ContentLength': 64 * 1024 * 1024, 'ETag': '"0"',
+        'ResponseMetadata': { 'HTTPHeaders': { 'x-amz-bucket-region': 'us-east-1' } } })
+    fake.respond('cloudformation', 'CreateStack', lambda params: {
+        'StackId': f"arn:aws:cloudformation:us-east-1:000000000000:stack/{params['StackName']}/0" })
+    fake.respond('cloudformation', 'DescribeStacks', lambda params: { 'Stacks': [{
+        'StackName': params['StackName'].split('/')[1] if params['StackName'].startswith('arn:') else params['StackName'],
+        'StackId': params['StackName'],
+        'CreationTime': created,
+        'StackStatus': 'CREATE_IN_PROGRESS' }] })
+    fake.respond('cloudformation', 'ValidateTemplate', { 'Parameters': [] })
+    fake.respond('s3', 'PutObject', { 'ETag': '"0"' })
+    fake.respond('s3', 'CopyObject', { 'CopyObjectResult': { 'ETag': '"0"' } })
+    fake.respond('s3', 'DeleteObject', {})
+    fake.respond('ec2', 'RunInstances', { 'Instances': [{
+        'InstanceId': 'i-00000000',
+        'LaunchTime': created,
+        'State': { 'Name': 'pending' } }] })
+    return fake
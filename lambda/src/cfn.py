@@ -1,9 +1,12 @@
 import sys, os, uuid
-import json, yaml, base64
-import logging
+import json, base64, hashlib
+import logging, threading
 
-import boto3
+import boto3, copy, time
 from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from metrics import api_metrics
 
 '''
 initialize logger
@@ -17,32 +20,118 @@ def initialize_logger(name: str = __name__):
 logger = initialize_logger()
 clients = {}
 
+# boto3's default session is not thread-safe during client creation
+client_lock = threading.Lock()
+
+# event-data extensions batch-init decompresses, see batch-init.py
+COMPRESSED_EXTENSIONS = { '.gz': 'gzip', '.bz2': 'bzip2', '.zst': 'zstd' }
+
 
 '''
-create a boto client instance.
+create a boto client instance.  every client reports its calls
+to api_metrics
 '''
 def get_client(name: str, region: str = 'us-east-1', proxies: dict = None):
-    if not name in clients:
-        clients[name] = boto3.client(name, config = Config(
-            proxies = proxies,
-            region_name = region,
-            retries = { 'max_attempts': 5 }
-        ))
+    with client_lock:
+        if not name in clients:
+            clients[name] = api_metrics.instrument(boto3.client(name, config = Config(
+                proxies = proxies,
+                region_name = region,
+                retries = { 'max_attempts': 5 }
+            )))
 
     return clients[name]
 
 
+'''
+construct the clients used on every invocation.  called at import
+in the lambda so construction happens during the init phase
+'''
+def initialize_clients():
+    get_client('s3')
+    get_client('ssm')
+    get_client('cloudformation')
+
+
+'''
+parse yaml, importing the parser on first use to keep it off the
+import path of the lambda
+'''
+def load_yaml(body: str):
+    import yaml
+    return yaml.load(body, Loader = yaml.FullLoader)
+
+
+'''
+parse a cloudformation template.  the short form intrinsic functions
+are not standard yaml, each becomes its long form: !Ref X is
+{ 'Ref': 'X' }, !GetAtt a.b is { 'Fn::GetAtt': 'a.b' }
+'''
+def load_template(body: str):
+    import yaml
+
+    class TemplateLoader(yaml.SafeLoader):
+        pass
+
+    def intrinsic(loader, suffix, node):
+        if isinstance(node, yaml.ScalarNode):
+            value = loader.construct_scalar(node)
+        elif isinstance(node, yaml.SequenceNode):
+            value = loader.construct_sequence(node, deep = True)
+        else:
+            value = loader.construct_mapping(node, deep = True)
+
+        return { 'Ref' if suffix == 'Ref' else f'Fn::{suffix}': value }
+
+    TemplateLoader.add_multi_constructor('!', intrinsic)
+    return yaml.load(body, Loader = TemplateLoader)
+
+
+'''
+replace every { 'Ref': name } in value with the parameter value
+'''
+def resolve_refs(value, parameters: dict):
+    if isinstance(value, dict):
+        if list(value.keys()) == ['Ref']:
+            if not value['Ref'] in parameters:
+                raise Exception(f"Unable to resolve !Ref {value['Ref']} without CloudFormation.")
+            return parameters[value['Ref']]
+        return { k: resolve_refs(v, parameters) for k, v in value.items() }
+
+    if isinstance(value, list):
+        return [resolve_refs(v, parameters) for v in value]
+
+    return value
+
 '''
 verify that certain parameters already exist in the
-namespace
+namespace.  returns its parameters by name, so the launch
+reads them without further calls
 '''
 def verify_namespace(cfn, namespace: str):
     logger.info(f'Verifying namespace: {namespace}...')
 
     # fail if no params, especially event-data
-    if not cfn.verify_namespace(namespace):
+    params = cfn.verify_namespace(namespace)
+    if not params or not 'event-data' in params:
         raise Exception(f'{namespace} exists, but event-data was not found.')
 
+    return params
+
+
+'''
+the compression of the namespace event-data, as batch-init detects
+it: the content-encoding param, otherwise the file extension.  None
+when it is plain
+'''
+def get_event_data_encoding(params: dict):
+    encoding = params.get('content-encoding')
+    if encoding:
+        return None if encoding in ('none', 'identity') else encoding
+
+    extension = os.path.splitext(params.get('event-data', ''))[1]
+    return COMPRESSED_EXTENSIONS.get(extension)
+
 
 '''
 make sure we accept the file extension or fail
@@ -63,35 +152,162 @@ def get_lambda_event_data(event_file: str):
         return json.load(data)
 
 
+'''
+split size bytes into contiguous [start, end) ranges of about
+shard_bytes each, at most max_shards.  one range means no fan-out
+'''
+def plan_byte_ranges(size: int, shard_bytes: int, max_shards: int):
+    count = max(1, min(max_shards, -(-size // shard_bytes)))
+    return [[size * i // count, size * (i + 1) // count] for i in range(count)]
+
+
+'''
+S3 object cache that lives at module level so it survives warm
+lambda invocations.  Entries are served without a request until
+the ttl expires, then revalidated with a conditional GetObject
+(If-None-Match) so unchanged objects are neither downloaded nor
+parsed again.
+'''
+class S3ObjectCache(object):
+
+    def __init__(self, ttl: float = 300.0):
+        self.ttl = ttl
+        self.entries = {}
+        self.stats = { 'hits': 0, 'misses': 0, 'revalidations': 0 }
+        self.lock = threading.Lock()
+
+
+    '''
+    return the (optionally parsed) body of bucket/key.  parse is
+    applied once per downloaded version of the object
+    '''
+    def get(self, s3, bucket: str, key: str, parse = None):
+        cache_key = (bucket, key)
+
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry and time.monotonic() - entry['fetched'] < self.ttl:
+                self.stats['hits'] += 1
+                logger.debug('Cache hit for %s/%s', bucket, key)
+                return entry['value']
+
+        request = { 'Bucket': bucket, 'Key': key }
+        if entry:
+            request['IfNoneMatch'] = entry['etag']
+
+        try:
+            logger.debug('Retrieving S3 object body from %s/%s', bucket, key)
+            obj = s3.get_object(**request)
+
+        except ClientError as e:
+            if not entry or e.response['Error']['Code'] not in ('304', 'NotModified'):
+                raise e
+
+            # unchanged since the last download, extend the ttl
+            with self.lock:
+                entry['fetched'] = time.monotonic()
+                self.stats['revalidations'] += 1
+                self.stats['hits'] += 1
+
+            logger.debug('Cache revalidated %s/%s (%s)', bucket, key, entry['etag'])
+            return entry['value']
+
+        body = obj['Body'].read().decode('utf-8')
+        value = parse(body) if parse else body
+
+        with self.lock:
+            self.stats['misses'] += 1
+            self.entries[cache_key] = {
+                'etag': obj.get('ETag'),
+                'value': value,
+                'fetched': time.monotonic()
+            }
+
+        return value
+
+
+    '''
+    drop every entry and reset the counters
+    '''
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.stats = { 'hits': 0, 'misses': 0, 'revalidations': 0 }
+
+
+object_cache = S3ObjectCache(float(os.getenv('CFN_CACHE_TTL', 300)))
+
+# parsed templates by content hash, the body is only parsed once per version
+template_cache = {}
+
+
+'''
+a created stack, from its DescribeStacks description.  clients are
+thread-safe where boto3 resources are not, so create_stack returns
+this in place of a Stack resource
+'''
+class StackLaunch(object):
+
+    def __init__(self, stack: dict):
+        self.stack_name = stack['StackName']
+        self.stack_id = stack['StackId']
+        self.stack_status = stack['StackStatus']
+        self.stack_status_reason = stack.get('StackStatusReason')
+        self.creation_time = stack['CreationTime']
+
+
+'''
+a RunInstances launch with the attributes of a StackLaunch, so
+callers treat both launches alike
+'''
+class InstanceLaunch(object):
+
+    def __init__(self, name: str, instance: dict):
+        self.stack_name = name
+        self.instance_id = instance['InstanceId']
+        self.stack_status = instance['State']['Name'].upper()
+        self.stack_status_reason = f"Instance {instance['InstanceId']} requested with RunInstances"
+        self.creation_time = instance['LaunchTime']
+
+
+
 class CFN(object):
 
-    def __init__(self, cfn_bucket: str, cfn_key: str):
+    def __init__(self, cfn_bucket: str, cfn_key: str, registry = None):
         self.cfn_bucket = cfn_bucket
         self.cfn_key = cfn_key
+        self.registry = registry
 
 
     '''
-    check for the existence of parameters at a particular
-    namespace.  fail if none are present
+    read the parameters of a namespace, keyed by the name below it.
+    nested namespaces are not read.  empty when none are present
     '''
     def verify_namespace(self, namespace: str):
         logger.info('Checking existence of event-data in %s parameters', namespace)
 
         try:
             ssm = get_client('ssm')
-            response = ssm.get_parameters_by_path(
-                Path = namespace,
-                Recursive = False,
-                WithDecryption = False
-            )
+            params, token = {}, None
+            while True:
+                response = ssm.get_parameters_by_path(
+                    Path = namespace,
+                    Recursive = False,
+                    WithDecryption = False,
+                    **({ 'NextToken': token } if token else {})
+                )
+
+                for param in response['Parameters']:
+                    params[param['Name'].rpartition('/')[2]] = param['Value']
+
+                token = response.get('NextToken')
+                if not token:
+                    break
 
             # event-data needs to exist, at least
-            for param in response['Parameters']:
-                if param['Name'].endswith('event-data'):
-                    logger.info('%s parameter found.', param['Name'])
-                    return True
-
-            return False
+            if 'event-data' in params:
+                logger.info('event-data parameter found in %s.', namespace)
+            return params
 
         except Exception as e:
             logger.error('Unable to verify namespace parameter (event-data): %s', e)
@@ -102,12 +318,25 @@ class CFN(object):
     get relevant event info
     '''
     def get_event_info(self, event):
-        s3 = event['Records'][0]['s3']
-        bucket = s3['bucket']['name']
-        key = s3['object']['key']
+        return self.get_event_records(event)[0]
+
+
+    '''
+    get the bucket and key of every record in the event.  S3
+    may batch several object notifications into one event.  with
+    etag the object ETag is added to each record
+    '''
+    def get_event_records(self, event, etag: bool = False):
+        records = []
+        for record in event['Records']:
+            s3 = record['s3']
+            bucket = s3['bucket']['name']
+            key = s3['object']['key']
+
+            logger.info(f'Pulled bucket ({bucket}) and key ({key}) from object event')
+            records.append((bucket, key, s3['object'].get('eTag')) if etag else (bucket, key))
 
-        logger.info(f'Pulled bucket ({bucket}) and key ({key}) from object event')
-        return bucket, key
+        return records
 
 
     '''
@@ -136,6 +365,35 @@ class CFN(object):
         return response
 
 
+    '''
+    get the size of the event-data object at resource
+    '''
+    def get_event_data_size(self, resource: str):
+        path = resource.replace('s3://', '')
+        bucket, _, key = path.partition('/')
+        head = get_client('s3').head_object(Bucket = bucket, Key = key)
+
+        logger.info(f'event-data {resource} is {head["ContentLength"]} bytes')
+        return head['ContentLength']
+
+
+    '''
+    put the byte range shard plan read by each fan-out instance.  the
+    ranges are raw, batch-init aligns them to line boundaries
+    '''
+    def put_shard_plan(self, namespace: str, ranges: list):
+        sep = '/' if not namespace[-1:] == '/' else ''
+        param_path = f'{namespace}{sep}shard-plan'
+
+        logger.info('Putting shard-plan parameter: %s (%d shards)', param_path, len(ranges))
+        return get_client('ssm').put_parameter(
+            Name = param_path,
+            Value = json.dumps({ 'ranges': ranges }),
+            Type = 'String',
+            Overwrite = True
+        )
+
+
     '''
     return the name of the cloudformation stack.  Uses
     the event object name after dropping the suffix
@@ -181,7 +439,7 @@ class CFN(object):
 
         # load the string body as yaml
         yaml_body = self.get_object_body(params_path)
-        return yaml.load(yaml_body, Loader = yaml.FullLoader)
+        return load_yaml(yaml_body)
 
 
     '''
@@ -190,46 +448,83 @@ class CFN(object):
     '''
     def get_template_body_as_string(self):
         s3 = get_client('s3')
-        return self.__get_s3_object_body(s3, self.cfn_bucket, self.cfn_key)
+        return object_cache.get(s3, self.cfn_bucket, self.cfn_key)
 
 
     '''
-    return parameters to inject into the template in a yaml format
+    return parameters to inject into the template in a yaml format.
+    the cached list is copied so callers can extend it freely
     '''
     def get_template_params_as_yaml(self):
         s3 = get_client('s3')
-        params_str = self.__get_s3_object_body(s3, self.cfn_bucket, 'params.yml')
-        return yaml.load(params_str, Loader = yaml.FullLoader)
+        params = object_cache.get(s3, self.cfn_bucket, 'params.yml', load_yaml)
+        return copy.deepcopy(params)
 
 
     '''
-    Get the body of an object stored in S3.  Uniformly log the event.
+    get the install commands for a boot profile.
+      standard  - yum update and install everything from the public repositories
+      prebaked  - the image already has java, python3, boto3 and requests
+      wheelhouse - install from rpms and wheels stored in the cloudformation
+                   bucket under boot/, without repository or index lookups
     '''
-    def __get_s3_object_body(self, s3, bucket: str, key: str):
-        logger.debug('Retrieving S3 object body from %s/%s', bucket, key)
-        obj = s3.get_object(Bucket = bucket, Key = key)
-        return obj['Body'].read().decode('utf-8')
+    def get_boot_commands(self, profile: str, batch_dir: str):
+        bucket_path = self.cfn_bucket
+
+        if profile == 'standard':
+            return [
+                ('yum-update', 'yum update -y'),
+                ('install-java', 'yum install -y java-1.8.0'),
+                ('install-python', 'yum install -y python3'),
+                ('install-packages', 'python3 -m pip install boto3 requests zstandard')
+            ]
+
+        if profile == 'prebaked':
+            return []
+
+        if profile == 'wheelhouse':
+            return [
+                ('fetch-boot-cache', f'aws s3 cp --recursive s3://{bucket_path}/boot/ {batch_dir}/boot/'),
+                ('install-rpms', f'yum localinstall -y --disablerepo=* {batch_dir}/boot/rpms/*.rpm'),
+                ('install-packages', f'python3 -m pip install --no-index --find-links {batch_dir}/boot/wheelhouse boto3 requests zstandard')
+            ]
+
+        raise Exception(f'Unknown boot profile {profile}.')
 
 
     '''
-    get ec2-userdata to add into the cloudformation create request
+    get ec2-userdata to add into the cloudformation create request.  every
+    phase appends a timestamp to boot-timeline so boot-to-process latency
+    can be compared between profiles.  with a pool path the instance joins
+    the worker pool after its first job.  a fan-out instance is told which
+    range of the shard-plan it processes
     '''
-    def get_user_data(self, namespace):
+    def get_user_data(self, namespace, profile: str = None, pool_path: str = None, shard_index: int = None):
         batch_dir = '/batch-processing'
         bucket_path = self.cfn_bucket
+        profile = profile or os.getenv('BOOT_PROFILE', 'standard')
+
+        def mark(phase: str):
+            return f'echo "$(date +%s.%N) $(cut -d\' \' -f1 /proc/uptime) {phase}" >> {batch_dir}/boot-timeline'
 
         userdata = ['#!/bin/sh',
-            f'yum update -y',
             f'mkdir -p {batch_dir} && cd {batch_dir} && touch {batch_dir}/namespace',
+            f'echo profile={profile} > {batch_dir}/boot-timeline',
+            mark('userdata-start'),
             f'echo namespace={namespace} >> {batch_dir}/namespace',
+            f'echo shard={shard_index} > {batch_dir}/shard' if shard_index is not None else f'rm -f {batch_dir}/shard',
             f'aws s3 cp s3://{bucket_path}/batch-init.py {batch_dir}',
-            f'yum install -y java-1.8.0',
-            f'yum install -y python3',
-            f'python3 -m pip install boto3',
-            f'python3 -m pip install requests',
-            f'python3 batch-init.py &'
+            mark('fetch-batch-init')
         ]
 
+        for phase, command in self.get_boot_commands(profile, batch_dir):
+            userdata.extend([command, mark(phase)])
+
+        if pool_path:
+            userdata.append(f'python3 batch-init.py --pool {pool_path} &')
+        else:
+            userdata.append(f'python3 batch-init.py &')
+
         stringified = '\n'.join(userdata)
         logger.info('Generating instance UserData: %s', stringified)
         encoded_userdata = base64.b64encode(stringified.encode('utf-8'))
@@ -238,21 +533,26 @@ class CFN(object):
 
     '''
     initialize a cloudformation client and make a request to
-    create the stack/resources
+    create the stack/resources.  with a template registry the
+    stack is created from the registered TemplateURL
     '''
-    def create_stack(self, stack_name: str, template_body: str, template_parameters: []):
+    def create_stack(self, stack_name: str, template_body: str, template_parameters: [], client_request_token: str = None):
         logger.debug(f'Stringified template body\n{template_body}')
         logger.debug(f'Template parameters\n{template_parameters}')
 
-        #create a client token for retries, etc.
-        client_reqest_token = uuid.uuid4().hex
+        #create a client token for retries, etc.  a token derived from
+        #the event makes a redelivered launch the same request
+        client_reqest_token = client_request_token or uuid.uuid4().hex
 
-        # initialize CFN client here
+        template = { 'TemplateURL': self.registry.register(template_body) } if self.registry \
+            else { 'TemplateBody': template_body }
+
+        # the client is shared between invocations and record threads
         logger.info(f'Creating stack named {stack_name}...')
-        cfn = boto3.resource('cloudformation')
+        cfn = get_client('cloudformation')
         stack_response = cfn.create_stack(
             StackName = stack_name,
-            TemplateBody = template_body,
+            **template,
             Parameters = template_parameters,
             TimeoutInMinutes = 15,
             OnFailure = 'DELETE',
@@ -264,4 +564,56 @@ class CFN(object):
         )
 
         logger.info(f'Stack creation returned the following response: {stack_response}')
-        return stack_response
\ No newline at end of file
+        stack = cfn.describe_stacks(StackName = stack_response['StackId'])['Stacks'][0]
+        return StackLaunch(stack)
+
+
+    '''
+    the properties of the instance resource in the template with every
+    !Ref resolved from the stack parameters or the parameter defaults.
+    this is what CloudFormation would send to EC2 for the stack
+    '''
+    def get_instance_definition(self, template_body: str, template_parameters: list,
+            resource: str = 'BatchProcessingInstance'):
+        digest = hashlib.sha256(template_body.encode('utf-8')).hexdigest()
+        if not digest in template_cache:
+            template_cache[digest] = load_template(template_body)
+        template = template_cache[digest]
+
+        parameters = { name: str(p['Default']) for name, p in template.get('Parameters', {}).items() if 'Default' in p }
+        parameters.update({ p['ParameterKey']: p['ParameterValue'] for p in template_parameters })
+
+        return resolve_refs(template['Resources'][resource]['Properties'], parameters)
+
+
+    '''
+    launch the template's instance with a single RunInstances request,
+    no stack is created.  the client token makes a retried request
+    return the instance of the first one
+    '''
+    def run_instance(self, instance_name: str, template_body: str, template_parameters: list,
+            client_request_token: str = None):
+        definition = self.get_instance_definition(template_body, template_parameters)
+        profile = definition.get('IamInstanceProfile')
+
+        request = {
+            'ImageId': definition['ImageId'],
+            'InstanceType': definition['InstanceType'],
+            'KeyName': definition.get('KeyName'),
+            'SubnetId': definition.get('SubnetId'),
+            'SecurityGroupIds': definition.get('SecurityGroupIds'),
+            'IamInstanceProfile': ({ 'Arn': profile } if profile.startswith('arn:') else { 'Name': profile }) if profile else None,
+            # boto3 base64 encodes UserData itself
+            'UserData': base64.b64decode(definition['UserData']).decode('utf-8') if definition.get('UserData') else None,
+            'TagSpecifications': [{ 'ResourceType': 'instance', 'Tags': definition['Tags'] }] if definition.get('Tags') else None,
+            'MinCount': 1,
+            'MaxCount': 1,
+            'ClientToken': (client_request_token or uuid.uuid4().hex)[:64]
+        }
+
+        logger.info(f'Running instance named {instance_name}...')
+        response = get_client('ec2').run_instances(**{ k: v for k, v in request.items() if v })
+
+        launch = InstanceLaunch(instance_name, response['Instances'][0])
+        logger.info(f'RunInstances returned {launch.instance_id} ({launch.stack_status})')
+        return launch
@@ -1,65 +1,308 @@
-import sys, os
-import argparse, logging
+import os
 import json
-import uuid
+import datetime, time
 
-import boto3
-from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 
 from cfn import CFN
-from cfn import verify_namespace, check_key_or_fail, get_lambda_event_data
-from cfn import initialize_logger
+from cfn import verify_namespace, check_key_or_fail, get_lambda_event_data, get_event_data_encoding
+from cfn import initialize_logger, initialize_clients, object_cache, plan_byte_ranges
+from metrics import api_metrics
+from pool import get_worker_pool
+from idempotency import get_launch_index, get_dedupe_key, get_client_request_token
+from sizing import get_instance_sizer
+from tracker import start_tracking
+from registry import get_template_registry
 
 logger = initialize_logger()
 
+# build clients during the lambda init phase rather than the first invocation
+if os.getenv('AWS_LAMBDA_FUNCTION_NAME'):
+    initialize_clients()
+
+
+LAUNCHERS = ['cloudformation', 'ec2']
+
 
 '''
-lambda entrypoint
+the launcher of a namespace: its launcher parameter, otherwise
+LAUNCHER.  cloudformation creates a stack, ec2 runs the template's
+instance directly
 '''
-def lambda_handler(event, context):
+def get_launcher(namespace: str, params: dict):
+    launcher = params.get('launcher') or os.getenv('LAUNCHER', 'cloudformation')
+    if not launcher in LAUNCHERS:
+        raise Exception(f'Unknown launcher {launcher} for {namespace}.')
+
+    return launcher
+
+
+'''
+create one instance stack and start tracking it.  the parameter
+list is copied so each stack gets its own name, userdata and,
+when sized, instance type.  a dedupe key makes the request token
+the same for every delivery of the event.  the ec2 launcher runs
+the same instance without a stack
+'''
+def launch_stack(cfn: CFN, stack_name: str, namespace: str, template_body_str: str, template_params: list,
+        pool_path: str = None, shard_index: int = None, instance_type: str = None, dedupe_key: str = None,
+        launcher: str = 'cloudformation'):
+    # append the stack name as the Name tag on the EC2 instance
+    instance_userdata = cfn.get_user_data(namespace, pool_path = pool_path, shard_index = shard_index)
+    template_parameters = list(template_params)
+    if instance_type:
+        template_parameters = [p for p in template_parameters if p['ParameterKey'] != 'InstanceType']
+        template_parameters.append({ 'ParameterKey': 'InstanceType', 'ParameterValue': instance_type })
+
+    template_parameters.extend([
+        { 'ParameterKey': 'InstanceName', 'ParameterValue': stack_name },
+        { 'ParameterKey': 'InstanceUserData', 'ParameterValue': instance_userdata }
+    ])
+
+    # execute the client request to create
+    requested = time.time()
+    token = get_client_request_token(dedupe_key, stack_name) if dedupe_key else None
+    if launcher == 'ec2':
+        cfn_response = cfn.run_instance(stack_name, template_body_str, template_parameters, token)
+        instance_id, stack_id = cfn_response.instance_id, None
+    else:
+        cfn_response = cfn.create_stack(stack_name, template_body_str, template_parameters, token)
+        instance_id, stack_id = None, cfn_response.stack_id
+
+    # follow the stack to the batch-init start in the background
+    start_tracking(stack_name, namespace, requested, instance_id, stack_id, shard_index)
+
+    return {
+        'stack_name': stack_name,
+        'stack_status': cfn_response.stack_status,
+        'stack_status_reason': cfn_response.stack_status_reason,
+        'creation_time': cfn_response.creation_time.strftime("%m/%d/%Y, %H:%M:%S")
+    }
+
+
+'''
+the byte range shard plan for an event-data of size bytes, None when
+fan-out is off (FANOUT_SHARD_MB unset), the input fits in one shard or
+is compressed.  a compressed object is read whole by the first shard,
+the others would idle
+'''
+def get_fanout_ranges(namespace: str, params: dict, size: int):
+    shard_mb = int(os.getenv('FANOUT_SHARD_MB', 0))
+    if shard_mb <= 0 or size is None:
+        return None
+
+    ranges = plan_byte_ranges(size, shard_mb * 1024 * 1024, int(os.getenv('FANOUT_MAX_WORKERS', 10)))
+    if len(ranges) < 2:
+        return None
+
+    encoding = get_event_data_encoding(params)
+    if encoding:
+        logger.info(f'Not fanning out {namespace}, {encoding} event-data cannot be split')
+        return None
+
+    return ranges
+
+
+'''
+HEAD the namespace event-data when sizing or fan-out needs its size.
+None when neither is on or the size could not be read; the launch
+then falls back to the template default
+'''
+def get_event_data_size(cfn: CFN, namespace: str, params: dict, sizer):
+    if not sizer and int(os.getenv('FANOUT_SHARD_MB', 0)) <= 0:
+        return None
+
     try:
-        cloudform_bucket = os.getenv('CLOUDFORM_BUCKET', None)
-        cloudform_key = os.getenv('CLOUDFORM_KEY', None)
-        if None in (cloudform_bucket, cloudform_key):
-            raise Exception('Cloudformation resources must exist to proceed.')
+        return cfn.get_event_data_size(params['event-data'])
 
-        # there could be multiple records...
-        # stackname will be the object creating the event
-        cfn = CFN(cloudform_bucket, cloudform_key)
-        bucket, key = cfn.get_event_info(event)
+    except Exception as e:
+        logger.warning(f'Unable to size event-data in {namespace}: {e}')
+        return None
+
+
+'''
+choose the instance type for size bytes of input and log why.  None
+keeps the template default
+'''
+def get_instance_type(sizer, stack_name: str, size: int, override: str = None):
+    if not sizer or (size is None and not override):
+        return None
+
+    instance_type, rationale = sizer.select(size or 0, override)
+    logger.info(f'Instance type {instance_type} for {stack_name}: {rationale}')
+    return instance_type
+
+
+'''
+launch a stack for a single bucket/key record.  template body
+and parameters are shared between records.  the instance type
+follows the input size.  a large input fans out to one stack per
+shard; otherwise, with a worker pool, an idle worker takes the job
+and no stack is created
+'''
+def launch_record(cfn: CFN, bucket: str, key: str, template_body_str: str, template_params: list,
+        pool = None, dedupe_key: str = None):
+    # fail if not a valid extension
+    check_key_or_fail(key)
+
+    stack_name = cfn.get_name(key)
+    stack_namespace = cfn.get_namespace(bucket, key)
+
+    # fail here if no namespace.  its parameters are read once
+    params = verify_namespace(cfn, stack_namespace)
+
+    # put the event resource param for the instance to download
+    cfn.put_event_resource_param(stack_namespace, bucket, key)
+
+    # input size drives the instance type and fan-out
+    sizer = get_instance_sizer()
+    size = get_event_data_size(cfn, stack_namespace, params, sizer)
+    override = params.get('instance-type') if sizer else None
+
+    launcher = get_launcher(stack_namespace, params)
+
+    # split very large inputs across instances, each reads its own range
+    ranges = get_fanout_ranges(stack_namespace, params, size)
+    if ranges:
+        cfn.put_shard_plan(stack_namespace, ranges)
+
+        def launch_shard(shard_index):
+            shard_name = f'{stack_name}-shard{shard_index}'
+            start, end = ranges[shard_index]
+            return launch_stack(cfn, shard_name, stack_namespace, template_body_str, template_params,
+                shard_index = shard_index, instance_type = get_instance_type(sizer, shard_name, end - start, override),
+                dedupe_key = dedupe_key, launcher = launcher)
+
+        with ThreadPoolExecutor(max_workers = min(len(ranges), 8)) as executor:
+            shards = list(executor.map(launch_shard, range(len(ranges))))
+
+        return {
+            'stack_name': stack_name,
+            'stack_status': 'FAN_OUT',
+            'stack_status_reason': f'{len(shards)} shard stacks',
+            'creation_time': shards[0]['creation_time'],
+            'shards': shards
+        }
+
+    # hand the job to an idle pool worker before creating a stack
+    worker_id = pool.dispatch(stack_namespace) if pool else None
+    if worker_id:
+        return {
+            'stack_name': stack_name,
+            'stack_status': 'DISPATCHED',
+            'stack_status_reason': f'Assigned to pool worker {worker_id}',
+            'creation_time': datetime.datetime.utcnow().strftime("%m/%d/%Y, %H:%M:%S")
+        }
+
+    return launch_stack(cfn, stack_name, stack_namespace, template_body_str, template_params,
+        pool_path = pool.pool_path if pool else None, instance_type = get_instance_type(sizer, stack_name, size, override),
+        dedupe_key = dedupe_key, launcher = launcher)
+
+
+'''
+launch a record at most once per object version.  the record is
+claimed in the launch index by its bucket, key and ETag; a duplicate
+delivery returns the existing launch without touching AWS again.  a
+failed launch releases its claim so a redelivery can retry it
+'''
+def launch_record_once(cfn: CFN, bucket: str, key: str, etag: str, template_body_str: str,
+        template_params: list, pool = None, index = None):
+    if not index or not etag:
+        return launch_record(cfn, bucket, key, template_body_str, template_params, pool)
+
+    # unsupported keys fail before they are claimed
+    check_key_or_fail(key)
+
+    stack_name = cfn.get_name(key)
+    dedupe_key = get_dedupe_key(bucket, key, etag)
+    existing = index.claim(dedupe_key, stack_name)
+    if existing:
+        logger.info(f'Skipping duplicate {bucket}/{key} ({etag}), {existing["state"]} as {existing["stack_name"]}')
+        return {
+            'stack_name': existing['stack_name'],
+            'stack_status': 'DUPLICATE',
+            'stack_status_reason': f'{existing["state"]} for ETag {etag}',
+            'creation_time': datetime.datetime.utcfromtimestamp(existing['updated']).strftime("%m/%d/%Y, %H:%M:%S")
+        }
+
+    try:
+        result = launch_record(cfn, bucket, key, template_body_str, template_params, pool, dedupe_key)
 
-        # fail if not a valid extension
-        check_key_or_fail(key)
+    except Exception as e:
+        index.release(dedupe_key)
+        raise e
+
+    index.complete(dedupe_key, result['stack_name'])
+    return result
 
-        stack_name = cfn.get_name(key)
-        stack_namespace = cfn.get_namespace(bucket, key)
 
-        # fail here if no namespace
-        verify_namespace(cfn, stack_namespace)
+'''
+launch every record in the event with bounded parallelism.  each
+record succeeds or fails on its own and is reported in order.
+records are (bucket, key) or (bucket, key, etag); with a launch
+index, records with an etag are deduplicated
+'''
+def launch_records(cfn: CFN, records: list, template_body_str: str, template_params: list,
+        pool = None, index = None):
+    max_workers = max(1, min(len(records), int(os.getenv('MAX_RECORD_WORKERS', 4))))
+
+    def launch(record):
+        bucket, key, etag = (tuple(record) + (None,))[:3]
+        try:
+            result = launch_record_once(cfn, bucket, key, etag, template_body_str, template_params, pool, index)
+            result.update({ 'bucket': bucket, 'key': key, 'success': True })
+            return result
+
+        except Exception as e:
+            logger.error(f'Launch failed for {bucket}/{key}: {e}')
+            return { 'bucket': bucket, 'key': key, 'success': False, 'error': str(e) }
+
+    logger.info(f'Launching {len(records)} record(s) with {max_workers} worker(s)')
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        return list(executor.map(launch, records))
+
+
+'''
+the CFN helper, template body and parameters shared by every
+record of an invocation
+'''
+def load_launch_config():
+    cloudform_bucket = os.getenv('CLOUDFORM_BUCKET', None)
+    cloudform_key = os.getenv('CLOUDFORM_KEY', None)
+    if None in (cloudform_bucket, cloudform_key):
+        raise Exception('Cloudformation resources must exist to proceed.')
 
-        # put the event resource param for the instance to download
-        cfn.put_event_resource_param(stack_namespace, bucket, key)
+    # stackname will be the object creating the event
+    cfn = CFN(cloudform_bucket, cloudform_key, get_template_registry())
 
-        # get template, parameters, and userdata
-        # append the stack name as the Name tag on the EC2 instance
-        template_body_str = cfn.get_template_body_as_string()
-        instance_userdata = cfn.get_user_data(stack_namespace)
-        template_parameters = cfn.get_template_params_as_yaml()
-        template_parameters.extend([
-            { 'ParameterKey': 'InstanceName', 'ParameterValue': stack_name },
-            { 'ParameterKey': 'InstanceUserData', 'ParameterValue': instance_userdata }
-        ])
+    # get template and parameters once for every record
+    template_body_str = cfn.get_template_body_as_string()
+    template_parameters = cfn.get_template_params_as_yaml()
 
-        # execute the client request to create
-        cfn_response = cfn.create_stack(stack_name, template_body_str, template_parameters)
+    # an invalid template fails before any record is launched
+    if cfn.registry:
+        cfn.registry.register(template_body_str)
+
+    logger.info(f'Template cache stats: {object_cache.stats}')
+    return cfn, template_body_str, template_parameters
+
+
+'''
+lambda entrypoint
+'''
+def lambda_handler(event, context):
+    try:
+        # there could be multiple records...
+        cfn, template_body_str, template_parameters = load_launch_config()
+        records = cfn.get_event_records(event, etag = True)
+
+        results = launch_records(cfn, records, template_body_str, template_parameters,
+            get_worker_pool(), get_launch_index())
+        all_succeeded = all(r['success'] for r in results)
 
         return {
-            'statusCode': 200,
-            'body': json.dumps({
-                'stack_status': cfn_response.stack_status,
-                'stack_status_reason': cfn_response.stack_status_reason,
-                'creation_time': cfn_response.creation_time.strftime("%m/%d/%Y, %H:%M:%S")
-            })
+            'statusCode': 200 if all_succeeded else 400,
+            'body': json.dumps({ 'records': results })
         }
 
     except Exception as e:
@@ -70,6 +313,103 @@ def lambda_handler(event, context):
             'body': 'View application logs for more detail.'
         }
 
+    finally:
+        # one metric line per AWS operation called during the invocation
+        api_metrics.flush(dimensions = { 'Function': 'cfn_launch' })
+
+
+'''
+the S3 event in an SQS message body.  the body is an S3 event or an
+SNS notification wrapping one; s3:TestEvent messages have no records
+'''
+def get_message_event(message: dict):
+    body = json.loads(message['body'])
+    if 'Message' in body and not 'Records' in body:
+        body = json.loads(body['Message'])
+
+    return body if 'Records' in body else { 'Records': [] }
+
+
+'''
+coalesce the S3 records of an SQS batch into one launch per namespace.
+the newest jar of a namespace is launched, and every message with a
+record in the namespace (its data uploads too) shares that launch.
+returns [(record, message_ids)] and the ids of unreadable messages
+'''
+def coalesce_messages(cfn: CFN, messages: list):
+    namespaces = {}
+    unreadable = []
+
+    for message in messages:
+        try:
+            event = get_message_event(message)
+            records = cfn.get_event_records(event, etag = True)
+
+        except Exception as e:
+            logger.error(f'Unable to read message {message["messageId"]}: {e}')
+            unreadable.append(message['messageId'])
+            continue
+
+        for record, s3_record in zip(records, event['Records']):
+            bucket, key, _ = record
+            group = namespaces.setdefault(cfn.get_namespace(bucket, key), { 'jar': None, 'message_ids': [] })
+            if not message['messageId'] in group['message_ids']:
+                group['message_ids'].append(message['messageId'])
+
+            event_time = s3_record.get('eventTime', '')
+            if key.endswith('.jar') and (group['jar'] is None or event_time >= group['jar'][0]):
+                group['jar'] = (event_time, record)
+
+    launches = []
+    for namespace, group in namespaces.items():
+        if group['jar'] is None:
+            logger.info(f'No jar for {namespace} in {len(group["message_ids"])} message(s), nothing to launch')
+            continue
+
+        launches.append((group['jar'][1], group['message_ids']))
+
+    return launches, unreadable
+
+
+'''
+launch the coalesced records of an SQS batch.  the response lists
+the messages to retry: every message of a failed launch and any
+message that could not be read
+'''
+def launch_messages(cfn: CFN, messages: list, template_body_str: str, template_params: list,
+        pool = None, index = None):
+    launches, failed = coalesce_messages(cfn, messages)
+    results = launch_records(cfn, [record for record, _ in launches], template_body_str, template_params, pool, index)
+
+    for (_, message_ids), result in zip(launches, results):
+        if not result['success']:
+            failed.extend(message_ids)
+
+    failed = list(dict.fromkeys(failed))
+    logger.info(f'{len(messages)} message(s) coalesced into {len(launches)} launch(es), {len(failed)} to retry')
+    return { 'batchItemFailures': [{ 'itemIdentifier': message_id } for message_id in failed] }
+
+
+'''
+lambda entrypoint for an SQS queue of S3 events.  the event source
+mapping must report batch item failures
+'''
+def sqs_handler(event, context):
+    messages = event['Records']
+    try:
+        cfn, template_body_str, template_parameters = load_launch_config()
+        return launch_messages(cfn, messages, template_body_str, template_parameters,
+            get_worker_pool(), get_launch_index())
+
+    except Exception as e:
+        logger.error(e)
+
+        # nothing was launched, retry the whole batch
+        return { 'batchItemFailures': [{ 'itemIdentifier': m['messageId'] } for m in messages] }
+
+    finally:
+        api_metrics.flush(dimensions = { 'Function': 'cfn_launch_sqs' })
+
 
 '''
 main - local testing and development
@@ -0,0 +1,229 @@
+import os, time, datetime
+import json, hashlib, sqlite3
+import contextlib
+
+from botocore.exceptions import ClientError
+
+from cfn import get_client, initialize_logger
+
+logger = initialize_logger()
+
+'''
+launch index layout.  every launched S3 object version has one entry
+keyed by its dedupe key:
+
+    {index}/{dedupe_key}  "in-flight <epoch> <stack_name>" while launching,
+                          "launched <epoch> <stack_name>" once created
+'''
+IN_FLIGHT = 'in-flight'
+LAUNCHED = 'launched'
+
+
+'''
+the dedupe key of an S3 object version.  the same bucket, key and
+ETag always produce the same key, a changed object a new one
+'''
+def get_dedupe_key(bucket: str, key: str, etag: str):
+    return hashlib.sha256(f'{bucket}/{key}:{etag.strip(chr(34))}'.encode('utf-8')).hexdigest()
+
+
+'''
+the CreateStack ClientRequestToken for a stack launched for a dedupe
+key.  a retried or redelivered launch sends the same token
+'''
+def get_client_request_token(dedupe_key: str, stack_name: str):
+    return hashlib.sha256(f'{dedupe_key}:{stack_name}'.encode('utf-8')).hexdigest()
+
+
+'''
+parse an index value into an entry
+'''
+def parse_entry(value: str):
+    state, updated, stack_name = value.split(' ', 2)
+    return { 'state': state, 'updated': float(updated), 'stack_name': stack_name }
+
+
+'''
+an in-flight entry older than timeout belongs to a launch that died,
+a launched entry older than ttl may be launched again
+'''
+def is_stale(entry: dict, timeout: float, ttl: float):
+    age = time.time() - entry['updated']
+    return age > (timeout if entry['state'] == IN_FLIGHT else ttl)
+
+
+'''
+SSM parameter store backed launch index.  Entries are created with
+Overwrite = False so only one invocation claims an object version.
+They are advanced parameters with an Expiration policy: SSM deletes
+an in-flight entry after timeout and a launched one after ttl, so the
+index never grows into the parameter quota of the account.  A stale
+entry is taken over by overwriting the version that was read; only the
+invocation whose write is the next version wins.
+'''
+class SsmLaunchIndex(object):
+
+    def __init__(self, index_path: str, timeout: float = 900.0, ttl: float = 86400.0):
+        self.index_path = index_path.rstrip('/')
+        self.timeout = timeout
+        self.ttl = ttl
+
+    '''
+    claim the dedupe key.  returns None when claimed, otherwise the
+    entry of the launch that holds it
+    '''
+    def claim(self, dedupe_key: str, stack_name: str):
+        # an entry deleted between the put and the read is claimed again
+        for attempt in range(3):
+            if self.__put(dedupe_key, IN_FLIGHT, stack_name, overwrite = False):
+                return None
+
+            entry, version = self.__get(dedupe_key)
+            if entry is None:
+                continue
+            if not is_stale(entry, self.timeout, self.ttl):
+                return entry
+
+            logger.info(f'Taking over stale launch index entry {dedupe_key}: {entry}')
+            written = self.__put(dedupe_key, IN_FLIGHT, stack_name, overwrite = True)
+            if written == version + 1:
+                return None
+
+            # another invocation took it over first
+            winner, _ = self.__get(dedupe_key, version + 1)
+            return winner or self.get(dedupe_key)
+
+        raise Exception(f'Unable to claim launch index entry {dedupe_key}.')
+
+    def get(self, dedupe_key: str):
+        return self.__get(dedupe_key)[0]
+
+    def complete(self, dedupe_key: str, stack_name: str):
+        self.__put(dedupe_key, LAUNCHED, stack_name, overwrite = True)
+
+    '''
+    drop the claim of a failed launch so a redelivery can retry it
+    '''
+    def release(self, dedupe_key: str):
+        try:
+            get_client('ssm').delete_parameter(Name = f'{self.index_path}/{dedupe_key}')
+
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ParameterNotFound':
+                raise e
+
+    '''
+    the entry and its parameter version, (None, None) when absent.
+    version selects an earlier version of the entry
+    '''
+    def __get(self, dedupe_key: str, version: int = None):
+        name = f'{self.index_path}/{dedupe_key}' + (f':{version}' if version else '')
+        try:
+            parameter = get_client('ssm').get_parameter(Name = name)['Parameter']
+            return parse_entry(parameter['Value']), parameter['Version']
+
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('ParameterNotFound', 'ParameterVersionNotFound'):
+                return None, None
+            raise e
+
+    '''
+    write an entry that expires once it can no longer hold the key.
+    returns the written version, False when it exists and overwrite is
+    off
+    '''
+    def __put(self, dedupe_key: str, state: str, stack_name: str, overwrite: bool):
+        now = time.time()
+        expires = datetime.datetime.utcfromtimestamp(now + (self.timeout if state == IN_FLIGHT else self.ttl))
+        try:
+            response = get_client('ssm').put_parameter(
+                Name = f'{self.index_path}/{dedupe_key}',
+                Value = f'{state} {now} {stack_name}',
+                Type = 'String',
+                Tier = 'Advanced',
+                Policies = json.dumps([{ 'Type': 'Expiration', 'Version': '1.0',
+                    'Attributes': { 'Timestamp': expires.strftime('%Y-%m-%dT%H:%M:%S.000Z') } }]),
+                Overwrite = overwrite
+            )
+            return response['Version']
+
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ParameterAlreadyExists':
+                return False
+            raise e
+
+
+'''
+local SQLite stand-in for the launch index.  the primary key replaces
+Overwrite = False and a conditional update takes over stale entries
+'''
+class SqliteLaunchIndex(object):
+
+    def __init__(self, path: str, timeout: float = 900.0, ttl: float = 86400.0):
+        self.path = path
+        self.timeout = timeout
+        self.ttl = ttl
+
+        with self.__connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS launches ('
+                'dedupe_key TEXT PRIMARY KEY, state TEXT, updated REAL, stack_name TEXT)')
+
+    def claim(self, dedupe_key: str, stack_name: str):
+        now = time.time()
+        with self.__connect() as db:
+            inserted = db.execute('INSERT OR IGNORE INTO launches VALUES (?, ?, ?, ?)',
+                (dedupe_key, IN_FLIGHT, now, stack_name)).rowcount
+            if inserted:
+                return None
+
+            taken = db.execute('UPDATE launches SET state = ?, updated = ?, stack_name = ? WHERE dedupe_key = ? '
+                'AND ((state = ? AND updated < ?) OR (state = ? AND updated < ?))',
+                (IN_FLIGHT, now, stack_name, dedupe_key, IN_FLIGHT, now - self.timeout, LAUNCHED, now - self.ttl)).rowcount
+            if taken:
+                logger.info(f'Took over stale launch index entry {dedupe_key}')
+                return None
+
+        return self.get(dedupe_key)
+
+    def get(self, dedupe_key: str):
+        with self.__connect() as db:
+            row = db.execute('SELECT state, updated, stack_name FROM launches WHERE dedupe_key = ?',
+                (dedupe_key,)).fetchone()
+
+        return { 'state': row[0], 'updated': row[1], 'stack_name': row[2] } if row else None
+
+    def complete(self, dedupe_key: str, stack_name: str):
+        with self.__connect() as db:
+            db.execute('UPDATE launches SET state = ?, updated = ?, stack_name = ? WHERE dedupe_key = ?',
+                (LAUNCHED, time.time(), stack_name, dedupe_key))
+
+    def release(self, dedupe_key: str):
+        with self.__connect() as db:
+            db.execute('DELETE FROM launches WHERE dedupe_key = ?', (dedupe_key,))
+
+    @contextlib.contextmanager
+    def __connect(self):
+        db = sqlite3.connect(self.path, timeout = 30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+
+'''
+the launch index configured for the lambda, None when deduplication
+is off.  LAUNCH_INDEX is an SSM path, or file://{path} for the local
+SQLite index
+'''
+def get_launch_index():
+    index_path = os.getenv('LAUNCH_INDEX', None)
+    if not index_path:
+        return None
+
+    timeout = float(os.getenv('LAUNCH_INDEX_TIMEOUT', 900))
+    ttl = float(os.getenv('LAUNCH_INDEX_TTL', 86400))
+    if index_path.startswith('file://'):
+        return SqliteLaunchIndex(index_path[len('file://'):], timeout, ttl)
+
+    return SsmLaunchIndex(index_path, timeout, ttl)
@@ -0,0 +1,139 @@
+import os, sys, time
+import json, threading
+
+THROTTLE_CODES = ['Throttling', 'ThrottlingException', 'ThrottledException', 'TooManyRequestsException',
+    'RequestLimitExceeded', 'RequestThrottled', 'SlowDown', 'ProvisionedThroughputExceededException']
+
+# latency histogram upper bounds in milliseconds, the last bucket is unbounded
+LATENCY_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+# embedded metric format accepts at most 100 values per metric
+MAX_LATENCY_VALUES = 100
+
+
+'''
+Per service and operation AWS API metrics collected from botocore's
+event system.  before-call/after-call time each API call (retries
+included), needs-retry sees every attempt so throttles absorbed by the
+retry config are counted too.
+'''
+class ApiMetrics(object):
+
+    def __init__(self, namespace: str = 'CfnEc2Processing', enabled: bool = True):
+        self.namespace = namespace
+        self.enabled = enabled
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    '''
+    register the handlers on a client, returns the client
+    '''
+    def instrument(self, client):
+        events = client.meta.events
+        service = client.meta.service_model.service_name
+        events.register_first(f'before-call.{service}.*', self.__before_call)
+        events.register(f'after-call.{service}.*', self.__after_call)
+        events.register(f'after-call-error.{service}.*', self.__after_call_error)
+        events.register_first(f'needs-retry.{service}.*', self.__needs_retry)
+        return client
+
+    def __operation(self, service: str, operation: str):
+        key = (service, operation)
+        if not key in self.operations:
+            self.operations[key] = {
+                'calls': 0, 'errors': 0, 'retries': 0, 'throttles': 0,
+                'latency': [], 'histogram': [0] * (len(LATENCY_BUCKETS) + 1)
+            }
+
+        return self.operations[key]
+
+    def __before_call(self, context, **kwargs):
+        context['metrics_start'] = time.perf_counter()
+
+    def __after_call(self, model, parsed, context, **kwargs):
+        self.__record(model, context, parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+            'Error' in parsed)
+
+    def __after_call_error(self, model, context, **kwargs):
+        self.__record(model, context, 0, True)
+
+    def __record(self, model, context, retries: int, error: bool):
+        elapsed = (time.perf_counter() - context.get('metrics_start', time.perf_counter())) * 1000
+        bucket = len([b for b in LATENCY_BUCKETS if elapsed > b])
+
+        with self.lock:
+            op = self.__operation(model.service_model.service_name, model.name)
+            op['calls'] += 1
+            op['retries'] += retries
+            op['errors'] += 1 if error else 0
+            op['histogram'][bucket] += 1
+            if len(op['latency']) < MAX_LATENCY_VALUES:
+                op['latency'].append(round(elapsed, 3))
+
+    def __needs_retry(self, response, operation, **kwargs):
+        if not response:
+            return
+
+        code = response[1].get('Error', {}).get('Code')
+        if code in THROTTLE_CODES:
+            with self.lock:
+                self.__operation(operation.service_model.service_name, operation.name)['throttles'] += 1
+
+    '''
+    embedded metric format documents, one per service and operation
+    '''
+    def to_emf(self, dimensions: dict = None):
+        dimensions = dimensions or {}
+        timestamp = int(time.time() * 1000)
+        documents = []
+
+        with self.lock:
+            for (service, operation), op in sorted(self.operations.items()):
+                document = {
+                    '_aws': {
+                        'Timestamp': timestamp,
+                        'CloudWatchMetrics': [{
+                            'Namespace': self.namespace,
+                            'Dimensions': [list(dimensions.keys()) + ['Service', 'Operation']],
+                            'Metrics': [
+                                { 'Name': 'Calls', 'Unit': 'Count' },
+                                { 'Name': 'Errors', 'Unit': 'Count' },
+                                { 'Name': 'Retries', 'Unit': 'Count' },
+                                { 'Name': 'Throttles', 'Unit': 'Count' },
+                                { 'Name': 'Latency', 'Unit': 'Milliseconds' }
+                            ]
+                        }]
+                    },
+                    'Service': service,
+                    'Operation': operation,
+                    'Calls': op['calls'],
+                    'Errors': op['errors'],
+                    'Retries': op['retries'],
+                    'Throttles': op['throttles'],
+                    'Latency': op['latency'],
+                    'LatencyHistogram': dict(zip([f'le_{b}ms' for b in LATENCY_BUCKETS] + ['gt_5000ms'], op['histogram']))
+                }
+                document.update(dimensions)
+                documents.append(document)
+
+        return documents
+
+    '''
+    write the metric lines and start a new collection period
+    '''
+    def flush(self, out = None, dimensions: dict = None):
+        if self.enabled:
+            out = out or sys.stdout
+            for document in self.to_emf(dimensions):
+                out.write(json.dumps(document) + '\n')
+            out.flush()
+
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+
+api_metrics = ApiMetrics(os.getenv('METRICS_NAMESPACE', 'CfnEc2Processing'),
+    os.getenv('API_METRICS', 'on') != 'off')
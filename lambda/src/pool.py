@@ -0,0 +1,167 @@
+import os, time
+
+from botocore.exceptions import ClientError
+
+from cfn import get_client, initialize_logger
+
+logger = initialize_logger()
+
+'''
+worker pool layout, shared with batch-init.py --pool.  every worker
+publishes a state under the pool path and receives work through an
+assignment that only one dispatcher can create:
+
+    {pool}/{worker_id}/state       "idle <epoch>", "busy <epoch>" or "leaving <epoch>"
+    {pool}/{worker_id}/assignment  the namespace to process
+'''
+STATE = 'state'
+ASSIGNMENT = 'assignment'
+
+
+'''
+SSM parameter store backed pool board.  The assignment is created with
+Overwrite = False so two dispatchers can never claim the same worker.
+'''
+class SsmPoolBoard(object):
+
+    def __init__(self, pool_path: str):
+        self.pool_path = pool_path.rstrip('/')
+
+    '''
+    return {worker_id: {'state', 'heartbeat', 'assigned'}}
+    '''
+    def get_workers(self):
+        ssm = get_client('ssm')
+        request = { 'Path': self.pool_path, 'Recursive': True, 'MaxResults': 10 }
+        params = {}
+
+        while True:
+            response = ssm.get_parameters_by_path(**request)
+            for p in response['Parameters']:
+                params[p['Name'][len(self.pool_path) + 1:]] = p['Value']
+
+            if not response.get('NextToken'):
+                return parse_workers(params)
+            request['NextToken'] = response['NextToken']
+
+    '''
+    create the assignment for a worker, False if already claimed
+    '''
+    def claim(self, worker_id: str, namespace: str):
+        try:
+            get_client('ssm').put_parameter(
+                Name = f'{self.pool_path}/{worker_id}/{ASSIGNMENT}',
+                Value = namespace,
+                Type = 'String',
+                Overwrite = False
+            )
+            return True
+
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ParameterAlreadyExists':
+                return False
+            raise e
+
+
+'''
+local directory stand-in for the pool board.  files replace
+parameters and O_EXCL replaces Overwrite = False
+'''
+class LocalPoolBoard(object):
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.pool_path = f'file://{directory}'
+
+    def get_workers(self):
+        params = {}
+        for worker_id in os.listdir(self.directory):
+            for name in os.listdir(os.path.join(self.directory, worker_id)):
+                with open(os.path.join(self.directory, worker_id, name), 'r') as param:
+                    params[f'{worker_id}/{name}'] = param.read()
+
+        return parse_workers(params)
+
+    def claim(self, worker_id: str, namespace: str):
+        try:
+            fd = os.open(os.path.join(self.directory, worker_id, ASSIGNMENT),
+                os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+
+        with os.fdopen(fd, 'w') as assignment:
+            assignment.write(namespace)
+        return True
+
+
+'''
+group "{worker_id}/{name}" values into worker records
+'''
+def parse_workers(params: dict):
+    workers = {}
+    for path, value in params.items():
+        worker_id, _, name = path.partition('/')
+        worker = workers.setdefault(worker_id, { 'state': None, 'heartbeat': 0.0, 'assigned': False })
+
+        if name == STATE:
+            state, _, heartbeat = value.partition(' ')
+            worker['state'] = state
+            worker['heartbeat'] = float(heartbeat or 0)
+        elif name == ASSIGNMENT:
+            worker['assigned'] = True
+
+    return workers
+
+
+'''
+Dispatch jobs to idle pool members.  A worker is idle when its last
+heartbeat is recent, it reports idle and holds no assignment.
+'''
+class WorkerPool(object):
+
+    def __init__(self, board, heartbeat_timeout: float = 120.0):
+        self.board = board
+        self.pool_path = board.pool_path
+        self.heartbeat_timeout = heartbeat_timeout
+
+    def get_idle_workers(self):
+        now = time.time()
+        workers = self.board.get_workers()
+
+        idle = [worker_id for worker_id, w in workers.items()
+            if w['state'] == 'idle' and not w['assigned']
+            and now - w['heartbeat'] < self.heartbeat_timeout]
+
+        # most recent heartbeat first, least likely to have gone away
+        return sorted(idle, key = lambda worker_id: -workers[worker_id]['heartbeat'])
+
+    '''
+    assign the namespace to an idle worker.  returns the worker id or
+    None when no worker could be claimed
+    '''
+    def dispatch(self, namespace: str):
+        for worker_id in self.get_idle_workers():
+            if self.board.claim(worker_id, namespace):
+                logger.info(f'Dispatched {namespace} to pool worker {worker_id}')
+                return worker_id
+
+            logger.debug(f'Pool worker {worker_id} was claimed by another dispatcher')
+
+        logger.info(f'No idle pool worker for {namespace}')
+        return None
+
+
+'''
+the pool configured for the lambda, None when pool mode is off.
+WORKER_POOL is an SSM path, or file://{dir} for the local board
+'''
+def get_worker_pool():
+    pool_path = os.getenv('WORKER_POOL', None)
+    if not pool_path:
+        return None
+
+    heartbeat_timeout = float(os.getenv('POOL_HEARTBEAT_TIMEOUT', 120))
+    if pool_path.startswith('file://'):
+        return WorkerPool(LocalPoolBoard(pool_path[len('file://'):]), heartbeat_timeout)
+
+    return WorkerPool(SsmPoolBoard(pool_path), heartbeat_timeout)
@@ -0,0 +1,157 @@
+import os, threading
+import hashlib, uuid
+
+from botocore.exceptions import ClientError
+
+from cfn import get_client, initialize_logger
+
+logger = initialize_logger()
+
+# CreateStack and ValidateTemplate limit for a template read from a TemplateURL
+MAX_TEMPLATE_URL_BODY = 1024 * 1024
+
+# registered template urls by (bucket, key), kept across warm invocations
+registered = {}
+registered_lock = threading.Lock()
+
+# bucket regions, a TemplateURL must name the bucket's own region
+bucket_regions = {}
+
+
+'''
+the content hash a template is registered under
+'''
+def get_template_digest(template_body: str):
+    return hashlib.sha256(template_body.encode('utf-8')).hexdigest()
+
+
+'''
+Content-addressed template registry.  Each distinct template version is
+uploaded to a staging key unique to the attempt, validated from there
+and only then published to {prefix}{sha256}.yml; stacks are created
+from its TemplateURL instead of an inline body.  Validating by URL lifts
+the 51,200 byte inline limit to 1MB.  Only validated templates are
+published, so an existing key needs no validation.
+'''
+class TemplateRegistry(object):
+
+    def __init__(self, bucket: str, prefix: str = 'templates/'):
+        self.bucket = bucket
+        self.prefix = f"{prefix.strip('/')}/" if prefix.strip('/') else ''
+
+    def get_key(self, digest: str):
+        return f'{self.prefix}{digest}.yml'
+
+    # concurrent publishers of one template never share a staging object
+    def get_staging_key(self, digest: str):
+        return f'{self.prefix}staging/{digest}-{uuid.uuid4().hex}.yml'
+
+    def get_url(self, key: str):
+        return f'https://{self.bucket}.s3.{self.get_region()}.amazonaws.com/{key}'
+
+    '''
+    the region of the bucket, from the HeadObject that looked for the
+    template or else GetBucketLocation
+    '''
+    def get_region(self):
+        if not self.bucket in bucket_regions:
+            location = get_client('s3').get_bucket_location(Bucket = self.bucket).get('LocationConstraint')
+            bucket_regions[self.bucket] = { None: 'us-east-1', '': 'us-east-1', 'EU': 'eu-west-1' }.get(location, location)
+
+        return bucket_regions[self.bucket]
+
+    '''
+    the TemplateURL of a template, validating and publishing it the
+    first time its hash is seen.  an invalid template raises without
+    being published
+    '''
+    def register(self, template_body: str):
+        digest = get_template_digest(template_body)
+        key = self.get_key(digest)
+
+        with registered_lock:
+            if (self.bucket, key) in registered:
+                return registered[(self.bucket, key)]
+
+        if not self.__exists(key):
+            self.__publish(digest, template_body, key)
+
+        url = self.get_url(key)
+        with registered_lock:
+            registered[(self.bucket, key)] = url
+
+        return url
+
+    def __exists(self, key: str):
+        try:
+            self.__note_region(get_client('s3').head_object(Bucket = self.bucket, Key = key))
+            return True
+
+        except ClientError as e:
+            self.__note_region(e.response)
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise e
+
+    # S3 reports the bucket region on every HeadObject, found or not
+    def __note_region(self, response: dict):
+        region = response.get('ResponseMetadata', {}).get('HTTPHeaders', {}).get('x-amz-bucket-region')
+        if region:
+            bucket_regions[self.bucket] = region
+
+    '''
+    stage, validate by url and publish.  the staging copy is removed
+    whether or not the template is valid
+    '''
+    def __publish(self, digest: str, template_body: str, key: str):
+        body = template_body.encode('utf-8')
+        if len(body) > MAX_TEMPLATE_URL_BODY:
+            raise Exception(f'Template {digest} is larger than {MAX_TEMPLATE_URL_BODY} bytes.')
+
+        s3 = get_client('s3')
+        staging_key = self.get_staging_key(digest)
+        s3.put_object(
+            Bucket = self.bucket,
+            Key = staging_key,
+            Body = body,
+            ContentType = 'application/x-yaml',
+            Metadata = { 'sha256': digest }
+        )
+
+        try:
+            self.__validate(digest, staging_key)
+            s3.copy_object(
+                Bucket = self.bucket,
+                Key = key,
+                CopySource = { 'Bucket': self.bucket, 'Key': staging_key }
+            )
+            logger.info(f'Published template {digest} to s3://{self.bucket}/{key}')
+
+        finally:
+            s3.delete_object(Bucket = self.bucket, Key = staging_key)
+
+    def __validate(self, digest: str, staging_key: str):
+        try:
+            get_client('cloudformation').validate_template(TemplateURL = self.get_url(staging_key))
+            logger.info(f'Validated template {digest}')
+
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ValidationError':
+                raise Exception(f"Template {digest} is invalid: {e.response['Error'].get('Message')}")
+            raise e
+
+
+'''
+the template registry configured for the lambda, None to send the
+template inline.  TEMPLATE_REGISTRY is s3://bucket/prefix/
+'''
+def get_template_registry():
+    location = os.getenv('TEMPLATE_REGISTRY', None)
+    if not location:
+        return None
+
+    if not location.startswith('s3://'):
+        raise Exception(f'TEMPLATE_REGISTRY must be s3://bucket/prefix/, not {location}.')
+
+    bucket, _, prefix = location[len('s3://'):].partition('/')
+    return TemplateRegistry(bucket, prefix)
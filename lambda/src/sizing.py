@@ -0,0 +1,66 @@
+import os
+
+from cfn import initialize_logger
+
+logger = initialize_logger()
+
+'''
+default size-to-type table.  each tier is "{max MB}:{type}", the first
+tier the input fits in wins and "*" takes everything larger
+'''
+DEFAULT_INSTANCE_SIZES = '256:t2.micro,1024:t3.small,4096:t3.large,16384:m5.xlarge,*:m5.2xlarge'
+
+
+'''
+parse an INSTANCE_SIZES table into [(max_bytes, type)], max_bytes is
+None for the unbounded tier
+'''
+def parse_size_table(spec: str):
+    table = []
+    for tier in spec.split(','):
+        limit, _, instance_type = tier.strip().partition(':')
+        if not instance_type:
+            raise Exception(f'Invalid instance size tier: {tier}')
+
+        table.append((None if limit == '*' else int(limit) * 1024 * 1024, instance_type))
+
+    # unbounded tier last, the rest smallest first
+    return sorted(table, key = lambda t: (t[0] is None, t[0] or 0))
+
+
+'''
+Pick the instance type for an input size.  A per-namespace
+instance-type parameter overrides the table.
+'''
+class InstanceSizer(object):
+
+    def __init__(self, table: list):
+        self.table = table
+
+    '''
+    returns the instance type and the reason it was chosen
+    '''
+    def select(self, size: int, override: str = None):
+        if override:
+            return override, 'instance-type parameter override'
+
+        for limit, instance_type in self.table:
+            if limit is None or size <= limit:
+                tier = 'largest tier' if limit is None else f'{limit // (1024 * 1024)} MB tier'
+                return instance_type, f'{size / (1024 * 1024):0.1f} MB input fits the {tier}'
+
+        # no unbounded tier, stay on the largest listed type
+        limit, instance_type = self.table[-1]
+        return instance_type, f'{size / (1024 * 1024):0.1f} MB input exceeds every tier'
+
+
+'''
+the sizer configured for the lambda, None when sizing is off.
+INSTANCE_SIZES is the table, or "off" to keep the template default
+'''
+def get_instance_sizer():
+    spec = os.getenv('INSTANCE_SIZES', DEFAULT_INSTANCE_SIZES)
+    if spec == 'off':
+        return None
+
+    return InstanceSizer(parse_size_table(spec))
@@ -0,0 +1,355 @@
+import os, time
+import json, math, random
+
+from botocore.exceptions import ClientError
+
+from cfn import get_client, initialize_logger
+
+logger = initialize_logger()
+
+# timeline milestones, measured in seconds from the launch request
+MILESTONES = ['create_complete', 'instance_running', 'batch_init_start']
+
+# the template's instance, created running by cloudformation
+INSTANCE_RESOURCE = 'BatchProcessingInstance'
+
+TERMINAL_STATUSES = ['CREATE_COMPLETE', 'CREATE_FAILED', 'ROLLBACK_COMPLETE',
+    'ROLLBACK_FAILED', 'DELETE_COMPLETE', 'DELETE_FAILED']
+
+
+'''
+the parameter batch-init writes when it starts, one per fan-out shard
+so every shard reports its own start
+'''
+def get_batch_init_start_name(shard_index: int = None):
+    return 'batch-init-start' if shard_index is None else f'batch-init-start-shard{shard_index}'
+
+
+'''
+exponential backoff with full jitter.  call next() for the delay
+before the following poll
+'''
+class Backoff(object):
+
+    def __init__(self, base: float = 2.0, cap: float = 30.0):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next(self):
+        delay = min(self.cap, self.base * 2 ** self.attempt)
+        self.attempt += 1
+        return random.uniform(self.base / 2, delay)
+
+
+'''
+one json document per stack in a local directory
+'''
+class FileTimelineStore(object):
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def put(self, timeline: dict):
+        os.makedirs(self.directory, exist_ok = True)
+        with open(os.path.join(self.directory, f"{timeline['stack_name']}.json"), 'w') as out:
+            json.dump(timeline, out)
+
+    def all(self):
+        timelines = []
+        for name in sorted(os.listdir(self.directory)):
+            with open(os.path.join(self.directory, name), 'r') as timeline:
+                timelines.append(json.load(timeline))
+
+        return timelines
+
+
+'''
+one json object per stack under an S3 prefix
+'''
+class S3TimelineStore(object):
+
+    def __init__(self, bucket: str, prefix: str = 'timelines/'):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put(self, timeline: dict):
+        get_client('s3').put_object(
+            Bucket = self.bucket,
+            Key = f"{self.prefix}{timeline['stack_name']}.json",
+            Body = json.dumps(timeline).encode('utf-8')
+        )
+
+    def all(self):
+        s3 = get_client('s3')
+        timelines = []
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket = self.bucket, Prefix = self.prefix):
+            for obj in page.get('Contents', []):
+                body = s3.get_object(Bucket = self.bucket, Key = obj['Key'])['Body'].read()
+                timelines.append(json.loads(body))
+
+        return timelines
+
+
+'''
+get the timeline store.  TIMELINE_STORE is s3://bucket/prefix/ or a
+local directory
+'''
+def get_timeline_store(location: str = None):
+    location = location or os.getenv('TIMELINE_STORE', './timelines')
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[len('s3://'):].partition('/')
+        return S3TimelineStore(bucket, prefix)
+
+    return FileTimelineStore(location)
+
+
+'''
+Follow a stack from the create request until the batch-init script
+starts on its instance.  Every milestone is polled with backoff and
+recorded as an epoch time; failures keep the reasons reported in the
+stack events.  The stack is followed by its id, which still resolves
+after a failed stack was deleted.  An instance launched with
+RunInstances has no stack, tracking starts at the instance.
+'''
+class StackTracker(object):
+
+    def __init__(self, store, timeout: float = 1800.0, backoff_base: float = 2.0, backoff_cap: float = 30.0):
+        self.store = store
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+    def track(self, stack_name: str, namespace: str, requested: float, instance_id: str = None,
+            stack_id: str = None, shard_index: int = None):
+        timeline = {
+            'stack_name': stack_name,
+            'namespace': namespace,
+            'requested': requested,
+            'launcher': 'ec2' if instance_id else 'cloudformation',
+            'status': None,
+            'reasons': []
+        }
+        if stack_id:
+            timeline['stack_id'] = stack_id
+        if shard_index is not None:
+            timeline['shard_index'] = shard_index
+        deadline = requested + self.timeout
+        stack = stack_id or stack_name
+
+        try:
+            if instance_id:
+                timeline['instance_id'] = instance_id
+                timeline['instance_running'] = self.__wait_for_instance(instance_id, deadline)
+                timeline['status'] = 'RUNNING'
+            else:
+                completed_resources = {}
+                status, completed = self.__wait_for_stack(stack, timeline['reasons'], deadline, completed_resources)
+                timeline['status'] = status
+                if status != 'CREATE_COMPLETE':
+                    return self.__put(timeline)
+
+                timeline['create_complete'] = completed
+
+                # cloudformation completes the instance once it is running
+                if INSTANCE_RESOURCE in completed_resources:
+                    timeline['instance_id'], timeline['instance_running'] = completed_resources[INSTANCE_RESOURCE]
+                else:
+                    timeline['instance_id'] = self.__get_instance_id(stack)
+                    timeline['instance_running'] = self.__wait_for_instance(timeline['instance_id'], deadline)
+
+            timeline['batch_init_start'] = self.__wait_for_batch_init(namespace, requested, deadline, shard_index)
+
+        except Exception as e:
+            logger.error(f'Tracking {stack_name} stopped: {e}')
+            timeline['reasons'].append(str(e))
+
+        return self.__put(timeline)
+
+    def __put(self, timeline: dict):
+        self.store.put(timeline)
+        logger.info(f'Stack timeline: {json.dumps(timeline)}')
+        return timeline
+
+    '''
+    poll the newest stack events until the stack reaches a terminal
+    status.  returns the status and the time it was reached.  the
+    physical id and completion time of every created resource are
+    added to completed_resources
+    '''
+    def __wait_for_stack(self, stack: str, reasons: list, deadline: float, completed_resources: dict):
+        cfn = get_client('cloudformation')
+        backoff = Backoff(self.backoff_base, self.backoff_cap)
+        seen = set()
+
+        while time.time() < deadline:
+            events = cfn.describe_stack_events(StackName = stack)['StackEvents']
+
+            for event in reversed(events):
+                if event['EventId'] in seen:
+                    continue
+                seen.add(event['EventId'])
+
+                if event['ResourceStatus'].endswith('_FAILED'):
+                    reasons.append(f"{event['LogicalResourceId']}: {event.get('ResourceStatusReason')}")
+
+                if event['ResourceStatus'] == 'CREATE_COMPLETE':
+                    completed_resources[event['LogicalResourceId']] = (event.get('PhysicalResourceId'),
+                        event['Timestamp'].timestamp())
+
+                if event['ResourceType'] == 'AWS::CloudFormation::Stack' \
+                        and event['ResourceStatus'] in TERMINAL_STATUSES:
+                    return event['ResourceStatus'], event['Timestamp'].timestamp()
+
+            time.sleep(backoff.next())
+
+        raise Exception(f'Timed out waiting for {stack} to complete.')
+
+    def __get_instance_id(self, stack: str):
+        response = get_client('cloudformation').describe_stack_resource(
+            StackName = stack,
+            LogicalResourceId = INSTANCE_RESOURCE
+        )
+        return response['StackResourceDetail']['PhysicalResourceId']
+
+    '''
+    poll until the instance reports running.  returns the time observed
+    '''
+    def __wait_for_instance(self, instance_id: str, deadline: float):
+        ec2 = get_client('ec2')
+        backoff = Backoff(self.backoff_base, self.backoff_cap)
+
+        while time.time() < deadline:
+            response = ec2.describe_instances(InstanceIds = [instance_id])
+            state = response['Reservations'][0]['Instances'][0]['State']['Name']
+            if state == 'running':
+                return time.time()
+
+            time.sleep(backoff.next())
+
+        raise Exception(f'Timed out waiting for {instance_id} to run.')
+
+    '''
+    poll the batch-init-start parameter written by batch-init.py.  a value
+    older than the request belongs to a previous run
+    '''
+    def __wait_for_batch_init(self, namespace: str, requested: float, deadline: float, shard_index: int = None):
+        ssm = get_client('ssm')
+        backoff = Backoff(self.backoff_base, self.backoff_cap)
+        sep = '/' if not namespace[-1:] == '/' else ''
+        name = f'{namespace}{sep}{get_batch_init_start_name(shard_index)}'
+
+        while time.time() < deadline:
+            try:
+                response = ssm.get_parameter(Name = name)
+                started = float(response['Parameter']['Value'])
+                if started >= requested:
+                    return started
+
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ParameterNotFound':
+                    raise e
+
+            time.sleep(backoff.next())
+
+        raise Exception(f'Timed out waiting for batch-init to start in {namespace}.')
+
+
+'''
+nearest-rank percentile of a sorted list
+'''
+def percentile(values: list, pct: float):
+    rank = max(1, math.ceil(pct / 100.0 * len(values)))
+    return values[rank - 1]
+
+
+'''
+percentile summary of each milestone, in seconds from the request
+'''
+def summarize(timelines: list):
+    summary = {}
+    for milestone in MILESTONES:
+        durations = sorted(t[milestone] - t['requested'] for t in timelines if t.get(milestone))
+        if not durations:
+            continue
+
+        summary[milestone] = {
+            'count': len(durations),
+            'p50': percentile(durations, 50),
+            'p90': percentile(durations, 90),
+            'p99': percentile(durations, 99),
+            'max': durations[-1]
+        }
+
+    statuses = {}
+    for t in timelines:
+        statuses[t['status']] = statuses.get(t['status'], 0) + 1
+    summary['statuses'] = statuses
+
+    return summary
+
+
+'''
+the summary of each launcher's timelines, to compare stack creation
+with RunInstances.  timelines from before launchers count as
+cloudformation
+'''
+def summarize_by_launcher(timelines: list):
+    launchers = {}
+    for t in timelines:
+        launchers.setdefault(t.get('launcher', 'cloudformation'), []).append(t)
+
+    return { launcher: summarize(group) for launcher, group in sorted(launchers.items()) }
+
+
+'''
+start tracking without holding up the launch.  TRACKER_FUNCTION names
+the lambda that runs tracker_handler; tracking is off without it
+'''
+def start_tracking(stack_name: str, namespace: str, requested: float, instance_id: str = None,
+        stack_id: str = None, shard_index: int = None):
+    function_name = os.getenv('TRACKER_FUNCTION', None)
+    if not function_name:
+        return
+
+    payload = { 'stack_name': stack_name, 'namespace': namespace, 'requested': requested }
+    if instance_id:
+        payload['instance_id'] = instance_id
+    if stack_id:
+        payload['stack_id'] = stack_id
+    if shard_index is not None:
+        payload['shard_index'] = shard_index
+
+    try:
+        get_client('lambda').invoke(
+            FunctionName = function_name,
+            InvocationType = 'Event',
+            Payload = json.dumps(payload).encode('utf-8')
+        )
+
+    except Exception as e:
+        logger.warning(f'Unable to start tracking {stack_name}: {e}')
+
+
+'''
+lambda entrypoint for the tracker function
+'''
+def tracker_handler(event, context):
+    tracker = StackTracker(get_timeline_store(), float(os.getenv('TRACKER_TIMEOUT', 840)))
+    return tracker.track(event['stack_name'], event['namespace'], event['requested'], event.get('instance_id'),
+        event.get('stack_id'), event.get('shard_index'))
+
+
+'''
+main - print the percentile summary of stored timelines
+'''
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Stack launch latency summary')
+    parser.add_argument('store', nargs = '?', help = 'Timeline directory or s3://bucket/prefix/')
+    parser.add_argument('--by-launcher', action = 'store_true', help = 'Summarize cloudformation and ec2 launches apart.')
+    args = parser.parse_args()
+
+    timelines = get_timeline_store(args.store).all()
+    print(json.dumps(summarize_by_launcher(timelines) if args.by_launcher else summarize(timelines), indent = 2))
@@ -1,10 +1,16 @@
 import unittest
 import sys
-import json
+import io, base64
+import json, datetime
+
+import boto3
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
 
 sys.path.append('./lambda/src')
 
-from cfn import CFN
+import cfn as cfn_module
+from cfn import CFN, S3ObjectCache, plan_byte_ranges
 
 class TestCfn(unittest.TestCase):
 
@@ -90,4 +96,208 @@ class TestCfn(unittest.TestCase):
     create the stack/resources
     '''
     def create_stack(self):
-        pass
\ No newline at end of file
+        pass
+
+    '''
+    every record of a batched event is returned in order
+    '''
+    def test_get_event_records(self):
+        cfn = CFN(None, None)
+
+        with open('./lambda/tests/resources/s3-objects-created.json', 'r') as file_obj:
+            event_data = json.load(file_obj)
+            records = cfn.get_event_records(event_data)
+            self.assertEqual(3, len(records))
+            self.assertEqual(('floresj4-cfn-ec2-processing', 'batch-processor-0.0.1-SNAPSHOT.jar'), records[0])
+            self.assertEqual('jobs/nightly/sample-data.csv', records[2][1])
+
+            # the first record is still available through get_event_info
+            self.assertEqual(records[0], cfn.get_event_info(event_data))
+
+
+    '''
+    cached objects are served within the ttl, revalidated with
+    If-None-Match after it and downloaded again when changed
+    '''
+    def test_s3_object_cache(self):
+        s3 = boto3.client('s3', region_name = 'us-east-1',
+            aws_access_key_id = 'test', aws_secret_access_key = 'test')
+        cache = S3ObjectCache(ttl = 60)
+        parsed = []
+
+        def parse(body):
+            parsed.append(body)
+            return body.upper()
+
+        with Stubber(s3) as stubber:
+            stubber.add_response('get_object',
+                { 'Body': StreamingBody(io.BytesIO(b'v1'), 2), 'ETag': '"e1"' },
+                { 'Bucket': 'b', 'Key': 'params.yml' })
+            stubber.add_client_error('get_object', service_error_code = '304',
+                http_status_code = 304,
+                expected_params = { 'Bucket': 'b', 'Key': 'params.yml', 'IfNoneMatch': '"e1"' })
+            stubber.add_response('get_object',
+                { 'Body': StreamingBody(io.BytesIO(b'v2'), 2), 'ETag': '"e2"' },
+                { 'Bucket': 'b', 'Key': 'params.yml', 'IfNoneMatch': '"e1"' })
+
+            self.assertEqual('V1', cache.get(s3, 'b', 'params.yml', parse))
+            self.assertEqual('V1', cache.get(s3, 'b', 'params.yml', parse))
+
+            # expire the entry, unchanged object is revalidated
+            cache.ttl = 0
+            self.assertEqual('V1', cache.get(s3, 'b', 'params.yml', parse))
+
+            # changed object is downloaded and parsed again
+            self.assertEqual('V2', cache.get(s3, 'b', 'params.yml', parse))
+            stubber.assert_no_pending_responses()
+
+        self.assertEqual(['v1', 'v2'], parsed)
+        self.assertEqual({ 'hits': 2, 'misses': 2, 'revalidations': 1 }, cache.stats)
+
+
+    '''
+    boot profiles change the install phases, every phase is timestamped
+    '''
+    def test_get_user_data_profiles(self):
+        cfn = CFN('cfn-bucket', 'template.yml')
+
+        standard = base64.b64decode(cfn.get_user_data('/bucket/', 'standard')).decode('utf-8')
+        self.assertIn('yum update -y', standard)
+        self.assertIn('boot-timeline', standard)
+        self.assertIn('pip install boto3 requests zstandard', standard)
+        self.assertTrue(standard.endswith('python3 batch-init.py &'))
+
+        prebaked = base64.b64decode(cfn.get_user_data('/bucket/', 'prebaked')).decode('utf-8')
+        self.assertNotIn('yum', prebaked)
+        self.assertNotIn('pip', prebaked)
+
+        wheelhouse = base64.b64decode(cfn.get_user_data('/bucket/', 'wheelhouse')).decode('utf-8')
+        self.assertIn('s3://cfn-bucket/boot/', wheelhouse)
+        self.assertIn('--no-index', wheelhouse)
+        self.assertIn('--disablerepo=*', wheelhouse)
+        self.assertIn('boot/wheelhouse boto3 requests zstandard', wheelhouse)
+
+        with self.assertRaises(Exception):
+            cfn.get_user_data('/bucket/', 'unknown')
+
+
+    '''
+    byte ranges cover the whole object without gaps, capped at max shards
+    '''
+    def test_plan_byte_ranges(self):
+        self.assertEqual([[0, 100]], plan_byte_ranges(100, 100, 10))
+        self.assertEqual([[0, 33], [33, 66], [66, 100]], plan_byte_ranges(100, 40, 10))
+        self.assertEqual(2, len(plan_byte_ranges(1000, 1, 2)))
+        self.assertEqual([[0, 0]], plan_byte_ranges(0, 10, 10))
+
+
+    '''
+    RunInstances gets the template's instance with the stack parameters
+    and parameter defaults resolved, and answers like a created stack
+    '''
+    def test_run_instance(self):
+        cfn = CFN('cfn-bucket', 'template.yml')
+        with open('./cloudformation/template.yml', 'r') as template:
+            template_body = template.read()
+
+        userdata = cfn.get_user_data('/bucket/')
+        parameters = [
+            { 'ParameterKey': 'InstanceKeyPair', 'ParameterValue': 'key' },
+            { 'ParameterKey': 'InstanceSubnetId', 'ParameterValue': 'subnet-1' },
+            { 'ParameterKey': 'InstanceProfile', 'ParameterValue': 'profile' },
+            { 'ParameterKey': 'InstanceName', 'ParameterValue': 'job' },
+            { 'ParameterKey': 'InstanceUserData', 'ParameterValue': userdata }
+        ]
+
+        ec2 = boto3.client('ec2', region_name = 'us-east-1',
+            aws_access_key_id = 'test', aws_secret_access_key = 'test')
+        cfn_module.clients['ec2'] = ec2
+        try:
+            with Stubber(ec2) as stubber:
+                stubber.add_response('run_instances', { 'Instances': [{ 'InstanceId': 'i-0123',
+                    'State': { 'Name': 'pending' }, 'LaunchTime': datetime.datetime(2020, 1, 1) }] }, {
+                    'ImageId': 'ami-0947d2ba12ee1ff75',
+                    'InstanceType': 't2.micro',
+                    'KeyName': 'key',
+                    'SubnetId': 'subnet-1',
+                    'SecurityGroupIds': ['sg-04f46cd06fd1b653d'],
+                    'IamInstanceProfile': { 'Name': 'profile' },
+                    'UserData': base64.b64decode(userdata).decode('utf-8'),
+                    'TagSpecifications': [{ 'ResourceType': 'instance', 'Tags': [{ 'Key': 'Name', 'Value': 'job' }] }],
+                    'MinCount': 1,
+                    'MaxCount': 1,
+                    'ClientToken': 'token'
+                })
+
+                launch = cfn.run_instance('job', template_body, parameters, 'token')
+
+        finally:
+            cfn_module.clients.pop('ec2', None)
+
+        self.assertEqual('job', launch.stack_name)
+        self.assertEqual('i-0123', launch.instance_id)
+        self.assertEqual('PENDING', launch.stack_status)
+        self.assertEqual(datetime.datetime(2020, 1, 1), launch.creation_time)
+
+
+    '''
+    create_stack goes through the shared client and describes the new
+    stack for its status
+    '''
+    def test_create_stack(self):
+        cfn = CFN('cfn-bucket', 'template.yml')
+        stack_id = 'arn:aws:cloudformation:us-east-1:000000000000:stack/job/0'
+
+        client = boto3.client('cloudformation', region_name = 'us-east-1',
+            aws_access_key_id = 'test', aws_secret_access_key = 'test')
+        cfn_module.clients['cloudformation'] = client
+        try:
+            with Stubber(client) as stubber:
+                stubber.add_response('create_stack', { 'StackId': stack_id }, {
+                    'StackName': 'job', 'TemplateBody': 'template', 'Parameters': [],
+                    'TimeoutInMinutes': 15, 'OnFailure': 'DELETE',
+                    'Capabilities': ['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM'], 'ClientRequestToken': 'token' })
+                stubber.add_response('describe_stacks', { 'Stacks': [{ 'StackName': 'job', 'StackId': stack_id,
+                    'StackStatus': 'CREATE_IN_PROGRESS', 'CreationTime': datetime.datetime(2020, 1, 1) }] },
+                    { 'StackName': stack_id })
+
+                launch = cfn.create_stack('job', 'template', [], 'token')
+
+        finally:
+            cfn_module.clients.pop('cloudformation', None)
+
+        self.assertEqual('job', launch.stack_name)
+        self.assertEqual('CREATE_IN_PROGRESS', launch.stack_status)
+        self.assertIsNone(launch.stack_status_reason)
+        self.assertEqual(datetime.datetime(2020, 1, 1), launch.creation_time)
+
+
+    '''
+    verify_namespace pages through the namespace and returns it by
+    parameter name, the launch reads nothing else from SSM
+    '''
+    def test_verify_namespace(self):
+        cfn = CFN('cfn-bucket', 'template.yml')
+        path = { 'Path': '/bucket/', 'Recursive': False, 'WithDecryption': False }
+
+        client = boto3.client('ssm', region_name = 'us-east-1',
+            aws_access_key_id = 'test', aws_secret_access_key = 'test')
+        cfn_module.clients['ssm'] = client
+        try:
+            with Stubber(client) as stubber:
+                stubber.add_response('get_parameters_by_path', { 'NextToken': 'next', 'Parameters': [
+                    { 'Name': '/bucket/launcher', 'Value': 'ec2' }] }, path)
+                stubber.add_response('get_parameters_by_path', { 'Parameters': [
+                    { 'Name': '/bucket/event-data', 'Value': 's3://bucket/data.csv.gz' }] }, dict(path, NextToken = 'next'))
+                stubber.add_response('get_parameters_by_path', { 'Parameters': [] }, dict(path, Path = '/empty/'))
+
+                params = cfn_module.verify_namespace(cfn, '/bucket/')
+                with self.assertRaises(Exception):
+                    cfn_module.verify_namespace(cfn, '/empty/')
+
+        finally:
+            cfn_module.clients.pop('ssm', None)
+
+        self.assertEqual({ 'launcher': 'ec2', 'event-data': 's3://bucket/data.csv.gz' }, params)
+        self.assertEqual('gzip', cfn_module.get_event_data_encoding(params))
+        self.assertIsNone(cfn_module.get_event_data_encoding(dict(params, **{ 'content-encoding': 'none' })))
@@ -0,0 +1,265 @@
+import unittest
+import sys
+import json
+import datetime
+import os, base64
+import tempfile
+
+sys.path.append('./lambda/src')
+
+from cfn import CFN, InstanceLaunch
+from cfn_launch import launch_records, launch_messages
+from idempotency import SqliteLaunchIndex, get_dedupe_key
+
+
+'''
+stands in for the StackLaunch returned by create_stack
+'''
+class FakeStack(object):
+
+    def __init__(self, stack_name: str):
+        self.stack_name = stack_name
+        self.stack_id = f'arn:aws:cloudformation:us-east-1:000000000000:stack/{stack_name}/0'
+        self.stack_status = 'CREATE_IN_PROGRESS'
+        self.stack_status_reason = None
+        self.creation_time = datetime.datetime(2020, 1, 1)
+
+
+'''
+CFN with the AWS calls replaced by local bookkeeping
+'''
+class FakeCFN(CFN):
+
+    def __init__(self):
+        super().__init__('cfn-bucket', 'template.yml')
+        self.created = []
+        self.shard_plans = []
+        self.event_data_size = 0
+        self.namespace_params = {}
+        self.tokens = []
+        self.instances = []
+
+    def verify_namespace(self, namespace: str):
+        return dict({ 'event-data': 's3://bucket/data.csv' }, **self.namespace_params)
+
+    def put_event_resource_param(self, namespace: str, bucket: str, key: str):
+        return { 'Version': 1 }
+
+    def get_event_data_size(self, resource: str):
+        return self.event_data_size
+
+    def put_shard_plan(self, namespace: str, ranges: list):
+        self.shard_plans.append((namespace, ranges))
+        return { 'Version': 1 }
+
+    def create_stack(self, stack_name: str, template_body: str, template_parameters: [], client_request_token: str = None):
+        self.created.append((stack_name, template_parameters))
+        self.tokens.append(client_request_token)
+        return FakeStack(stack_name)
+
+    def run_instance(self, instance_name: str, template_body: str, template_parameters: [], client_request_token: str = None):
+        self.instances.append((instance_name, template_parameters))
+        self.tokens.append(client_request_token)
+        return InstanceLaunch(instance_name, { 'InstanceId': 'i-0123', 'State': { 'Name': 'pending' },
+            'LaunchTime': datetime.datetime(2020, 1, 1) })
+
+
+class TestCfnLaunch(unittest.TestCase):
+
+    '''
+    every record is launched and reported in event order, an
+    unsupported key fails without affecting the others
+    '''
+    def test_launch_records(self):
+        cfn = FakeCFN()
+
+        with open('./lambda/tests/resources/s3-objects-created.json', 'r') as file_obj:
+            records = cfn.get_event_records(json.load(file_obj))
+
+        shared_params = [{ 'ParameterKey': 'InstanceType', 'ParameterValue': 't2.micro' }]
+        results = launch_records(cfn, records, 'template', shared_params)
+
+        self.assertEqual([True, True, False], [r['success'] for r in results])
+        self.assertEqual('batch-processor-001-SNAPSHOT', results[0]['stack_name'])
+        self.assertEqual('batch-processor-002-SNAPSHOT', results[1]['stack_name'])
+        self.assertIn('not supported', results[2]['error'])
+
+        # the shared parameter list is not mutated between records
+        self.assertEqual(1, len(shared_params))
+        self.assertEqual('t2.micro', shared_params[0]['ParameterValue'])
+        for _, params in cfn.created:
+            names = [p['ParameterValue'] for p in params if p['ParameterKey'] == 'InstanceName']
+            self.assertEqual(1, len(names))
+
+
+    '''
+    an idle pool worker takes the job instead of a new stack
+    '''
+    def test_launch_records_dispatches_to_pool(self):
+        cfn = FakeCFN()
+
+        class FakePool(object):
+            pool_path = '/bucket/pool'
+            def dispatch(self, namespace: str):
+                return 'i-0123' if namespace == '/floresj4-cfn-ec2-processing/' else None
+
+        with open('./lambda/tests/resources/s3-objects-created.json', 'r') as file_obj:
+            records = cfn.get_event_records(json.load(file_obj))
+
+        results = launch_records(cfn, records[:2], 'template', [], FakePool())
+        self.assertEqual('DISPATCHED', results[0]['stack_status'])
+        self.assertIn('i-0123', results[0]['stack_status_reason'])
+        self.assertEqual('CREATE_IN_PROGRESS', results[1]['stack_status'])
+        self.assertEqual(['batch-processor-002-SNAPSHOT'], [name for name, _ in cfn.created])
+
+
+    '''
+    a large event-data fans out to one stack per shard, each told
+    its own shard-plan index
+    '''
+    def test_launch_records_fans_out(self):
+        cfn = FakeCFN()
+        cfn.event_data_size = 5 * 1024 * 1024 + 1
+
+        with open('./lambda/tests/resources/s3-objects-created.json', 'r') as file_obj:
+            records = cfn.get_event_records(json.load(file_obj))
+
+        os.environ['FANOUT_SHARD_MB'] = '2'
+        try:
+            results = launch_records(cfn, records[:1], 'template', [])
+        finally:
+            del os.environ['FANOUT_SHARD_MB']
+
+        self.assertEqual('FAN_OUT', results[0]['stack_status'])
+        self.assertEqual(3, len(results[0]['shards']))
+
+        namespace, ranges = cfn.shard_plans[0]
+        self.assertEqual(3, len(ranges))
+        self.assertEqual(cfn.event_data_size, ranges[-1][1])
+
+        created = sorted(cfn.created)
+        self.assertEqual([f'batch-processor-001-SNAPSHOT-shard{i}' for i in range(3)], [name for name, _ in created])
+        for i, (_, params) in enumerate(created):
+            userdata = [p['ParameterValue'] for p in params if p['ParameterKey'] == 'InstanceUserData'][0]
+            self.assertIn(f'echo shard={i} >', base64.b64decode(userdata).decode('utf-8'))
+
+
+    '''
+    compressed event-data is read whole by one instance, it never fans out
+    '''
+    def test_launch_records_compressed_no_fan_out(self):
+        with open('./lambda/tests/resources/s3-objects-created.json', 'r') as file_obj:
+            records = CFN('cfn-bucket', 'template.yml').get_event_records(json.load(file_obj))
+
+        os.environ['FANOUT_SHARD_MB'] = '2'
+        try:
+            for params in [{ 'event-data': 's3://bucket/data.csv.gz' }, { 'event-data': 's3://bucket/data.csv', 'content-encoding': 'zstd' }]:
+                cfn = FakeCFN()
+                cfn.event_data_size = 5 * 1024 * 1024 + 1
+                cfn.namespace_params.update(params)
+
+                results = launch_records(cfn, records[:1], 'template', [])
+
+                self.assertEqual([], cfn.shard_plans)
+                self.assertEqual(['batch-processor-001-SNAPSHOT'], [name for name, _ in cfn.created])
+                self.assertNotEqual('FAN_OUT', results[0]['stack_status'])
+        finally:
+            del os.environ['FANOUT_SHARD_MB']
+
+
+    '''
+    the instance type follows the input size unless the namespace
+    overrides it
+    '''
+    def test_launch_records_sizes_instance(self):
+        cfn = FakeCFN()
+        cfn.event_data_size = 2 * 1024 * 1024 * 1024
+
+        with open('./lambda/tests/resources/s3-objects-created.json', 'r') as file_obj:
+            records = cfn.get_event_records(json.load(file_obj))
+
+        shared_params = [{ 'ParameterKey': 'InstanceType', 'ParameterValue': 't2.micro' }]
+        os.environ['INSTANCE_SIZES'] = '256:t2.micro,*:m5.xlarge'
+        try:
+            launch_records(cfn, records[:1], 'template', shared_params)
+            cfn.namespace_params['instance-type'] = 'c5.xlarge'
+            launch_records(cfn, records[:1], 'template', shared_params)
+        finally:
+            del os.environ['INSTANCE_SIZES']
+
+        types = [[p['ParameterValue'] for p in params if p['ParameterKey'] == 'InstanceType'] for _, params in cfn.created]
+        self.assertEqual([['m5.xlarge'], ['c5.xlarge']], types)
+
+
+    '''
+    the namespace launcher parameter picks RunInstances over a stack,
+    an unknown launcher fails the record
+    '''
+    def test_launch_records_selects_launcher(self):
+        cfn = FakeCFN()
+
+        with open('./lambda/tests/resources/s3-objects-created.json', 'r') as file_obj:
+            records = cfn.get_event_records(json.load(file_obj))
+
+        launch_records(cfn, records[:1], 'template', [])
+        cfn.namespace_params['launcher'] = 'ec2'
+        results = launch_records(cfn, records[:1], 'template', [])
+        cfn.namespace_params['launcher'] = 'spot'
+        failed = launch_records(cfn, records[:1], 'template', [])
+
+        self.assertEqual(['batch-processor-001-SNAPSHOT'], [name for name, _ in cfn.created])
+        self.assertEqual(['batch-processor-001-SNAPSHOT'], [name for name, _ in cfn.instances])
+        self.assertEqual('PENDING', results[0]['stack_status'])
+        self.assertFalse(failed[0]['success'])
+        self.assertIn('Unknown launcher', failed[0]['error'])
+
+    '''
+    a redelivered event is a no-op, a changed object launches again
+    with a different request token and a failed launch can be retried
+    '''
+    def test_launch_records_deduplicates(self):
+        cfn = FakeCFN()
+
+        with open('./lambda/tests/resources/s3-objects-created.json', 'r') as file_obj:
+            records = cfn.get_event_records(json.load(file_obj), etag = True)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            index = SqliteLaunchIndex(os.path.join(tmp, 'launches.db'))
+
+            first = launch_records(cfn, records, 'template', [], index = index)
+            again = launch_records(cfn, records, 'template', [], index = index)
+            self.assertEqual(['CREATE_IN_PROGRESS', 'CREATE_IN_PROGRESS'], [r['stack_status'] for r in first[:2]])
+            self.assertEqual(['DUPLICATE', 'DUPLICATE'], [r['stack_status'] for r in again[:2]])
+            self.assertFalse(again[2]['success'])
+            self.assertEqual(2, len(cfn.created))
+
+            changed = [(records[0][0], records[0][1], 'changed')]
+            launch_records(cfn, changed, 'template', [], index = index)
+            self.assertEqual(3, len(cfn.created))
+            self.assertEqual(3, len(set(cfn.tokens)))
+
+            failed = [('missing-namespace', records[0][1], 'retried')]
+            cfn.verify_namespace = lambda namespace: {}
+            self.assertFalse(launch_records(cfn, failed, 'template', [], index = index)[0]['success'])
+            self.assertIsNone(index.get(get_dedupe_key(*failed[0])))
+
+
+    '''
+    an SQS batch launches the newest jar per namespace, a data upload
+    shares its jar's launch and only failed messages are retried
+    '''
+    def test_launch_messages(self):
+        cfn = FakeCFN()
+
+        with open('./lambda/tests/resources/sqs-s3-events.json', 'r') as file_obj:
+            messages = json.load(file_obj)['Records']
+
+        response = launch_messages(cfn, messages, 'template', [])
+        self.assertEqual(['batch-processor-001-SNAPSHOT', 'batch-processor-003-SNAPSHOT'], sorted(n for n, _ in cfn.created))
+        self.assertEqual([{ 'itemIdentifier': messages[5]['messageId'] }], response['batchItemFailures'])
+
+        verify = cfn.verify_namespace
+        cfn.verify_namespace = lambda namespace: namespace != '/floresj4-cfn-ec2-processing/jobs/nightly/' and verify(namespace)
+        response = launch_messages(cfn, messages, 'template', [])
+        failed = [f['itemIdentifier'] for f in response['batchItemFailures']]
+        self.assertEqual([messages[i]['messageId'] for i in (5, 1, 2, 3)], failed)
@@ -0,0 +1,85 @@
+import unittest
+import sys
+import json, time
+
+import boto3
+from botocore.stub import Stubber, ANY
+
+sys.path.append('./lambda/src')
+
+import cfn
+from idempotency import SsmLaunchIndex
+
+
+class TestSsmLaunchIndex(unittest.TestCase):
+
+    def setUp(self):
+        cfn.clients['ssm'] = boto3.client('ssm', region_name = 'us-east-1',
+            aws_access_key_id = 'test', aws_secret_access_key = 'test')
+        self.index = SsmLaunchIndex('/launches/', timeout = 900, ttl = 86400)
+
+    def tearDown(self):
+        cfn.clients.pop('ssm', None)
+
+    def put_params(self, overwrite: bool):
+        return { 'Name': '/launches/key', 'Value': ANY, 'Type': 'String', 'Tier': 'Advanced',
+            'Policies': ANY, 'Overwrite': overwrite }
+
+    def parameter(self, value: str, version: int):
+        return { 'Parameter': { 'Name': '/launches/key', 'Value': value, 'Version': version } }
+
+    '''
+    a new entry is claimed and expires with the in-flight timeout
+    '''
+    def test_claim(self):
+        puts = []
+        cfn.clients['ssm'].meta.events.register('provide-client-params.ssm.PutParameter',
+            lambda params, **kwargs: puts.append(dict(params)))
+
+        with Stubber(cfn.clients['ssm']) as stubber:
+            stubber.add_response('put_parameter', { 'Version': 1 }, self.put_params(False))
+            stubber.add_response('put_parameter', { 'Version': 2 }, self.put_params(True))
+
+            self.assertIsNone(self.index.claim('key', 'stack'))
+            self.index.complete('key', 'stack')
+
+        expires = [json.loads(put['Policies'])[0]['Attributes']['Timestamp'] for put in puts]
+        self.assertEqual(['Expiration', 'Expiration'], [json.loads(put['Policies'])[0]['Type'] for put in puts])
+        self.assertEqual([time.strftime('%Y-%m-%dT%H', time.gmtime(time.time() + delay)) for delay in (900, 86400)],
+            [timestamp[:13] for timestamp in expires])
+        self.assertTrue(puts[1]['Value'].startswith('launched '))
+
+    '''
+    a fresh entry is reported, a stale one is taken over when the
+    overwrite is the next version
+    '''
+    def test_claim_existing_and_stale(self):
+        with Stubber(cfn.clients['ssm']) as stubber:
+            stubber.add_client_error('put_parameter', service_error_code = 'ParameterAlreadyExists')
+            stubber.add_response('get_parameter', self.parameter(f'launched {time.time()} stack', 2))
+
+            stubber.add_client_error('put_parameter', service_error_code = 'ParameterAlreadyExists')
+            stubber.add_response('get_parameter', self.parameter(f'in-flight {time.time() - 1000} stack', 3))
+            stubber.add_response('put_parameter', { 'Version': 4 }, self.put_params(True))
+
+            self.assertEqual('launched', self.index.claim('key', 'stack')['state'])
+            self.assertIsNone(self.index.claim('key', 'stack'))
+            stubber.assert_no_pending_responses()
+
+    '''
+    of two invocations taking over the same stale entry, the one that
+    wrote later loses and reports the winner
+    '''
+    def test_takeover_race(self):
+        now = time.time()
+        with Stubber(cfn.clients['ssm']) as stubber:
+            stubber.add_client_error('put_parameter', service_error_code = 'ParameterAlreadyExists')
+            stubber.add_response('get_parameter', self.parameter(f'in-flight {now - 1000} stack', 3))
+            stubber.add_response('put_parameter', { 'Version': 5 }, self.put_params(True))
+            stubber.add_response('get_parameter', self.parameter(f'in-flight {now} stack', 4),
+                { 'Name': '/launches/key:4' })
+
+            entry = self.index.claim('key', 'stack')
+            stubber.assert_no_pending_responses()
+
+        self.assertEqual({ 'state': 'in-flight', 'updated': now, 'stack_name': 'stack' }, entry)
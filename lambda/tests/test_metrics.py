@@ -0,0 +1,77 @@
+import unittest
+import sys
+import io
+import json
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import boto3
+from botocore.config import Config
+
+sys.path.append('./lambda/src')
+
+from metrics import ApiMetrics
+
+
+'''
+answers GetParameter with a throttle for the first two attempts
+'''
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    attempts = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        ThrottlingHandler.attempts += 1
+
+        if ThrottlingHandler.attempts <= 2:
+            status, body = 400, { '__type': 'ThrottlingException', 'message': 'Rate exceeded' }
+        else:
+            status, body = 200, { 'Parameter': { 'Name': 'name', 'Value': 'value' } }
+
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMetrics(unittest.TestCase):
+
+    '''
+    throttles absorbed by the client retry config are counted and the
+    call is emitted as an embedded metric line
+    '''
+    def test_throttled_call(self):
+        server = HTTPServer(('127.0.0.1', 0), ThrottlingHandler)
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+
+        try:
+            metrics = ApiMetrics('Test')
+            ssm = metrics.instrument(boto3.client('ssm', region_name = 'us-east-1',
+                endpoint_url = f'http://127.0.0.1:{server.server_port}',
+                aws_access_key_id = 'test', aws_secret_access_key = 'test',
+                config = Config(retries = { 'max_attempts': 5 })))
+
+            ssm.get_parameter(Name = 'name')
+
+            out = io.StringIO()
+            metrics.flush(out, { 'Function': 'test' })
+        finally:
+            server.shutdown()
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(1, len(lines))
+
+        metric = json.loads(lines[0])
+        self.assertEqual(('ssm', 'GetParameter'), (metric['Service'], metric['Operation']))
+        self.assertEqual((1, 2, 2, 0), (metric['Calls'], metric['Retries'], metric['Throttles'], metric['Errors']))
+        self.assertEqual(1, len(metric['Latency']))
+        self.assertEqual(1, sum(metric['LatencyHistogram'].values()))
+        self.assertEqual([['Function', 'Service', 'Operation']], metric['_aws']['CloudWatchMetrics'][0]['Dimensions'])
+
+        # flushing starts a new collection period
+        self.assertEqual([], metrics.to_emf())
@@ -0,0 +1,55 @@
+import unittest
+import sys
+import os
+import time
+import tempfile
+
+sys.path.append('./lambda/src')
+
+from pool import WorkerPool, LocalPoolBoard
+
+
+class TestPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.board = LocalPoolBoard(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    '''
+    write a worker parameter the way batch-init.py --pool does
+    '''
+    def put(self, worker_id: str, name: str, value: str):
+        os.makedirs(os.path.join(self.tmp.name, worker_id), exist_ok = True)
+        with open(os.path.join(self.tmp.name, worker_id, name), 'w') as param:
+            param.write(value)
+
+    '''
+    only fresh, idle and unassigned workers are dispatched to and
+    each worker is claimed once
+    '''
+    def test_dispatch(self):
+        now = time.time()
+        self.put('i-idle', 'state', f'idle {now}')
+        self.put('i-busy', 'state', f'busy {now}')
+        self.put('i-stale', 'state', f'idle {now - 600}')
+        self.put('i-assigned', 'state', f'idle {now}')
+        self.put('i-assigned', 'assignment', '/bucket/other/')
+
+        pool = WorkerPool(self.board, heartbeat_timeout = 120)
+        self.assertEqual(['i-idle'], pool.get_idle_workers())
+        self.assertEqual('i-idle', pool.dispatch('/bucket/job/'))
+        self.assertIsNone(pool.dispatch('/bucket/next/'))
+
+        with open(os.path.join(self.tmp.name, 'i-idle', 'assignment'), 'r') as assignment:
+            self.assertEqual('/bucket/job/', assignment.read())
+
+    '''
+    a claim fails when another dispatcher already assigned the worker
+    '''
+    def test_claim_is_exclusive(self):
+        self.put('i-1', 'state', f'idle {time.time()}')
+        self.assertTrue(self.board.claim('i-1', '/bucket/a/'))
+        self.assertFalse(self.board.claim('i-1', '/bucket/b/'))
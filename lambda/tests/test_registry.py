@@ -0,0 +1,135 @@
+import unittest
+import sys
+import uuid
+from unittest import mock
+
+import boto3
+from botocore.stub import Stubber
+
+sys.path.append('./lambda/src')
+
+import cfn
+import registry
+from registry import TemplateRegistry, get_template_digest
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        registry.registered.clear()
+        registry.bucket_regions.clear()
+        self.uuid = mock.patch.object(registry.uuid, 'uuid4', return_value = uuid.UUID(int = 1))
+        self.uuid.start()
+        cfn.clients['s3'] = boto3.client('s3', region_name = 'us-east-1',
+            aws_access_key_id = 'test', aws_secret_access_key = 'test')
+        cfn.clients['cloudformation'] = boto3.client('cloudformation', region_name = 'us-east-1',
+            aws_access_key_id = 'test', aws_secret_access_key = 'test')
+
+    def tearDown(self):
+        self.uuid.stop()
+        registry.registered.clear()
+        registry.bucket_regions.clear()
+        cfn.clients.pop('s3', None)
+        cfn.clients.pop('cloudformation', None)
+
+    '''
+    a new template is staged, validated by url and published once
+    under its hash, later registrations are answered from memory
+    '''
+    def test_register(self):
+        body = 'Resources: {}'
+        digest = get_template_digest(body)
+        key, staging_key = f'templates/{digest}.yml', f'templates/staging/{digest}-{uuid.UUID(int = 1).hex}.yml'
+
+        with Stubber(cfn.clients['s3']) as s3_stub, \
+                Stubber(cfn.clients['cloudformation']) as cfn_stub:
+            s3_stub.add_client_error('head_object', service_error_code = '404', http_status_code = 404,
+                expected_params = { 'Bucket': 'cfn-bucket', 'Key': key },
+                response_meta = { 'HTTPHeaders': { 'x-amz-bucket-region': 'eu-west-1' } })
+            s3_stub.add_response('put_object', {}, { 'Bucket': 'cfn-bucket', 'Key': staging_key,
+                'Body': body.encode('utf-8'), 'ContentType': 'application/x-yaml',
+                'Metadata': { 'sha256': digest } })
+            cfn_stub.add_response('validate_template', { 'Parameters': [] },
+                { 'TemplateURL': f'https://cfn-bucket.s3.eu-west-1.amazonaws.com/{staging_key}' })
+            s3_stub.add_response('copy_object', {}, { 'Bucket': 'cfn-bucket', 'Key': key,
+                'CopySource': { 'Bucket': 'cfn-bucket', 'Key': staging_key } })
+            s3_stub.add_response('delete_object', {}, { 'Bucket': 'cfn-bucket', 'Key': staging_key })
+
+            templates = TemplateRegistry('cfn-bucket')
+            url = templates.register(body)
+            self.assertEqual(url, templates.register(body))
+
+            s3_stub.assert_no_pending_responses()
+            cfn_stub.assert_no_pending_responses()
+
+        self.assertEqual(f'https://cfn-bucket.s3.eu-west-1.amazonaws.com/{key}', url)
+
+    '''
+    a published template is trusted without validation, an invalid
+    template fails without being published and its staging copy is
+    removed
+    '''
+    def test_register_published_and_invalid(self):
+        staging_key = f"templates/staging/{get_template_digest('Resources: [')}-{uuid.UUID(int = 1).hex}.yml"
+
+        with Stubber(cfn.clients['s3']) as s3_stub, \
+                Stubber(cfn.clients['cloudformation']) as cfn_stub:
+            s3_stub.add_response('head_object', { 'ContentLength': 13 })
+            s3_stub.add_response('get_bucket_location', { 'LocationConstraint': 'EU' }, { 'Bucket': 'cfn-bucket' })
+            s3_stub.add_client_error('head_object', service_error_code = '404', http_status_code = 404)
+            s3_stub.add_response('put_object', {})
+            cfn_stub.add_client_error('validate_template', service_error_code = 'ValidationError',
+                service_message = 'Template format error')
+            s3_stub.add_response('delete_object', {}, { 'Bucket': 'cfn-bucket', 'Key': staging_key })
+
+            templates = TemplateRegistry('cfn-bucket')
+            templates.register('Resources: {}')
+            with self.assertRaises(Exception) as raised:
+                templates.register('Resources: [')
+
+            self.assertIn('Template format error', str(raised.exception))
+            s3_stub.assert_no_pending_responses()
+
+    '''
+    templates above the inline limit register, above 1MB they fail
+    before anything is uploaded
+    '''
+    def test_register_large(self):
+        large = 'Resources: {}\n' + '#' * 100000 + '\n'
+
+        with Stubber(cfn.clients['s3']) as s3_stub, \
+                Stubber(cfn.clients['cloudformation']) as cfn_stub:
+            s3_stub.add_client_error('head_object', service_error_code = '404', http_status_code = 404)
+            s3_stub.add_response('put_object', {})
+            s3_stub.add_response('get_bucket_location', {})
+            cfn_stub.add_response('validate_template', { 'Parameters': [] })
+            s3_stub.add_response('copy_object', {})
+            s3_stub.add_response('delete_object', {})
+            s3_stub.add_client_error('head_object', service_error_code = '404', http_status_code = 404)
+
+            templates = TemplateRegistry('cfn-bucket')
+            templates.register(large)
+            with self.assertRaises(Exception) as raised:
+                templates.register('#' * (registry.MAX_TEMPLATE_URL_BODY + 1))
+
+            self.assertIn('larger than', str(raised.exception))
+            s3_stub.assert_no_pending_responses()
+
+    '''
+    the prefix is always a directory, and every publish attempt stages
+    under its own key
+    '''
+    def test_keys(self):
+        self.assertEqual('templates/abc.yml', TemplateRegistry('cfn-bucket', 'templates').get_key('abc'))
+        self.assertEqual('templates/abc.yml', TemplateRegistry('cfn-bucket', '/templates/').get_key('abc'))
+        self.assertEqual('abc.yml', TemplateRegistry('cfn-bucket', '').get_key('abc'))
+
+        self.uuid.stop()
+        try:
+            templates = TemplateRegistry('cfn-bucket')
+            staging = [templates.get_staging_key('abc') for _ in range(2)]
+        finally:
+            self.uuid.start()
+
+        self.assertNotEqual(staging[0], staging[1])
+        self.assertTrue(all(key.startswith('templates/staging/abc-') for key in staging))
@@ -0,0 +1,37 @@
+import unittest
+import sys
+
+sys.path.append('./lambda/src')
+
+from sizing import InstanceSizer, parse_size_table
+
+MB = 1024 * 1024
+
+
+class TestSizing(unittest.TestCase):
+
+    '''
+    tiers are ordered by size with the unbounded tier last
+    '''
+    def test_parse_size_table(self):
+        table = parse_size_table('*:m5.xlarge, 1024:t3.small,256:t2.micro')
+        self.assertEqual([(256 * MB, 't2.micro'), (1024 * MB, 't3.small'), (None, 'm5.xlarge')], table)
+
+        with self.assertRaises(Exception):
+            parse_size_table('256')
+
+
+    '''
+    the first tier the input fits wins, the override beats the table
+    '''
+    def test_select(self):
+        sizer = InstanceSizer(parse_size_table('256:t2.micro,1024:t3.small,*:m5.xlarge'))
+
+        self.assertEqual('t2.micro', sizer.select(0)[0])
+        self.assertEqual('t2.micro', sizer.select(256 * MB)[0])
+        self.assertEqual('t3.small', sizer.select(256 * MB + 1)[0])
+        self.assertEqual('m5.xlarge', sizer.select(50 * 1024 * MB)[0])
+        self.assertEqual(('c5.xlarge', 'instance-type parameter override'), sizer.select(0, 'c5.xlarge'))
+
+        bounded = InstanceSizer(parse_size_table('256:t2.micro'))
+        self.assertEqual('t2.micro', bounded.select(512 * MB)[0])
@@ -0,0 +1,159 @@
+import unittest
+import sys
+import datetime
+import tempfile
+
+import boto3
+from botocore.stub import Stubber
+
+sys.path.append('./lambda/src')
+
+import cfn
+from tracker import Backoff, StackTracker, FileTimelineStore, summarize, summarize_by_launcher
+
+
+def stub_client(name: str):
+    client = boto3.client(name, region_name = 'us-east-1',
+        aws_access_key_id = 'test', aws_secret_access_key = 'test')
+    cfn.clients[name] = client
+    return Stubber(client)
+
+
+class TestTracker(unittest.TestCase):
+
+    def tearDown(self):
+        for name in ['cloudformation', 'ec2', 'ssm']:
+            cfn.clients.pop(name, None)
+
+    '''
+    delays grow exponentially up to the cap and stay above half the base
+    '''
+    def test_backoff(self):
+        backoff = Backoff(base = 1.0, cap = 8.0)
+        delays = [backoff.next() for _ in range(10)]
+        self.assertTrue(all(0.5 <= d <= 8.0 for d in delays))
+        self.assertLessEqual(delays[0], 1.0)
+
+    '''
+    nearest-rank percentiles per milestone relative to the request
+    '''
+    def test_summarize(self):
+        timelines = [{ 'requested': 0, 'status': 'CREATE_COMPLETE', 'create_complete': float(i) } for i in range(1, 101)]
+        timelines.append({ 'requested': 0, 'status': 'ROLLBACK_COMPLETE' })
+
+        summary = summarize(timelines)
+        self.assertEqual(100, summary['create_complete']['count'])
+        self.assertEqual(50.0, summary['create_complete']['p50'])
+        self.assertEqual(90.0, summary['create_complete']['p90'])
+        self.assertEqual(100.0, summary['create_complete']['max'])
+        self.assertNotIn('batch_init_start', summary)
+        self.assertEqual({ 'CREATE_COMPLETE': 100, 'ROLLBACK_COMPLETE': 1 }, summary['statuses'])
+
+    '''
+    follow a stack to CREATE_COMPLETE, the running instance and the
+    batch-init start; the instance is running when cloudformation
+    completed it, no instance poll is needed.  the timeline is persisted
+    '''
+    def test_track(self):
+        requested = 1600000000.0
+        completed = datetime.datetime.fromtimestamp(requested + 90, datetime.timezone.utc)
+
+        running = datetime.datetime.fromtimestamp(requested + 80, datetime.timezone.utc)
+
+        def event(event_id, resource_type, status, timestamp = completed, logical_id = 'job', physical_id = 'id'):
+            return { 'StackId': 'id', 'EventId': event_id, 'StackName': 'job',
+                'LogicalResourceId': logical_id, 'PhysicalResourceId': physical_id, 'ResourceType': resource_type,
+                'ResourceStatus': status, 'Timestamp': timestamp }
+
+        with stub_client('cloudformation') as cfn_stub, stub_client('ec2') as ec2_stub, \
+                stub_client('ssm') as ssm_stub, tempfile.TemporaryDirectory() as tmp:
+            cfn_stub.add_response('describe_stack_events', { 'StackEvents': [
+                event('1', 'AWS::CloudFormation::Stack', 'CREATE_IN_PROGRESS')] })
+            cfn_stub.add_response('describe_stack_events', { 'StackEvents': [
+                event('3', 'AWS::CloudFormation::Stack', 'CREATE_COMPLETE'),
+                event('2', 'AWS::EC2::Instance', 'CREATE_COMPLETE', running, 'BatchProcessingInstance', 'i-0123'),
+                event('1', 'AWS::CloudFormation::Stack', 'CREATE_IN_PROGRESS')] })
+            ssm_stub.add_response('get_parameter', { 'Parameter': { 'Value': str(requested - 500) } })
+            ssm_stub.add_response('get_parameter', { 'Parameter': { 'Value': str(requested + 150) } })
+
+            store = FileTimelineStore(tmp)
+            tracker = StackTracker(store, timeout = 1e10, backoff_base = 0.001, backoff_cap = 0.001)
+            timeline = tracker.track('job', '/bucket/ns/', requested)
+
+            self.assertEqual('CREATE_COMPLETE', timeline['status'])
+            self.assertEqual(requested + 90, timeline['create_complete'])
+            self.assertEqual('i-0123', timeline['instance_id'])
+            self.assertEqual(requested + 80, timeline['instance_running'])
+            self.assertEqual(requested + 150, timeline['batch_init_start'])
+            self.assertEqual([timeline], store.all())
+
+    '''
+    a RunInstances launch is followed from its instance, no stack is
+    polled, and is summarized apart from the stack launches
+    '''
+    def test_track_instance(self):
+        requested = 1600000000.0
+
+        with stub_client('ec2') as ec2_stub, stub_client('ssm') as ssm_stub, tempfile.TemporaryDirectory() as tmp:
+            ec2_stub.add_response('describe_instances', { 'Reservations': [
+                { 'Instances': [{ 'State': { 'Name': 'running' } }] }] }, { 'InstanceIds': ['i-0123'] })
+            ssm_stub.add_response('get_parameter', { 'Parameter': { 'Value': str(requested + 60) } })
+
+            store = FileTimelineStore(tmp)
+            tracker = StackTracker(store, timeout = 1e10, backoff_base = 0.001, backoff_cap = 0.001)
+            timeline = tracker.track('job', '/bucket/ns/', requested, 'i-0123')
+
+            self.assertEqual('ec2', timeline['launcher'])
+            self.assertEqual('RUNNING', timeline['status'])
+            self.assertNotIn('create_complete', timeline)
+            self.assertEqual(requested + 60, timeline['batch_init_start'])
+
+        summary = summarize_by_launcher([timeline, { 'requested': 0, 'status': 'CREATE_COMPLETE' }])
+        self.assertEqual(['cloudformation', 'ec2'], list(summary.keys()))
+        self.assertEqual(60.0, summary['ec2']['batch_init_start']['p50'])
+
+    '''
+    a stack deleted after a failed create is still followed by its id
+    to the final status and the failure reason
+    '''
+    def test_track_deleted_stack(self):
+        requested = 1600000000.0
+        stack_id = 'arn:aws:cloudformation:us-east-1:000000000000:stack/job/0'
+        failed = datetime.datetime.fromtimestamp(requested + 30, datetime.timezone.utc)
+
+        def event(event_id, resource_type, status, logical_id = 'job', reason = None):
+            return { 'StackId': stack_id, 'EventId': event_id, 'StackName': 'job', 'LogicalResourceId': logical_id,
+                'ResourceType': resource_type, 'ResourceStatus': status, 'Timestamp': failed,
+                **({ 'ResourceStatusReason': reason } if reason else {}) }
+
+        with stub_client('cloudformation') as cfn_stub, tempfile.TemporaryDirectory() as tmp:
+            cfn_stub.add_response('describe_stack_events', { 'StackEvents': [
+                event('4', 'AWS::CloudFormation::Stack', 'DELETE_COMPLETE'),
+                event('3', 'AWS::CloudFormation::Stack', 'DELETE_IN_PROGRESS'),
+                event('2', 'AWS::EC2::Instance', 'CREATE_FAILED', 'BatchProcessingInstance', 'Insufficient capacity'),
+                event('1', 'AWS::CloudFormation::Stack', 'CREATE_IN_PROGRESS')] }, { 'StackName': stack_id })
+
+            tracker = StackTracker(FileTimelineStore(tmp), timeout = 1e10, backoff_base = 0.001, backoff_cap = 0.001)
+            timeline = tracker.track('job', '/bucket/ns/', requested, stack_id = stack_id)
+
+        self.assertEqual('DELETE_COMPLETE', timeline['status'])
+        self.assertEqual(['BatchProcessingInstance: Insufficient capacity'], timeline['reasons'])
+        self.assertEqual(stack_id, timeline['stack_id'])
+
+    '''
+    a fan-out shard waits for its own batch-init start
+    '''
+    def test_track_shard(self):
+        requested = 1600000000.0
+
+        with stub_client('ec2') as ec2_stub, stub_client('ssm') as ssm_stub, tempfile.TemporaryDirectory() as tmp:
+            ec2_stub.add_response('describe_instances', { 'Reservations': [
+                { 'Instances': [{ 'State': { 'Name': 'running' } }] }] })
+            ssm_stub.add_response('get_parameter', { 'Parameter': { 'Value': str(requested + 70) } },
+                { 'Name': '/bucket/ns/batch-init-start-shard2' })
+
+            tracker = StackTracker(FileTimelineStore(tmp), timeout = 1e10, backoff_base = 0.001, backoff_cap = 0.001)
+            timeline = tracker.track('job-shard2', '/bucket/ns/', requested, 'i-0123', shard_index = 2)
+
+        self.assertEqual(requested + 70, timeline['batch_init_start'])
+        self.assertEqual(2, timeline['shard_index'])